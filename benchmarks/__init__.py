@@ -0,0 +1,2 @@
+# Benchmarks for the authentication system
+# Run them from the project folder, for example: python -m benchmarks.auth_flows --help
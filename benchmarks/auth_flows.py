@@ -0,0 +1,184 @@
+# This file benchmarks the register, login and OTP flows end to end
+# Example:
+#   python -m benchmarks.auth_flows --users 50 --rounds 8 --concurrency 4 --save baseline.json
+#   python -m benchmarks.auth_flows --users 50 --rounds 8 --concurrency 4 --compare baseline.json
+import sys
+import time
+import argparse
+import platform
+from concurrent.futures import ThreadPoolExecutor
+from lib.auth import register_new_user, login_user, log_successful_login
+from lib.otp_service import create_new_otp, verify_otp_code, get_otp_store, set_otp_store
+from lib.otp_store import SQLOTPStore, MemoryOTPStore, TOTPStore
+from lib.hashing import set_hashing_engine, shutdown_hashing_engine
+from lib.audit import start_audit_writer, stop_audit_writer
+from benchmarks.common import (
+    TempDatabase, TimedHashingEngine, reset_timings, summarize, save_json, load_json
+)
+
+# The operations we measure, in the order they run for each user
+OPERATIONS = ["register_new_user", "login_user", "create_new_otp", "verify_otp_code", "log_successful_login"]
+
+# Which numbers count as a regression when comparing against a baseline
+HIGHER_IS_WORSE = ["p50_ms", "p95_ms", "p99_ms"]
+LOWER_IS_WORSE = ["throughput_per_s"]
+
+# OTP stores the benchmark can switch between
+OTP_STORES = {"sql": SQLOTPStore, "memory": MemoryOTPStore, "totp": lambda: TOTPStore(b"benchmark-key")}
+
+def timed_call(samples, name, function, *args):
+    """Run one operation and record its total, bcrypt, query and commit time"""
+    timings = reset_timings()
+    started = time.perf_counter()
+    result = function(*args)
+    total = time.perf_counter() - started
+
+    samples[name].append({
+        "total": total,
+        "bcrypt": timings.bcrypt,
+        "query": timings.query,
+        "commit": timings.commit,
+        "statements": timings.statements,
+    })
+    return result
+
+def register_one(database, samples, index):
+    """Register benchmark user number `index`"""
+    db = database.session()
+    try:
+        user = timed_call(samples, "register_new_user", register_new_user,
+                          db, f"bench_user_{index}", f"bench_user_{index}@example.com", "bench-password")
+        if user is None:
+            raise RuntimeError(f"Could not register bench_user_{index}")
+    finally:
+        db.close()
+
+def login_flow_one(database, samples, index):
+    """Run login -> issue OTP -> verify OTP -> log success for one user"""
+    db = database.session()
+    try:
+        user = timed_call(samples, "login_user", login_user,
+                          db, f"bench_user_{index}@example.com", "bench-password")
+        if user is None:
+            raise RuntimeError(f"Login failed for bench_user_{index}")
+
+        code = timed_call(samples, "create_new_otp", create_new_otp, db, user.id)
+        if not timed_call(samples, "verify_otp_code", verify_otp_code, db, user.id, code):
+            raise RuntimeError(f"OTP check failed for bench_user_{index}")
+
+        timed_call(samples, "log_successful_login", log_successful_login, db, user.id)
+    finally:
+        db.close()
+
+def run_phase(concurrency, function, count):
+    """Run function(index) for every index using `concurrency` threads, return wall time"""
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        # list() makes any worker exception show up here
+        list(pool.map(function, range(count)))
+    return time.perf_counter() - started
+
+def run_benchmark(users=20, rounds=10, concurrency=4, hash_workers=None, otp_store="sql", audit="sync"):
+    """Run the whole benchmark and return the results as a dictionary"""
+    database = TempDatabase()
+    set_hashing_engine(TimedHashingEngine(workers=hash_workers, rounds=rounds))
+    previous_store = get_otp_store()
+    set_otp_store(OTP_STORES[otp_store]())
+    if audit == "buffered":
+        start_audit_writer(database.SessionLocal)
+    samples = {name: [] for name in OPERATIONS}
+
+    try:
+        # Phase 1: register every user
+        register_wall = run_phase(concurrency, lambda i: register_one(database, samples, i), users)
+
+        # Phase 2: every user logs in with an OTP
+        login_wall = run_phase(concurrency, lambda i: login_flow_one(database, samples, i), users)
+    finally:
+        stop_audit_writer()
+        shutdown_hashing_engine()
+        set_otp_store(previous_store)
+        database.close()
+
+    operations = {"register_new_user": summarize(samples["register_new_user"], register_wall)}
+    for name in OPERATIONS[1:]:
+        operations[name] = summarize(samples[name], login_wall)
+
+    return {
+        "settings": {"users": users, "rounds": rounds, "concurrency": concurrency, "hash_workers": hash_workers,
+                     "otp_store": otp_store, "audit": audit},
+        "machine": {"python": platform.python_version(), "platform": platform.platform()},
+        "flows_per_s": users / login_wall if login_wall > 0 else 0.0,
+        "operations": operations,
+    }
+
+def print_report(results):
+    """Print a table of the results"""
+    settings = results["settings"]
+    print(f"\nusers={settings['users']} rounds={settings['rounds']} concurrency={settings['concurrency']}"
+          f" otp_store={settings['otp_store']} audit={settings['audit']}")
+    print(f"login flows per second: {results['flows_per_s']:.1f}")
+    print("-" * 104)
+    print(f"{'operation':<22}{'ops/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'bcrypt ms':>11}{'query ms':>10}{'commit ms':>11}{'stmts':>7}")
+    print("-" * 104)
+    for name, stats in results["operations"].items():
+        print(f"{name:<22}{stats['throughput_per_s']:>9.1f}{stats['p50_ms']:>9.2f}{stats['p95_ms']:>9.2f}"
+              f"{stats['p99_ms']:>9.2f}{stats['mean_bcrypt_ms']:>11.2f}{stats['mean_query_ms']:>10.2f}"
+              f"{stats['mean_commit_ms']:>11.2f}{stats['mean_statements']:>7.1f}")
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Print changes against a saved baseline and return the list of regressions"""
+    regressions = []
+    print(f"\nCompared to baseline (tolerance {tolerance:.0%}):")
+
+    for name, stats in results["operations"].items():
+        old = baseline["operations"].get(name)
+        if not old:
+            continue
+
+        for key in HIGHER_IS_WORSE + LOWER_IS_WORSE:
+            if not old[key]:
+                continue
+            change = (stats[key] - old[key]) / old[key]
+            worse = change > tolerance if key in HIGHER_IS_WORSE else change < -tolerance
+            marker = "  REGRESSION" if worse else ""
+            print(f"  {name:<22}{key:<18}{old[key]:>10.2f} -> {stats[key]:>10.2f} ({change:+.1%}){marker}")
+            if worse:
+                regressions.append((name, key))
+
+    return regressions
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Benchmark the register, login and OTP flows")
+    parser.add_argument("--users", type=int, default=20, help="how many users to register and log in")
+    parser.add_argument("--rounds", type=int, default=10, help="bcrypt cost (work factor)")
+    parser.add_argument("--concurrency", type=int, default=4, help="how many flows run at the same time")
+    parser.add_argument("--hash-workers", type=int, default=None, help="bcrypt pool size (default: CPU count)")
+    parser.add_argument("--otp-store", choices=sorted(OTP_STORES), default="sql", help="where OTP codes are kept")
+    parser.add_argument("--audit", choices=["sync", "buffered"], default="sync",
+                        help="save login attempts straight away or through the background audit writer")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against a JSON baseline saved earlier")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before flagging (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.users, args.rounds, args.concurrency, args.hash_workers, args.otp_store,
+                            args.audit)
+    print_report(results)
+
+    if args.save:
+        save_json(args.save, results)
+        print(f"\nResults saved to {args.save}")
+
+    if args.compare:
+        regressions = compare_to_baseline(results, load_json(args.compare), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) found")
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
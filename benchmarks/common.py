@@ -0,0 +1,162 @@
+# This file has the shared helpers the benchmarks use: temp databases, timers and percentiles
+import os
+import math
+import json
+import time
+import shutil
+import tempfile
+import threading
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, Session
+from lib.database import create_all_tables
+from lib.hashing import HashingEngine, _hash_password_bytes, _check_password_bytes
+import lib.models  # noqa: F401  (registers the tables on Base)
+
+# Each thread keeps its own running totals so concurrent workers don't mix them up
+_thread_timings = threading.local()
+
+class Timings:
+    """Running totals of where one operation spent its time (in seconds)"""
+
+    def __init__(self):
+        self.bcrypt = 0.0
+        self.query = 0.0
+        self.commit = 0.0
+        self.statements = 0
+
+def current_timings():
+    """Get the Timings object for the operation running on this thread"""
+    timings = getattr(_thread_timings, "value", None)
+    if timings is None:
+        timings = Timings()
+        _thread_timings.value = timings
+    return timings
+
+def reset_timings():
+    """Start fresh totals for the next operation on this thread"""
+    _thread_timings.value = Timings()
+    return _thread_timings.value
+
+class TimedSession(Session):
+    """A database session that records how long commits take"""
+
+    def commit(self):
+        timings = current_timings()
+        query_before = timings.query
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            # Statements run by the flush inside commit are already counted as query time
+            elapsed = time.perf_counter() - started
+            timings.commit += elapsed - (timings.query - query_before)
+
+class TimedHashingEngine(HashingEngine):
+    """A thread-pool hashing engine that records bcrypt time for the calling operation"""
+
+    def __init__(self, workers=None, rounds=12):
+        super().__init__(kind="thread", workers=workers, rounds=rounds)
+
+    def _timed(self, function, *args):
+        # Remember which operation asked for the work, then time it inside the worker
+        timings = current_timings()
+
+        def run():
+            started = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                timings.bcrypt += time.perf_counter() - started
+
+        return self.pool.submit(run)
+
+    def submit_hash(self, password):
+        return self._timed(_hash_password_bytes, password, self.rounds)
+
+    def submit_check(self, password, hashed_password):
+        return self._timed(_check_password_bytes, password, hashed_password)
+
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+def _stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    timings = current_timings()
+    timings.query += time.perf_counter() - started
+    timings.statements += 1
+
+def _stop_query_timer_on_error(context):
+    # Statements the database rejects (e.g. a unique constraint) still count
+    started_times = context.connection.info.get("query_started") if context.connection else None
+    if not started_times:
+        return
+    started = started_times.pop()
+    timings = current_timings()
+    timings.query += time.perf_counter() - started
+    timings.statements += 1
+
+class TempDatabase:
+    """A throwaway SQLite file with the full schema, removed again by close()"""
+
+    def __init__(self, name="bench.db"):
+        self.folder = tempfile.mkdtemp(prefix="auth_bench_")
+        self.path = os.path.join(self.folder, name)
+        self.url = f"sqlite:///{self.path}"
+
+        # Wait for locks instead of failing straight away when workers write at once
+        self.engine = create_engine(self.url, connect_args={"timeout": 30})
+        create_all_tables(self.engine)
+
+        # Time every SQL statement that goes through this engine
+        event.listen(self.engine, "before_cursor_execute", _start_query_timer)
+        event.listen(self.engine, "after_cursor_execute", _stop_query_timer)
+        event.listen(self.engine, "handle_error", _stop_query_timer_on_error)
+
+        self.SessionLocal = sessionmaker(bind=self.engine, class_=TimedSession, expire_on_commit=False)
+
+    def session(self):
+        """Open a new database session on the temp file"""
+        return self.SessionLocal()
+
+    def close(self):
+        """Dispose of the engine and delete the temp folder"""
+        self.engine.dispose()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (0 for an empty list)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+def summarize(samples, wall_time):
+    """Turn a list of per-call samples into throughput and latency numbers (milliseconds)"""
+    totals = [s["total"] for s in samples]
+    count = len(samples)
+
+    def mean_of(key):
+        return 1000.0 * sum(s[key] for s in samples) / count if count else 0.0
+
+    return {
+        "count": count,
+        "throughput_per_s": count / wall_time if wall_time > 0 else 0.0,
+        "p50_ms": 1000.0 * percentile(totals, 50),
+        "p95_ms": 1000.0 * percentile(totals, 95),
+        "p99_ms": 1000.0 * percentile(totals, 99),
+        "mean_bcrypt_ms": mean_of("bcrypt"),
+        "mean_query_ms": mean_of("query"),
+        "mean_commit_ms": mean_of("commit"),
+        "mean_statements": sum(s["statements"] for s in samples) / count if count else 0.0,
+    }
+
+def save_json(path, data):
+    """Write benchmark results to a JSON file"""
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+def load_json(path):
+    """Read benchmark results back from a JSON file"""
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,273 @@
+# This file throws many complete sign-up and login flows at one SQLite file from several
+# processes at once, to find out how many concurrent users the database can take
+# Each flow is register -> login_user -> create_new_otp -> verify_otp_code.
+#
+# Flows arrive at a fixed average rate (like real users would), whether or not earlier ones
+# have finished, so latency includes the time a flow waited for a free worker.
+# Examples:
+#   python -m benchmarks.load_storm --workers 4 --rate 20 --duration 30
+#   python -m benchmarks.load_storm --workers 1,2,4,8 --rate 40 --duration 20 --save storm.json
+#   python -m benchmarks.load_storm --workers 8 --rate 80 --duration 20 --shards 4
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import OperationalError
+from lib.database import create_all_tables
+from benchmarks.common import TempDatabase, percentile, save_json
+
+# The steps of one flow, in order
+STEPS = ["register", "login_user", "create_new_otp", "verify_otp_code"]
+
+# How long workers get to start up before the first flow is due
+START_DELAY_SECONDS = 2.0
+
+def arrival_times(rate, duration, pattern="poisson", seed=1):
+    """Seconds after the start at which each flow arrives"""
+    rng = random.Random(seed)
+    times = []
+    now = 0.0
+    while True:
+        # Poisson arrivals have random gaps with the right average, uniform ones are evenly spaced
+        now += rng.expovariate(rate) if pattern == "poisson" else 1.0 / rate
+        if now >= duration:
+            return times
+        times.append(now)
+
+def error_kind(error):
+    """Short name for an error, so the report can count them"""
+    if isinstance(error, OperationalError) and "database is locked" in str(error):
+        return "database is locked"
+    return type(error).__name__
+
+def run_flow(db, name, password):
+    """One complete flow for a new user, returns {step: seconds}"""
+    # Imported here so each worker process sets up its own hashing engine first
+    from lib.auth import try_register_user, login_user
+    from lib.otp_service import create_new_otp, verify_otp_code
+
+    step_times = {}
+
+    def step(step_name, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        step_times[step_name] = time.perf_counter() - started
+        return result
+
+    user, taken = step("register", try_register_user, db, name, f"{name}@example.com", password)
+    if user is None:
+        raise RuntimeError(f"{taken} already taken for {name}")
+    if step("login_user", login_user, db, f"{name}@example.com", password) is None:
+        raise RuntimeError(f"login failed for {name}")
+    code = step("create_new_otp", create_new_otp, db, user.id)
+    if not step("verify_otp_code", verify_otp_code, db, user.id, code):
+        raise RuntimeError(f"OTP check failed for {name}")
+    return step_times
+
+def run_sharded_flow(service, name, password):
+    """The same flow through the sharded store (lib/sharding.py), returns {step: seconds}"""
+    step_times = {}
+
+    def step(step_name, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        step_times[step_name] = time.perf_counter() - started
+        return result
+
+    user, taken = step("register", service.register, name, f"{name}@example.com", password)
+    if user is None:
+        raise RuntimeError(f"{taken} already taken for {name}")
+    if step("login_user", service.login, f"{name}@example.com", password) is None:
+        raise RuntimeError(f"login failed for {name}")
+    code = step("create_new_otp", service.issue_otp, user.id)
+    if not step("verify_otp_code", service.verify_otp, user.id, code):
+        raise RuntimeError(f"OTP check failed for {name}")
+    return step_times
+
+def worker_main(worker_number, schedule, settings):
+    """Run this worker's share of the flows (in a separate process), returns its samples"""
+    from lib.hashing import HashingEngine, set_hashing_engine
+
+    # bcrypt runs in this process, one hash at a time, like a single-threaded server would
+    set_hashing_engine(HashingEngine(kind="thread", workers=1, rounds=settings["rounds"]))
+    if settings["shards"]:
+        from lib.sharding import ShardSet, ShardedAuthService
+        shard_set = ShardSet(settings["path"], busy_timeout=settings["busy_timeout"])
+        service = ShardedAuthService(shard_set)
+    else:
+        engine = create_engine(f"sqlite:///{settings['path']}", connect_args={"timeout": settings["busy_timeout"]})
+        Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+    flows = []  # (waited seconds, total seconds from arrival, error kind or None)
+    steps = {name: [] for name in STEPS}
+    start_at = settings["start_at"]
+
+    for number, offset in schedule:
+        # Wait for the flow's arrival time (if we're behind, start straight away)
+        due = start_at + offset
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        began = time.time()
+
+        name = f"storm_{settings['run_id']}_{worker_number}_{number}"
+        try:
+            if settings["shards"]:
+                step_times = run_sharded_flow(service, name, "storm-password")
+            else:
+                with Session() as db:
+                    step_times = run_flow(db, name, "storm-password")
+            for step_name, seconds in step_times.items():
+                steps[step_name].append(seconds)
+            error = None
+        except Exception as exc:
+            error = error_kind(exc)
+
+        flows.append((began - due, time.time() - due, error))
+
+    if settings["shards"]:
+        shard_set.close()
+    else:
+        engine.dispose()
+    return {"flows": flows, "steps": steps}
+
+def run_storm(workers=4, rate=10.0, duration=10.0, rounds=10, pattern="poisson", busy_timeout=5.0,
+              path=None, seed=1, shards=0):
+    """Run one load test and return the results as a dictionary
+
+    With shards > 0 the flows go through the sharded store and path is its folder.
+    """
+    # Use the given database file (or shard folder), or a fresh temporary one
+    database = None
+    temp_folder = None
+    if shards:
+        from lib.sharding import ShardSet
+        if path is None:
+            temp_folder = path = tempfile.mkdtemp(prefix="auth_storm_shards_")
+        ShardSet(path, shard_count=shards).close()
+    elif path is None:
+        database = TempDatabase(name="storm.db")
+        path = database.path
+    else:
+        create_all_tables(create_engine(f"sqlite:///{path}"))
+
+    arrivals = arrival_times(rate, duration, pattern, seed)
+    settings = {
+        "path": path,
+        "rounds": rounds,
+        "busy_timeout": busy_timeout,
+        "shards": shards,
+        "run_id": f"{os.getpid()}{int(time.time())}",
+        "start_at": time.time() + START_DELAY_SECONDS,
+    }
+
+    # Hand the arrivals out to the workers in turn
+    schedules = [[] for _ in range(workers)]
+    for number, offset in enumerate(arrivals):
+        schedules[number % workers].append((number, offset))
+
+    # "spawn" gives every worker a clean interpreter (no copied threads or connections)
+    context = multiprocessing.get_context("spawn")
+    try:
+        with context.Pool(workers) as pool:
+            results = pool.starmap(worker_main, [(i, schedules[i], settings) for i in range(workers)])
+    finally:
+        if database is not None:
+            database.close()
+        if temp_folder is not None:
+            shutil.rmtree(temp_folder, ignore_errors=True)
+    wall = max(time.time() - settings["start_at"], duration)
+
+    return summarize_storm(results, {
+        "workers": workers, "rate": rate, "duration": duration, "rounds": rounds,
+        "pattern": pattern, "busy_timeout": busy_timeout, "shards": shards,
+    }, len(arrivals), wall)
+
+def summarize_storm(results, settings, offered, wall):
+    """Combine the workers' samples into throughput, latency and error numbers"""
+    flows = [flow for result in results for flow in result["flows"]]
+    finished = [total for waited, total, error in flows if error is None]
+    waits = [waited for waited, total, error in flows]
+
+    errors = {}
+    for waited, total, error in flows:
+        if error is not None:
+            errors[error] = errors.get(error, 0) + 1
+
+    step_stats = {}
+    for step_name in STEPS:
+        samples = [s for result in results for s in result["steps"][step_name]]
+        step_stats[step_name] = {
+            "p50_ms": 1000.0 * percentile(samples, 50),
+            "p95_ms": 1000.0 * percentile(samples, 95),
+        }
+
+    return {
+        "settings": settings,
+        "offered_flows": offered,
+        "finished_flows": len(finished),
+        "throughput_per_s": len(finished) / wall if wall > 0 else 0.0,
+        "p50_ms": 1000.0 * percentile(finished, 50),
+        "p95_ms": 1000.0 * percentile(finished, 95),
+        "p99_ms": 1000.0 * percentile(finished, 99),
+        "max_wait_ms": 1000.0 * max(waits, default=0.0),
+        "locked_errors": errors.get("database is locked", 0),
+        "errors": errors,
+        "steps": step_stats,
+    }
+
+def print_report(runs):
+    """Print one line per run, then the step times of each run"""
+    print("-" * 100)
+    print(f"{'workers':>8}{'offered':>9}{'done':>7}{'flows/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'max wait ms':>13}{'locked':>8}{'other errors':>14}")
+    print("-" * 100)
+    for run in runs:
+        other = sum(run["errors"].values()) - run["locked_errors"]
+        print(f"{run['settings']['workers']:>8}{run['offered_flows']:>9}{run['finished_flows']:>7}"
+              f"{run['throughput_per_s']:>9.1f}{run['p50_ms']:>10.1f}{run['p95_ms']:>10.1f}{run['p99_ms']:>10.1f}"
+              f"{run['max_wait_ms']:>13.1f}{run['locked_errors']:>8}{other:>14}")
+
+    for run in runs:
+        steps = ", ".join(f"{name} {stats['p50_ms']:.1f}/{stats['p95_ms']:.1f}"
+                          for name, stats in run["steps"].items())
+        print(f"\nworkers={run['settings']['workers']} step p50/p95 ms: {steps}")
+        if run["errors"]:
+            print(f"  errors: {run['errors']}")
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Run concurrent register/login/OTP flows against one SQLite file")
+    parser.add_argument("--workers", default="4", help="worker processes, or a list like 1,2,4,8 to try each")
+    parser.add_argument("--rate", type=float, default=10.0, help="new flows per second (all workers together)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds during which flows arrive")
+    parser.add_argument("--arrivals", choices=["poisson", "uniform"], default="poisson", help="how flows are spaced")
+    parser.add_argument("--rounds", type=int, default=10, help="bcrypt cost (work factor)")
+    parser.add_argument("--busy-timeout", type=float, default=5.0, help="seconds SQLite waits for a lock")
+    parser.add_argument("--database", help="database file (or shard folder) to use (default: a fresh temporary one)")
+    parser.add_argument("--shards", type=int, default=0, help="spread users over this many SQLite files")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the arrival times")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    runs = []
+    for workers in [int(part) for part in args.workers.split(",")]:
+        print(f"Running with {workers} worker(s)...", flush=True)
+        runs.append(run_storm(workers, args.rate, args.duration, args.rounds, args.arrivals,
+                              args.busy_timeout, args.database, args.seed, args.shards))
+    print_report(runs)
+
+    if args.save:
+        save_json(args.save, {"runs": runs})
+        print(f"\nResults saved to {args.save}")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
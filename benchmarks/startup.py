@@ -0,0 +1,107 @@
+# This file measures how long the program takes to start, for the commands people run most
+# Every run is a fresh Python process, the way a user or a script starts it.
+# Run it with: python -m benchmarks.startup   (exits with 1 if any command goes over budget)
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+from benchmarks.common import save_json
+
+# The project folder (where main.py lives)
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The most each start may take (median, in milliseconds). Generous on purpose so a slow
+# machine passes, while something like an eager SQLAlchemy import in "health" still fails.
+BUDGET_MS = {
+    "main.py --help": 150,
+    "main.py health": 150,
+    "interactive (new database)": 3000,
+    "interactive (existing database)": 2000,
+}
+
+# Commands that should start without loading SQLAlchemy at all
+LIGHT_COMMANDS = ["main.py --help", "main.py health"]
+
+# A line of python -X importtime output for the top-level sqlalchemy package
+_SQLALCHEMY_IMPORT = re.compile(r"\|\s+sqlalchemy$", re.MULTILINE)
+
+def run_once(folder, arguments, stdin_text=None, trace_imports=False):
+    """Start main.py once in the given folder, returns (milliseconds, its stderr output)"""
+    trace = ["-X", "importtime"] if trace_imports else []
+    command = [sys.executable] + trace + [os.path.join(PROJECT_DIR, "main.py")] + arguments
+    environment = dict(os.environ, PYTHONPATH=PROJECT_DIR)
+
+    started = time.perf_counter()
+    finished = subprocess.run(command, cwd=folder, input=stdin_text, capture_output=True, text=True,
+                              env=environment)
+    elapsed_ms = 1000.0 * (time.perf_counter() - started)
+    return elapsed_ms, finished.stderr
+
+def measure(runs=5):
+    """Time each command `runs` times, returns {command: {"median_ms", "min_ms", "loads_sqlalchemy"}}"""
+    folder = tempfile.mkdtemp(prefix="auth_startup_")
+    database_path = os.path.join(folder, "auth_system.db")
+    results = {}
+
+    def time_command(name, arguments, stdin_text=None, fresh_database=False):
+        samples = []
+        for _ in range(runs):
+            if fresh_database and os.path.exists(database_path):
+                os.remove(database_path)
+            samples.append(run_once(folder, arguments, stdin_text)[0])
+
+        # One more start with import tracing on, to see what it loaded (not timed)
+        _, import_log = run_once(folder, arguments, stdin_text, trace_imports=True)
+        results[name] = {
+            "median_ms": statistics.median(samples),
+            "min_ms": min(samples),
+            "loads_sqlalchemy": bool(_SQLALCHEMY_IMPORT.search(import_log)),
+        }
+
+    try:
+        # Option 4 on the main menu exits straight away
+        time_command("interactive (new database)", [], "4\n", fresh_database=True)
+        time_command("interactive (existing database)", [], "4\n")
+        time_command("main.py --help", ["--help"])
+        time_command("main.py health", ["health"])
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return results
+
+def main(argv=None):
+    """Print the start times and fail if any command is over budget or loads too much"""
+    parser = argparse.ArgumentParser(description="Measure how long main.py takes to start")
+    parser.add_argument("--runs", type=int, default=5, help="starts per command (the median is reported)")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    results = measure(args.runs)
+    failures = 0
+
+    for name, budget in BUDGET_MS.items():
+        stats = results[name]
+        problems = []
+        if stats["median_ms"] > budget:
+            problems.append("OVER BUDGET")
+        if name in LIGHT_COMMANDS and stats["loads_sqlalchemy"]:
+            problems.append("LOADS SQLALCHEMY")
+        failures += bool(problems)
+
+        status = ", ".join(problems) or "ok"
+        print(f"{name:<34}{stats['median_ms']:>8.1f} ms median{stats['min_ms']:>8.1f} ms min"
+              f"  (budget {budget} ms)  {status}")
+
+    if args.save:
+        save_json(args.save, results)
+        print(f"\nResults saved to {args.save}")
+
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+# This file checks how many SQL statements each auth operation sends to the database
+# Run it with: python -m benchmarks.statement_counts   (exits with 1 if any count goes up)
+import sys
+from lib.auth import try_register_user, login_user, log_successful_login, update_user_info
+from lib.otp_service import create_new_otp, verify_otp_code
+from lib.hashing import set_hashing_engine, shutdown_hashing_engine
+from benchmarks.common import TempDatabase, TimedHashingEngine, reset_timings
+
+# The most statements each operation may use (with the default SQL OTP store, no user
+# cache or Bloom filter, and login attempts saved straight away)
+EXPECTED_STATEMENTS = {
+    "register (new user)": 1,             # INSERT
+    "register (username taken)": 1,       # INSERT rejected by the unique constraint
+    "login (correct password)": 1,        # SELECT user
+    "login (wrong password)": 2,          # SELECT user + INSERT login attempt
+    "update profile (all fields)": 1,     # UPDATE
+    "update profile (email taken)": 2,    # UPDATE rejected + UPDATE without the email
+    "create OTP": 2,                      # UPDATE old codes + INSERT new code
+    "verify OTP (correct)": 1,            # UPDATE ... WHERE code matches
+    "verify OTP (wrong)": 1,              # UPDATE that matches nothing
+    "log successful login": 1,            # INSERT login attempt
+}
+
+def count_statements(function, *args):
+    """Run function(*args) and return (result, number of SQL statements it sent)"""
+    timings = reset_timings()
+    result = function(*args)
+    return result, timings.statements
+
+def measure():
+    """Run every operation once against a temp database, returns {operation: statement count}"""
+    database = TempDatabase()
+    set_hashing_engine(TimedHashingEngine(rounds=4))
+    counts = {}
+
+    try:
+        db = database.session()
+
+        (user, _), counts["register (new user)"] = count_statements(
+            try_register_user, db, "count_user", "count@example.com", "password1")
+        try_register_user(db, "other_user", "other@example.com", "password1")
+        _, counts["register (username taken)"] = count_statements(
+            try_register_user, db, "count_user", "new@example.com", "password1")
+
+        _, counts["login (correct password)"] = count_statements(
+            login_user, db, "count@example.com", "password1")
+        _, counts["login (wrong password)"] = count_statements(
+            login_user, db, "count@example.com", "wrong-password")
+
+        _, counts["update profile (all fields)"] = count_statements(
+            update_user_info, db, user, "count_user2", "count2@example.com", "password2")
+        _, counts["update profile (email taken)"] = count_statements(
+            update_user_info, db, user, "count_user3", "other@example.com")
+
+        code, counts["create OTP"] = count_statements(create_new_otp, db, user.id)
+        _, counts["verify OTP (wrong)"] = count_statements(verify_otp_code, db, user.id, "not-a-code")
+        _, counts["verify OTP (correct)"] = count_statements(verify_otp_code, db, user.id, code)
+
+        _, counts["log successful login"] = count_statements(log_successful_login, db, user.id)
+        db.close()
+    finally:
+        shutdown_hashing_engine()
+        database.close()
+
+    return counts
+
+def main():
+    """Print each count and fail if any operation uses more statements than expected"""
+    counts = measure()
+    failures = 0
+
+    for name, expected in EXPECTED_STATEMENTS.items():
+        actual = counts[name]
+        status = "ok" if actual <= expected else "TOO MANY"
+        if actual > expected:
+            failures += 1
+        print(f"{name:<32}{actual:>3} statements (expected {expected})  {status}")
+
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
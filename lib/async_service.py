@@ -0,0 +1,197 @@
+# This file offers the auth and OTP features as asyncio coroutines
+# It uses SQLAlchemy's async engine (aiosqlite driver) and runs bcrypt on the hashing
+# engine's worker pool, so one process can serve many login flows at the same time.
+#
+# Needs the async extras:  pip install aiosqlite greenlet
+#
+# Login runs the same steps as lib/auth.login_user (throttle, password check, failed
+# attempts saved, old bcrypt costs upgraded) with two exceptions: the username/email Bloom
+# filter and the user cache belong to lib/database.py's engine, so logins here always read
+# the row from the database. Changes made here still throw away that cache's copy.
+import asyncio
+from datetime import datetime
+from sqlalchemy import select, update, delete, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from lib.models import User, OTP, LoginAttempt
+from lib.auth import hash_password_async, check_password_async, _conflicting_field
+from lib.otp_service import generate_otp_code, get_otp_store, OTP_LIFETIME, otp_guess_allowed, record_otp_result
+from lib.otp_store import SQLOTPStore
+from lib.audit import flush_audit_log
+from lib.throttle import get_login_throttle, email_key, user_key
+from lib.history import history_query, make_page
+from lib.hashing import get_hashing_engine
+from lib.user_cache import get_user_cache
+from lib.session_tokens import get_session_tokens
+from lib.config import DATABASE_PATH
+
+# Same database file as lib/database.py, opened through the async driver
+ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{DATABASE_PATH}"
+
+def _forget_cached_user(user_id):
+    """Drop the user cache's copy of a user whose row changed here"""
+    user_cache = get_user_cache()
+    if user_cache:
+        user_cache.invalidate(user_id)
+
+class AsyncAuthService:
+    """Register, login, OTP, history and delete as coroutines"""
+
+    def __init__(self, url=ASYNC_DATABASE_URL):
+        # Wait up to 30 seconds for SQLite's write lock instead of failing straight away
+        self.engine = create_async_engine(url, connect_args={"timeout": 30})
+
+        # Keep loaded attributes after commit so returned users can be read without the database
+        self.Session = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    async def close(self):
+        """Close every database connection"""
+        await self.engine.dispose()
+
+    async def _record_attempt(self, db, user_id, successful):
+        await db.execute(insert(LoginAttempt).values(
+            user_id=user_id, successful=successful, timestamp=datetime.now()
+        ))
+        await db.commit()
+
+    async def try_register(self, username, email, password):
+        """Create a new account, returns (user, None) or (None, "username"/"email") if taken"""
+        # Step 1: Hash the password on the worker pool (the event loop keeps running)
+        hashed_password = await hash_password_async(password)
+
+        # Step 2: Save it with a single INSERT - the unique constraints on username and email
+        # tell us if either is taken, so there's no need to look them up first
+        async with self.Session() as db:
+            new_user = User(username=username, email=email, password=hashed_password, created_at=datetime.now())
+            db.add(new_user)
+            try:
+                await db.commit()
+            except IntegrityError as error:
+                await db.rollback()
+                return None, _conflicting_field(error)
+            return new_user, None
+
+    async def register(self, username, email, password):
+        """Create a new account, returns the User or None if the username/email is taken"""
+        user, _ = await self.try_register(username, email, password)
+        return user
+
+    async def login(self, email, password):
+        """Check email and password, returns the User or None"""
+        # Refuse locked-out emails before touching the database or bcrypt
+        throttle = get_login_throttle()
+        if throttle and throttle.retry_after(email_key(email)):
+            return None
+
+        async with self.Session() as db:
+            user = await db.scalar(select(User).where(User.email == email))
+            if user is None:
+                if throttle:
+                    throttle.record_failure(email_key(email))
+                return None
+
+            if throttle and throttle.retry_after(user_key(user.id)):
+                return None
+
+            if not await check_password_async(password, user.password):
+                # Password is wrong - record this failed attempt
+                if throttle:
+                    throttle.record_failure(email_key(email))
+                    throttle.record_failure(user_key(user.id))
+                await self._record_attempt(db, user.id, successful=False)
+                return None
+
+            if throttle:
+                throttle.reset(email_key(email))
+                throttle.reset(user_key(user.id))
+
+            # If the hash was made with an older bcrypt cost, upgrade it now that we know
+            # the password (same as login_user)
+            if get_hashing_engine().needs_rehash(user.password):
+                user.password = await hash_password_async(password)
+                await db.commit()
+                _forget_cached_user(user.id)
+            return user
+
+    async def log_successful_login(self, user_id):
+        """Record a successful login"""
+        async with self.Session() as db:
+            await self._record_attempt(db, user_id, successful=True)
+
+    async def issue_otp(self, user_id):
+        """Create a new OTP code for the user and return it"""
+        current_time = datetime.now()
+        expires_at = current_time + OTP_LIFETIME
+        store = get_otp_store()
+        code = store.make_code(user_id, current_time) or generate_otp_code()
+
+        # Stores that don't use the database (MemoryOTPStore, TOTPStore) are called directly
+        if not isinstance(store, SQLOTPStore):
+            store.issue(None, user_id, code, current_time, expires_at)
+            return code
+
+        async with self.Session() as db:
+            # Cancel older unused codes and save the new one in one transaction
+            await db.execute(
+                update(OTP).where(OTP.user_id == user_id, OTP.is_used == False).values(is_used=True)
+            )
+            await db.execute(insert(OTP).values(
+                user_id=user_id, code=code, created_at=current_time, expires_at=expires_at, is_used=False
+            ))
+            await db.commit()
+        return code
+
+    async def verify_otp(self, user_id, entered_code):
+        """Check an OTP code and mark it used, returns True/False"""
+        # Same lockout as verify_otp_code: refuse without looking the code up
+        if not otp_guess_allowed(user_id):
+            return False
+
+        correct = await self._consume_otp(user_id, entered_code)
+        record_otp_result(user_id, correct)
+        return correct
+
+    async def _consume_otp(self, user_id, entered_code):
+        store = get_otp_store()
+        if not isinstance(store, SQLOTPStore):
+            return store.consume(None, user_id, entered_code)
+
+        async with self.Session() as db:
+            # Only an unused, unexpired matching code is updated - so it can't be used twice
+            result = await db.execute(
+                update(OTP)
+                .where(
+                    OTP.user_id == user_id,
+                    OTP.code == entered_code,
+                    OTP.is_used == False,
+                    OTP.expires_at >= datetime.now(),
+                )
+                .values(is_used=True)
+            )
+            await db.commit()
+            return result.rowcount > 0
+
+    async def login_history(self, user_id, limit=10, before=None, successful=None):
+        """Get one page of login attempts, newest first (pass page.next_cursor as before)"""
+        if before is None:
+            await asyncio.to_thread(flush_audit_log)
+
+        async with self.Session() as db:
+            result = await db.execute(history_query(user_id, before, successful, limit + 1))
+            return make_page(result.all(), limit)
+
+    async def delete_user(self, user_id):
+        """Delete the account together with its OTP codes and login attempts"""
+        # Save any queued login attempts first so none are left behind (waits off the event loop)
+        await asyncio.to_thread(flush_audit_log)
+
+        async with self.Session() as db:
+            await db.execute(delete(OTP).where(OTP.user_id == user_id))
+            await db.execute(delete(LoginAttempt).where(LoginAttempt.user_id == user_id))
+            result = await db.execute(delete(User).where(User.id == user_id))
+            await db.commit()
+
+        # Like the menus and batch mode: no cached copy, and no session token still working
+        _forget_cached_user(user_id)
+        get_session_tokens().revoke_user(user_id)
+        return result.rowcount > 0
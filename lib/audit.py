@@ -0,0 +1,142 @@
+# This file records login attempts (the login_attempts table)
+# When the audit writer is running, attempts are queued in memory and a background
+# thread saves them in bulk, so logging in never waits for the database to save them
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime
+from sqlalchemy import insert
+from lib.models import LoginAttempt
+
+# Put on the queue by flush() to tell the writer to save what it has right now
+_FLUSH_NOW = object()
+
+class AuditWriter:
+    """Saves queued login attempts in batches from a background thread"""
+
+    def __init__(self, session_factory, max_batch=500, flush_interval=1.0, max_queue=100000):
+        self.session_factory = session_factory  # Makes the sessions the writer saves with
+        self.bind = session_factory.kw.get("bind")  # The engine those sessions use
+        self.max_batch = max_batch              # Save as soon as this many attempts are waiting
+        self.flush_interval = flush_interval    # ...or after this many seconds, whichever comes first
+
+        # A full queue makes callers wait, so attempts are never dropped
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self.thread.start()
+
+    def record(self, user_id, successful, timestamp=None):
+        """Queue one login attempt to be saved"""
+        self.queue.put({
+            "user_id": user_id,
+            "successful": successful,
+            "timestamp": timestamp or datetime.now(),
+        })
+
+    def flush(self):
+        """Wait until everything queued so far has been saved"""
+        self.queue.put(_FLUSH_NOW)
+        self.queue.join()
+
+    def stop(self):
+        """Save anything still queued and stop the background thread"""
+        if not self.thread.is_alive():
+            return
+        self.stopping.set()
+        self.queue.put(_FLUSH_NOW)  # Wake the thread up instead of waiting out the interval
+        self.thread.join()
+
+    def _next_batch(self):
+        """Collect attempts until max_batch are waiting or flush_interval has passed"""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=max(remaining, 0))
+            except queue.Empty:
+                break
+
+            if item is _FLUSH_NOW:
+                # Someone is waiting in flush() - save what we have straight away
+                self.queue.task_done()
+                break
+            batch.append(item)
+
+        return batch
+
+    def _save(self, batch):
+        """Insert a batch of attempts with one statement and one commit"""
+        db = self.session_factory()
+        try:
+            db.execute(insert(LoginAttempt), batch)
+            db.commit()
+        finally:
+            db.close()
+            for _ in batch:
+                self.queue.task_done()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                try:
+                    self._save(batch)
+                except Exception as error:
+                    # Keep the thread alive so later attempts still get saved
+                    print(f" Could not save {len(batch)} login attempts: {error}")
+            elif self.stopping.is_set() and self.queue.empty():
+                break
+
+# The writer used by record_login_attempt (None means save straight away)
+_audit_writer = None
+
+def start_audit_writer(session_factory=None, **settings):
+    """Start saving login attempts in the background"""
+    global _audit_writer
+
+    if _audit_writer is not None:
+        return _audit_writer
+
+    if session_factory is None:
+        from lib.database import SessionLocal
+        session_factory = SessionLocal
+
+    _audit_writer = AuditWriter(session_factory, **settings)
+
+    # Make sure queued attempts are saved when the program exits
+    atexit.register(stop_audit_writer)
+    return _audit_writer
+
+def stop_audit_writer():
+    """Save everything still queued and go back to saving attempts straight away"""
+    global _audit_writer
+    if _audit_writer is not None:
+        _audit_writer.stop()
+        _audit_writer = None
+
+def flush_audit_log():
+    """Wait until every queued login attempt is in the database"""
+    if _audit_writer is not None:
+        _audit_writer.flush()
+
+def record_login_attempt(db, user_id, successful):
+    """Record a login attempt, queued if the audit writer is running"""
+    writer = _audit_writer
+
+    # Queue it, unless this session talks to a different database than the writer
+    if writer is not None and db.get_bind() is writer.bind:
+        writer.record(user_id, successful)
+        return
+
+    # No writer - save it right now like before
+    attempt = LoginAttempt(
+        user_id=user_id,
+        successful=successful,
+        timestamp=datetime.now()
+    )
+    db.add(attempt)
+    db.commit()
@@ -1,49 +1,100 @@
 # This file handles user authentication - registering, logging in, and managing profiles
-import bcrypt
 from datetime import datetime
-from lib.models import User, LoginAttempt
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
+from lib.models import User
+from lib.hashing import get_hashing_engine
+from lib.audit import record_login_attempt, flush_audit_log
+from lib.throttle import get_login_throttle, email_key, user_key
+from lib.bloom import get_user_filter
+from lib.user_cache import get_user_cache, user_from_snapshot, snapshot_of
+from lib.metrics import timed, always
 
+@timed("hash_password", succeeded=always)
 def hash_password(password):
     """Turn a plain text password into a secure encrypted version"""
-    # Convert password string to bytes (required for bcrypt)
-    password_bytes = password.encode('utf-8')
-    
-    # Generate a random salt (makes each hash unique)
-    salt = bcrypt.gensalt()
-    
-    # Create the hashed password using bcrypt
-    hashed = bcrypt.hashpw(password_bytes, salt)
-    
-    # Convert back to string and return
-    return hashed.decode('utf-8')
+    # bcrypt runs in the hashing engine's worker pool (see lib/hashing.py)
+    return get_hashing_engine().hash(password)
 
+@timed("check_password")
 def check_password(password, hashed_password):
     """Check if a plain password matches the hashed version"""
-    # Convert both passwords to bytes
-    password_bytes = password.encode('utf-8')
-    hashed_bytes = hashed_password.encode('utf-8')
-    
-    # Use bcrypt to compare them securely
-    return bcrypt.checkpw(password_bytes, hashed_bytes)
+    # bcrypt compares them securely inside a worker
+    return get_hashing_engine().check(password, hashed_password)
 
-def register_new_user(db, username, email, password):
-    """Create a new user account in the database"""
-    
-    # Step 1: Check if someone already has this username
-    existing_user = db.query(User).filter(User.username == username).first()
-    if existing_user:
-        return None  # Username is taken
-    
-    # Step 2: Check if someone already has this email
-    existing_email = db.query(User).filter(User.email == email).first()
-    if existing_email:
-        return None  # Email is taken
+def submit_hash_password(password):
+    """Start hashing a password in the background and return a Future"""
+    return get_hashing_engine().submit_hash(password)
+
+def submit_check_password(password, hashed_password):
+    """Start checking a password in the background and return a Future"""
+    return get_hashing_engine().submit_check(password, hashed_password)
+
+async def hash_password_async(password):
+    """Hash a password without blocking the asyncio event loop"""
+    return await get_hashing_engine().hash_async(password)
+
+async def check_password_async(password, hashed_password):
+    """Check a password without blocking the asyncio event loop"""
+    return await get_hashing_engine().check_async(password, hashed_password)
+
+def check_passwords_batch(pairs):
+    """Check many (password, hashed_password) pairs in parallel, returns a list of True/False"""
+    return get_hashing_engine().check_batch(pairs)
+
+def _user_filter_for(db):
+    """The username/email Bloom filter, if one is running for this session's database"""
+    user_filter = get_user_filter()
+    if user_filter is not None and user_filter.covers(db):
+        return user_filter
+    return None
+
+def _user_cache_for(db):
+    """The user cache, if one is running for this session's database"""
+    user_cache = get_user_cache()
+    if user_cache is not None and user_cache.covers(db):
+        return user_cache
+    return None
+
+# The unique columns a taken name can clash on, as SQLite names them (user_directory is the
+# shard directory in lib/sharding.py)
+_NAME_COLUMNS = {
+    "users.username": "username",
+    "users.email": "email",
+    "user_directory.username": "username",
+    "user_directory.email": "email",
+}
+
+def _conflicting_field(error):
+    """Which unique column an IntegrityError about users is about ("username" or "email")
+
+    Any other failure (NOT NULL, a clashing id, a foreign key, ...) isn't about a taken
+    name, so the error is raised again.
+    """
+    # SQLite says e.g. "UNIQUE constraint failed: users.email"
+    prefix = "UNIQUE constraint failed: "
+    message = str(error.orig)
+    if message.startswith(prefix) and message[len(prefix):] in _NAME_COLUMNS:
+        return _NAME_COLUMNS[message[len(prefix):]]
+    raise error
+
+def _registered(result):
+    """A registration succeeded when it returned a user"""
+    return result[0] is not None
+
+@timed("register_user", succeeded=_registered)
+def try_register_user(db, username, email, password, user_id=None):
+    """Create a new user account, returns (user, None) or (None, "username"/"email") if taken"""
+    # user_id is normally left for the database to pick; the sharded store passes the id
+    # its directory handed out
     
-    # Step 3: Create the password hash (never store plain passwords!)
+    # Step 1: Create the password hash (never store plain passwords!)
     hashed_password = hash_password(password)
     
-    # Step 4: Create a new user object
+    # Step 2: Create a new user object
     new_user = User(
+        id=user_id,
         username=username,
         email=email,
         password=hashed_password,  
@@ -52,103 +103,189 @@ def register_new_user(db, username, email, password):
         # Record when account was created
     )
     
-    # Step 5: Save the new user to the database
-    db.add(new_user)        # Add to database session
-    db.commit()             # Save changes permanently
-    db.refresh(new_user)    # Get the updated user with ID
+    # Step 3: Save it with a single INSERT - the unique constraints on username and email
+    # tell us if either is taken, so there's no need to look them up first
+    db.add(new_user)
+    try:
+        db.commit()
+    except IntegrityError as error:
+        db.rollback()
+        return None, _conflicting_field(error)
+    
+    # Let the Bloom filter know these names exist now
+    user_filter = _user_filter_for(db)
+    if user_filter is not None:
+        user_filter.add_user(username, email)
     
-    return new_user  # Return the new user object
+    return new_user, None
+
+def register_new_user(db, username, email, password):
+    """Create a new user account in the database"""
+    # Returns the new user, or None if the username or email is taken
+    new_user, _ = try_register_user(db, username, email, password)
+    return new_user
 
+@timed("login_user")
 def login_user(db, email, password):
     """Check if user's email and password are correct"""
     
-    # Step 1: Find the user by their email address
+    # Step 1: Refuse straight away if this email has too many recent failures
+    throttle = get_login_throttle()
+    if throttle and throttle.retry_after(email_key(email)):
+        return None
+    
+    # Step 2: If the Bloom filter has never seen this email, no account can have it
+    # Another program may have registered it a moment ago, so a "no" only counts once the
+    # filter has caught up with user_name_log. It isn't a failed guess at a password, so
+    # the throttle isn't charged for it.
+    user_filter = _user_filter_for(db)
+    if user_filter is not None and not user_filter.might_have_email(email):
+        user_filter.catch_up(db)
+        if not user_filter.might_have_email(email):
+            return None
+    
+    # Step 3: Find the user by their email address
+    # Always from the database, never the cache: a password changed or an account deleted
+    # by another program must stop working straight away, not when the cached copy expires.
+    # The fresh row still goes into the cache for the dashboard's lookups.
+    user_cache = _user_cache_for(db)
     user = db.query(User).filter(User.email == email).first()
+    if user and user_cache:
+        user_cache.put(user)
     
-    # Step 2: If no user found with this email, login fails
+    # Step 4: If no user found with this email, login fails
     if not user:
+        if throttle:
+            throttle.record_failure(email_key(email))
         return None
     
-    # Step 3: Check if the password is correct
+    # Step 5: Refuse if the account itself is locked (guesses can come in via other emails later)
+    if throttle and throttle.retry_after(user_key(user.id)):
+        return None
+    
+    # Step 6: Check if the password is correct
     password_is_correct = check_password(password, user.password)
     
     if not password_is_correct:
         # Password is wrong - record this failed attempt
-        failed_attempt = LoginAttempt(
-            user_id=user.id,
-            successful=False,  # This login failed
-            timestamp=datetime.now()
-        )
-        db.add(failed_attempt)
-        db.commit()
+        if throttle:
+            throttle.record_failure(email_key(email))
+            throttle.record_failure(user_key(user.id))
+        record_login_attempt(db, user.id, successful=False)
         return None  # Login failed
     
-    # Step 4: Password is correct - return the user
+    # Step 7: Password is correct - clear the failure counts
+    if throttle:
+        throttle.reset(email_key(email))
+        throttle.reset(user_key(user.id))
+    
+    # Step 8: If the hash was made with an older bcrypt cost, upgrade it now that we
+    # know the password (this is how a new cost rolls out without a migration)
+    if get_hashing_engine().needs_rehash(user.password):
+        user.password = hash_password(password)
+        db.commit()
+        if user_cache:
+            user_cache.invalidate(user.id)
+    
     return user
 
+def get_lockout_seconds(email, user_id=None):
+    """How many seconds until this email (or account) may try to log in again, 0 if not locked"""
+    throttle = get_login_throttle()
+    if not throttle:
+        return 0
+    
+    seconds = throttle.retry_after(email_key(email))
+    if user_id is not None:
+        seconds = max(seconds, throttle.retry_after(user_key(user_id)))
+    return seconds
+
 def log_successful_login(db, user_id):
     """Record a successful login in the database"""
     
-    # Create a record of this successful login
-    success_attempt = LoginAttempt(
-        user_id=user_id,
-        successful=True,  # This login succeeded
-        timestamp=datetime.now()
-    )
-    
-    # Save it to the database
-    db.add(success_attempt)
-    db.commit()
+    # Record this successful login (queued if the audit writer is running)
+    record_login_attempt(db, user_id, successful=True)
 
 def update_user_info(db, user, new_username=None, new_email=None, new_password=None):
-    """Update user's profile information"""
+    """Update user's profile information, returns the fields that were already taken"""
     
-    # Update username if user provided a new one
+    # Step 1: Collect the changes (hash the new password before storing)
+    changes = {}
     if new_username:
-        # Check if another user already has this username
-        username_taken = db.query(User).filter(
-            User.username == new_username, 
-            User.id != user.id  # Don't check against current user
-        ).first()
-        
-        # Only update if username is available
-        if not username_taken:
-            user.username = new_username
-    
-    # Update email if user provided a new one
+        changes["username"] = new_username
     if new_email:
-        # Check if another user already has this email
-        email_taken = db.query(User).filter(
-            User.email == new_email, 
-            User.id != user.id  # Don't check against current user
-        ).first()
-        
-        # Only update if email is available
-        if not email_taken:
-            user.email = new_email
-    
-    # Update password if user provided a new one
+        changes["email"] = new_email
     if new_password:
-        # Hash the new password before storing
-        user.password = hash_password(new_password)
+        changes["password"] = hash_password(new_password)
     
-    # Save all changes to the database
-    db.commit()
-    db.refresh(user)  # Get updated user data
+    # Step 2: Save them with one UPDATE. If another user already has the new username or
+    # email, the unique constraint rejects it - drop that field and try again with the rest.
+    # The UPDATE is keyed on a copy of the row, because a rollback expires the user object
+    # and touching it afterwards would read the whole row back first.
+    current = snapshot_of(user)._asdict()
+    taken = []
+    while changes:
+        try:
+            db.execute(update(User).where(User.id == current["id"]).values(**changes))
+            db.commit()
+            break
+        except IntegrityError as error:
+            db.rollback()
+            field = _conflicting_field(error)
+            if field not in changes:
+                raise
+            taken.append(field)
+            del changes[field]
+    
+    # Step 3: Bring the user object up to date without another query
+    current.update(changes)
+    for field, value in current.items():
+        set_committed_value(user, field, value)
+    
+    # Let the Bloom filter know about any new username or email
+    user_filter = _user_filter_for(db)
+    if user_filter is not None:
+        user_filter.add_user(user.username, user.email)
+    
+    # The cached copy of this user is out of date now
+    user_cache = _user_cache_for(db)
+    if user_cache:
+        user_cache.invalidate(user.id)
+    
+    return taken
 
 def delete_user_account(db, user):
     """Completely remove a user account from the database"""
     
+    # Save any queued login attempts first so none are left behind for a deleted user
+    flush_audit_log()
+    
     # Delete the user (this also deletes related OTP codes and login attempts)
+    user_id = user.id
     db.delete(user)
     
     # Save the changes permanently
     db.commit()
+    
+    # Make sure the cache can't hand the deleted account out again
+    user_cache = _user_cache_for(db)
+    if user_cache:
+        user_cache.invalidate(user_id)
 
 def get_user_by_id(db, user_id):
     """Find a user by their ID number"""
     
+    # Use the cached copy if we have a fresh one
+    user_cache = _user_cache_for(db)
+    cached = user_cache.get_by_id(user_id) if user_cache else None
+    if cached is not None:
+        return user_from_snapshot(db, cached)
+    
     # Search for user with matching ID
     user = db.query(User).filter(User.id == user_id).first()
     
+    # Remember it for next time
+    if user and user_cache:
+        user_cache.put(user)
+    
     return user  # Returns user object or None if not found
\ No newline at end of file
@@ -0,0 +1,253 @@
+# This file runs auth commands from JSON lines instead of the menus, for scripts and replays
+# Each input line is one command, for example:
+#   {"command": "register", "username": "ann", "email": "ann@example.com", "password": "secret1"}
+#   {"command": "login", "email": "ann@example.com", "password": "secret1"}
+#   {"command": "verify-otp", "email": "ann@example.com", "code": "123456"}
+#   {"command": "history", "email": "ann@example.com", "limit": 10}
+#   {"command": "delete", "email": "ann@example.com"}
+# Accounts can also be named by "user_id" instead of "email" (one or the other, never both).
+# Each command gets one result line with "ok", its answer (or "error") and "ms", how long
+# it took. An "id" on the command is copied to its result so a caller can match them up.
+#
+# Commands run on a pool of worker threads. Every command for one account goes to the same
+# worker, so register -> login -> verify-otp for one person still happens in that order
+# while different people's commands run side by side. That only works if the account is
+# always named the same way, so the first command that names an account decides it for
+# the whole batch: after that, commands naming accounts the other way are refused.
+import sys
+import json
+import time
+import queue
+import threading
+from datetime import datetime
+from sqlalchemy import select
+from lib.database import session_scope
+from lib.models import User
+from lib.auth import try_register_user, login_user, log_successful_login, delete_user_account, get_user_by_id, get_lockout_seconds
+from lib.otp_service import create_new_otp, verify_otp_code, send_otp_email, get_otp_lockout_seconds
+from lib.history import get_login_history
+from lib.session_tokens import get_session_tokens
+from lib.validation import problem_with_new_user
+from lib.metrics import MetricsRegistry
+
+class CommandError(Exception):
+    """A command that can't be done (wrong password, unknown account, ...)"""
+
+def _user_id_for(db, command):
+    """The account a command is about, from its user_id or email"""
+    if command.get("user_id") is not None:
+        return int(command["user_id"])
+
+    email = command.get("email")
+    user_id = db.execute(select(User.id).where(User.email == email)).scalar() if email else None
+    if user_id is None:
+        raise CommandError("no such account")
+    return user_id
+
+def run_register(db, command, settings):
+    problem = problem_with_new_user(command)
+    if problem:
+        raise CommandError(problem)
+
+    user, taken = try_register_user(db, command["username"].strip(), command["email"].strip(), command["password"])
+    if user is None:
+        raise CommandError(f"{taken} already taken")
+    return {"user_id": user.id}
+
+def run_login(db, command, settings):
+    """Check the password and send an OTP code, like the first half of the menu login"""
+    email = command.get("email") or ""
+    user = login_user(db, email, command.get("password") or "")
+    if not user:
+        wait_seconds = get_lockout_seconds(email)
+        if wait_seconds:
+            raise CommandError(f"too many failed attempts, try again in {int(wait_seconds) + 1} seconds")
+        raise CommandError("wrong email or password")
+
+    code = create_new_otp(db, user.id)
+    if not send_otp_email(user.email, code):
+        raise CommandError("could not send the OTP email")
+
+    result = {"user_id": user.id}
+    if settings.get("show_otp"):
+        # Only for replays and load tests, where nobody reads the emails
+        result["otp_code"] = code
+    return result
+
+def run_verify_otp(db, command, settings):
+    """Check an OTP code and hand out a session token, like the second half of the menu login"""
+    user_id = _user_id_for(db, command)
+    if not verify_otp_code(db, user_id, str(command.get("code") or "")):
+        if get_otp_lockout_seconds(user_id):
+            raise CommandError("too many wrong codes")
+        raise CommandError("wrong or expired code")
+
+    log_successful_login(db, user_id)
+    return {"user_id": user_id, "token": get_session_tokens().issue(user_id)}
+
+def run_history(db, command, settings):
+    """One page of login history; pass the result's "next" back as "before" for the next page"""
+    user_id = _user_id_for(db, command)
+    before = command.get("before")
+    if before is not None:
+        before = (datetime.fromisoformat(before[0]), int(before[1]))
+
+    page = get_login_history(db, user_id, int(command.get("limit", 10)), before, command.get("successful"))
+    next_cursor = page.next_cursor and [page.next_cursor[0].isoformat(), page.next_cursor[1]]
+    return {
+        "user_id": user_id,
+        "attempts": [
+            {"id": row.id, "timestamp": row.timestamp.isoformat(), "successful": row.successful}
+            for row in page.attempts
+        ],
+        "next": next_cursor,
+    }
+
+def run_delete(db, command, settings):
+    user = get_user_by_id(db, _user_id_for(db, command))
+    if user is None:
+        raise CommandError("no such account")
+
+    delete_user_account(db, user)
+    get_session_tokens().revoke_user(user.id)
+    return {"user_id": user.id}
+
+# command name -> (function, whether it only reads)
+COMMANDS = {
+    "register": (run_register, False),
+    "login": (run_login, False),
+    "verify-otp": (run_verify_otp, False),
+    "history": (run_history, True),
+    "delete": (run_delete, False),
+}
+
+def run_command(command, settings=None):
+    """Run one command in its own database session, returns (result dictionary, outcome)"""
+    name = command.get("command")
+    if name not in COMMANDS:
+        return {"ok": False, "error": f"unknown command: {name}"}, "failure"
+    function, read_only = COMMANDS[name]
+
+    try:
+        with session_scope(read_only=read_only) as db:
+            answer = function(db, command, settings or {})
+        return dict(ok=True, **answer), "success"
+    except CommandError as error:
+        return {"ok": False, "error": str(error)}, "failure"
+    except (KeyError, TypeError, ValueError) as error:
+        return {"ok": False, "error": f"bad command: {error!r}"}, "failure"
+    except Exception as error:
+        return {"ok": False, "error": f"{type(error).__name__}: {error}"}, "error"
+
+class BatchRunner:
+    """Runs commands on worker threads and writes one JSON result line per command"""
+
+    def __init__(self, output, workers=4, show_otp=False, max_waiting=1000):
+        self.output = output
+        self.settings = {"show_otp": show_otp}
+        self.metrics = MetricsRegistry()    # Timing per command, for the summary at the end
+        self.write_lock = threading.Lock()
+        self.addressing = None              # "email" or "user_id", set by the first command naming an account
+
+        # One queue per worker; a full queue makes the reader wait instead of using up memory
+        self.queues = [queue.Queue(maxsize=max_waiting) for _ in range(workers)]
+        self.threads = [
+            threading.Thread(target=self._work, args=(work_queue,), name=f"batch-{number}", daemon=True)
+            for number, work_queue in enumerate(self.queues)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _account_key(self, command):
+        """The key that picks a command's worker, e.g. "email:ann@example.com" (CommandError if unusable)"""
+        has_email = command.get("email") is not None
+        has_user_id = command.get("user_id") is not None
+        if has_email and has_user_id:
+            raise CommandError("name the account by email or by user_id, not both")
+        if not (has_email or has_user_id):
+            return None
+
+        addressing = "email" if has_email else "user_id"
+        if self.addressing is None:
+            self.addressing = addressing
+        elif addressing != self.addressing:
+            # Different names for one account could land on different workers and run out of order
+            raise CommandError(f"this batch names accounts by {self.addressing}, not {addressing}")
+
+        return f"{addressing}:{command[addressing]}"
+
+    def submit(self, line_number, command):
+        """Hand a command to the worker that owns its account"""
+        account = self._account_key(command)
+        self.queues[hash(str(account)) % len(self.queues)].put((line_number, command))
+
+    def _work(self, work_queue):
+        while True:
+            item = work_queue.get()
+            if item is None:
+                return
+            line_number, command = item
+
+            started = time.perf_counter()
+            result, outcome = run_command(command, self.settings)
+            elapsed = time.perf_counter() - started
+
+            self.metrics.observe(str(command.get("command")), elapsed, outcome)
+            self._write(line_number, command, result, elapsed)
+
+    def _write(self, line_number, command, result, elapsed):
+        result = dict(line=line_number, id=command.get("id"), command=command.get("command"),
+                      ms=round(1000.0 * elapsed, 3), **result)
+        with self.write_lock:
+            self.output.write(json.dumps(result) + "\n")
+
+    def run(self, lines):
+        """Run every command in the lines (JSON text), returns a summary dictionary"""
+        started = time.perf_counter()
+        count = 0
+
+        for line_number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            count += 1
+            try:
+                command = json.loads(line)
+                if not isinstance(command, dict):
+                    raise ValueError("a command must be a JSON object")
+            except ValueError as error:
+                self.metrics.observe("invalid", 0.0, "failure")
+                self._write(line_number, {}, {"ok": False, "error": f"bad JSON: {error}"}, 0.0)
+                continue
+
+            try:
+                self.submit(line_number, command)
+            except CommandError as error:
+                self.metrics.observe(str(command.get("command")), 0.0, "failure")
+                self._write(line_number, command, {"ok": False, "error": str(error)}, 0.0)
+
+        # Tell every worker to finish its queue and stop
+        for work_queue in self.queues:
+            work_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.output.flush()
+
+        seconds = time.perf_counter() - started
+        return {
+            "commands": count,
+            "seconds": round(seconds, 3),
+            "per_second": round(count / seconds, 1) if seconds else None,
+            "by_command": {
+                row["operation"]: {
+                    "count": row["count"], "ok": row["success"], "failed": row["failure"],
+                    "errors": row["error"], "mean_ms": round(row["mean_ms"], 3),
+                    "p95_ms": None if row["p95_ms"] == float("inf") else row["p95_ms"],
+                }
+                for row in self.metrics.summary()
+            },
+        }
+
+def run_batch(lines, output=None, workers=4, show_otp=False):
+    """Run JSON line commands and write the results to output (stdout by default)"""
+    runner = BatchRunner(output or sys.stdout, workers, show_otp)
+    return runner.run(lines)
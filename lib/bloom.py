@@ -0,0 +1,210 @@
+# This file keeps a Bloom filter of every username and email in the users table
+# A Bloom filter answers "is this value in the set?" with either "definitely not" or
+# "maybe". Most stuffing and enumeration traffic uses emails we've never seen, and for
+# those a "definitely not" lets login_user skip the database.
+#
+# Usernames and emails added by any program (even another process) are also written to
+# the user_name_log table by database triggers, so a saved or running filter can catch up.
+# Saving the filter deletes the log entries it already holds (they'd otherwise keep the
+# names of deleted accounts forever); a running filter that finds its place in the log
+# gone reads the users table again instead.
+import os
+import math
+import struct
+import hashlib
+import threading
+from sqlalchemy import select, text
+from lib.models import User
+
+# Where the filter is saved between runs
+FILTER_PATH = "user_filter.bin"
+
+# File header: magic, bit count, hash count, item count, capacity, last user_name_log seq,
+# and a fingerprint of that log entry (tells us the file belongs to this database)
+_HEADER = struct.Struct("<4sQIQQQ16s")
+_MAGIC = b"UBF2"
+
+class BloomFilter:
+    """A fixed-size Bloom filter over strings"""
+
+    def __init__(self, capacity=10000, error_rate=0.001):
+        # Standard sizing: m bits and k hash functions for the wanted false-positive rate
+        self.capacity = capacity
+        self.bit_count = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.bit_count / capacity * math.log(2)))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def _positions(self, value):
+        """The k bit positions for a value (double hashing from one blake2b digest)"""
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        first, second = struct.unpack("<QQ", digest)
+        return [(first + i * second) % self.bit_count for i in range(self.hash_count)]
+
+    def add(self, value):
+        """Put a value in the filter"""
+        positions = self._positions(value)
+        # Setting a bit is read-modify-write, so two threads adding at once must not overlap
+        with self.lock:
+            for position in positions:
+                self.bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, value):
+        """False means definitely not added, True means maybe"""
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(value))
+
+    def is_overfull(self):
+        """True once more items were added than it was sized for (false positives go up)"""
+        return self.count > self.capacity
+
+def _latest_log_seq(db):
+    """Newest entry in user_name_log (0 if it's empty)"""
+    return db.execute(text("SELECT COALESCE(MAX(seq), 0) FROM user_name_log")).scalar()
+
+def _log_fingerprint(db, seq):
+    """Hash of one user_name_log entry (None if there's no such entry)"""
+    if seq == 0:
+        return bytes(16)
+    row = db.execute(text("SELECT username, email FROM user_name_log WHERE seq = :seq"), {"seq": seq}).first()
+    if row is None:
+        return None
+    return hashlib.blake2b(f"{row[0]}\n{row[1]}".encode("utf-8"), digest_size=16).digest()
+
+class UserFilter:
+    """Bloom filter of usernames and emails for one database"""
+
+    def __init__(self, bind, capacity):
+        self.bind = bind                  # The engine whose users table this filter describes
+        self.bloom = BloomFilter(capacity)
+        self.synced_seq = 0               # Last user_name_log entry already in the filter
+
+    def add_user(self, username, email):
+        self.bloom.add("username:" + username)
+        self.bloom.add("email:" + email)
+
+    def might_have_username(self, username):
+        return ("username:" + username) in self.bloom
+
+    def might_have_email(self, email):
+        return ("email:" + email) in self.bloom
+
+    def covers(self, db):
+        """True if this filter describes the database the session talks to"""
+        return db.get_bind() is self.bind
+
+    def catch_up(self, db):
+        """Add names other programs put in the users table since we last looked (one indexed query)"""
+        rows = db.execute(
+            text("SELECT seq, username, email FROM user_name_log WHERE seq > :seq ORDER BY seq"),
+            {"seq": self.synced_seq}
+        ).all()
+
+        # A gap before the first new entry means another process saved its filter and
+        # pruned entries we hadn't read yet, so read the users table again instead
+        if rows and rows[0][0] > self.synced_seq + 1:
+            self.read_users(db)
+            return
+
+        for seq, username, email in rows:
+            self.add_user(username, email)
+            self.synced_seq = seq
+
+    def read_users(self, db):
+        """Add every username and email in the users table"""
+        # Note the log position first, so names added while we read are caught up later
+        self.synced_seq = _latest_log_seq(db)
+
+        # Stream the rows instead of loading the whole table
+        rows = db.execute(select(User.username, User.email).execution_options(yield_per=5000))
+        for username, email in rows:
+            self.add_user(username, email)
+
+    @classmethod
+    def build(cls, db):
+        """Read every username and email from the users table into a new filter"""
+        user_total = db.query(User).count()
+
+        # Room for twice today's users so registrations don't fill it quickly
+        user_filter = cls(db.get_bind(), capacity=max(10000, user_total * 2 * 2))
+        user_filter.read_users(db)
+        return user_filter
+
+    def save(self, db, path=FILTER_PATH):
+        """Write the filter to a file, together with how far through user_name_log it is"""
+        self.catch_up(db)
+        header = _HEADER.pack(_MAGIC, self.bloom.bit_count, self.bloom.hash_count,
+                              self.bloom.count, self.bloom.capacity, self.synced_seq,
+                              _log_fingerprint(db, self.synced_seq))
+
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(header)
+            f.write(self.bloom.bits)
+        os.replace(temp_path, path)
+
+        # The file holds every name up to synced_seq, so the log only needs that last entry
+        # (load() checks its fingerprint)
+        db.execute(text("DELETE FROM user_name_log WHERE seq < :seq"), {"seq": self.synced_seq})
+        db.commit()
+
+    @classmethod
+    def load(cls, db, path=FILTER_PATH):
+        """Read a saved filter and catch it up, or None if there isn't a usable one"""
+        if not os.path.exists(path):
+            return None
+
+        with open(path, "rb") as f:
+            header = f.read(_HEADER.size)
+            bits = f.read()
+
+        if len(header) != _HEADER.size:
+            return None
+        magic, bit_count, hash_count, count, capacity, synced_seq, fingerprint = _HEADER.unpack(header)
+        if magic != _MAGIC or len(bits) != (bit_count + 7) // 8:
+            return None
+
+        # The log entry we stopped at must still be there and match, otherwise this file
+        # was saved for another database
+        if _log_fingerprint(db, synced_seq) != fingerprint:
+            return None
+
+        user_filter = cls(db.get_bind(), capacity)
+        user_filter.bloom.bit_count = bit_count
+        user_filter.bloom.hash_count = hash_count
+        user_filter.bloom.bits = bytearray(bits)
+        user_filter.bloom.count = count
+        user_filter.synced_seq = synced_seq
+
+        # Add everything registered or renamed since the file was saved
+        user_filter.catch_up(db)
+        return user_filter
+
+# The filter login and registration use (None means always ask the database)
+_user_filter = None
+
+def get_user_filter():
+    """Get the filter currently in use (or None)"""
+    return _user_filter
+
+def enable_user_filter(db, path=FILTER_PATH):
+    """Load the saved filter if it's still current, otherwise build a new one"""
+    global _user_filter
+
+    user_filter = UserFilter.load(db, path) if path else None
+    if user_filter is None or user_filter.bloom.is_overfull():
+        user_filter = UserFilter.build(db)
+
+    _user_filter = user_filter
+    return _user_filter
+
+def disable_user_filter():
+    """Stop using the filter"""
+    global _user_filter
+    _user_filter = None
+
+def save_user_filter(db, path=FILTER_PATH):
+    """Save the filter in use so the next start doesn't have to rebuild it"""
+    if _user_filter is not None and _user_filter.covers(db):
+        _user_filter.save(db, path)
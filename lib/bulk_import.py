@@ -0,0 +1,169 @@
+# This file imports lots of users at once from a CSV or JSONL file
+# Rows are read one chunk at a time, so memory stays flat no matter how big the file is
+import csv
+import json
+from itertools import islice
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from lib.models import User
+from lib.hashing import get_hashing_engine
+from lib.validation import problem_with_new_user
+
+# How many rows go into one transaction
+DEFAULT_CHUNK_SIZE = 1000
+
+class ImportReport:
+    """Counts of what happened during an import"""
+
+    def __init__(self):
+        self.imported = 0    # Users added to the database
+        self.conflicts = 0   # Rows skipped because the username or email already exists
+        self.invalid = 0     # Rows skipped because a field is missing, too short or not text (or the line is unreadable)
+
+    def as_dict(self):
+        return {"imported": self.imported, "conflicts": self.conflicts, "invalid": self.invalid}
+
+class UnreadableRow(dict):
+    """An empty row standing in for a JSONL line that isn't a JSON object"""
+
+    def __init__(self, problem):
+        super().__init__()
+        self.problem = problem   # Why the line couldn't be read
+
+def read_user_rows(path, file_format=None):
+    """Yield (line number, row dictionary) for every user in a CSV or JSONL file
+
+    A JSONL line that can't be read gives an UnreadableRow, so the import reports it as
+    invalid and carries on with the next line.
+    """
+    # Work out the format from the file name if we weren't told
+    if file_format is None:
+        file_format = "jsonl" if path.endswith((".jsonl", ".json")) else "csv"
+
+    with open(path, newline="") as f:
+        if file_format == "csv":
+            # Line 1 is the header (username,email,password)
+            for line_number, row in enumerate(csv.DictReader(f), start=2):
+                yield line_number, row
+        else:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as error:
+                    yield line_number, UnreadableRow(f"bad JSON: {error}")
+                    continue
+                if not isinstance(row, dict):
+                    yield line_number, UnreadableRow("not a JSON object")
+                    continue
+                yield line_number, row
+
+def _problem_with_row(row):
+    """Return why a row can't be imported, or None if it looks fine"""
+    if isinstance(row, UnreadableRow):
+        return row.problem
+    # Same rules the CLI uses when someone registers by hand
+    return problem_with_new_user(row)
+
+# Most values in one IN (...) list - older SQLite builds allow only 999 parameters per statement
+MAX_IN_VALUES = 900
+
+def _existing_values(db, column, values):
+    """Find which of the given values are already in the users table (one query per 900 values)"""
+    existing = set()
+    for start in range(0, len(values), MAX_IN_VALUES):
+        batch = values[start:start + MAX_IN_VALUES]
+        existing.update(db.execute(select(column).where(column.in_(batch))).scalars())
+    return existing
+
+def _import_chunk(db, chunk, report, on_problem):
+    """Check, hash and insert one chunk of rows"""
+    # Step 1: Drop rows that are invalid or repeat a username/email earlier in this chunk
+    candidates = []
+    seen_usernames = set()
+    seen_emails = set()
+    for line_number, row in chunk:
+        problem = _problem_with_row(row)
+        if problem:
+            report.invalid += 1
+            on_problem(line_number, row, problem)
+            continue
+
+        username = row["username"].strip()
+        email = row["email"].strip()
+        if username in seen_usernames or email in seen_emails:
+            report.conflicts += 1
+            on_problem(line_number, row, "duplicate in file")
+            continue
+
+        seen_usernames.add(username)
+        seen_emails.add(email)
+        candidates.append((line_number, row, username, email))
+
+    # Step 2: Check the whole chunk against the users table with one query per column
+    taken_usernames = _existing_values(db, User.username, list(seen_usernames))
+    taken_emails = _existing_values(db, User.email, list(seen_emails))
+
+    new_rows = []
+    for line_number, row, username, email in candidates:
+        if username in taken_usernames:
+            report.conflicts += 1
+            on_problem(line_number, row, "username already exists")
+        elif email in taken_emails:
+            report.conflicts += 1
+            on_problem(line_number, row, "email already exists")
+        else:
+            new_rows.append((line_number, row, username, email))
+
+    # Step 3: Hash every password in parallel on the hashing engine
+    engine = get_hashing_engine()
+    # Passwords are stripped like the menus do, so a trailing space or "\r" in the file
+    # doesn't end up in a password nobody can type
+    futures = [engine.submit_hash(row["password"].strip()) for _, row, _, _ in new_rows]
+    values = [
+        {"username": username, "email": email, "password": future.result()}
+        for (_, _, username, email), future in zip(new_rows, futures)
+    ]
+
+    if not values:
+        return
+
+    # Step 4: Insert the chunk with one multi-row statement in one transaction
+    try:
+        db.execute(insert(User), values)
+        db.commit()
+        report.imported += len(values)
+        return
+    except IntegrityError:
+        # Someone registered one of these names since step 2 - retry row by row
+        db.rollback()
+
+    for (line_number, row, _, _), value in zip(new_rows, values):
+        try:
+            db.execute(insert(User), [value])
+            db.commit()
+            report.imported += 1
+        except IntegrityError:
+            db.rollback()
+            report.conflicts += 1
+            on_problem(line_number, row, "username or email already exists")
+
+def import_users(db, rows, chunk_size=DEFAULT_CHUNK_SIZE, on_problem=None):
+    """Import users from an iterator of (line number, row) pairs, returns an ImportReport"""
+    report = ImportReport()
+    on_problem = on_problem or (lambda line_number, row, reason: None)
+    rows = iter(rows)
+
+    while True:
+        # Only one chunk of rows is held in memory at a time
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        _import_chunk(db, chunk, report, on_problem)
+
+    return report
+
+def import_users_from_file(db, path, file_format=None, chunk_size=DEFAULT_CHUNK_SIZE, on_problem=None):
+    """Import users from a CSV or JSONL file, returns an ImportReport"""
+    return import_users(db, read_user_rows(path, file_format), chunk_size, on_problem)
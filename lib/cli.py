@@ -1,27 +1,16 @@
 # This file handles all the menus and user interactions
-from lib.database import get_database
-from lib.auth import register_new_user, login_user, log_successful_login, update_user_info, delete_user_account, get_user_by_id
-from lib.otp_service import create_new_otp, verify_otp_code, send_otp_email
+from lib.database import session_scope
+from lib.auth import try_register_user, login_user, log_successful_login, update_user_info, delete_user_account, get_user_by_id, get_lockout_seconds
+from lib.otp_service import create_new_otp, verify_otp_code, send_otp_email, get_otp_lockout_seconds
 from lib.models import LoginAttempt
-
-def is_valid_email(email):
-    """Check if email has correct format"""
-    # Email must have @ symbol
-    if "@" not in email:
-        return False
-
-    # Split email into name and domain parts
-    name, _, domain = email.partition("@")
-
-    # Domain must have a dot (like .com, .org)
-    if "." not in domain:
-        return False
-
-    # Both name and domain must exist
-    if not name or not domain:
-        return False
-
-    return True
+from lib.audit import flush_audit_log
+from lib.metrics import registry as metrics_registry, write_prometheus_file
+from lib.user_cache import get_user_cache
+from lib.query_log import get_query_log
+from lib.history import get_login_history, export_login_history
+from lib.session_tokens import get_session_tokens
+from lib.login_stats import get_login_summary
+from lib.validation import is_valid_email, MIN_USERNAME_LENGTH, MIN_PASSWORD_LENGTH
 
 def show_main_menu():
     """Show the main menu options"""
@@ -30,7 +19,8 @@ def show_main_menu():
     print("="*40)
     print("1. Register (Create new account)")
     print("2. Login (Sign into account)")
-    print("3. Exit (Close program)")
+    print("3. Stats (Timing and counts for this session)")
+    print("4. Exit (Close program)")
     print("-"*40)
 
 def show_user_dashboard(username):
@@ -57,8 +47,8 @@ def register_user():
     password = input("Enter password: ").strip()
     
     # Check if username is long enough
-    if len(username) < 3:
-        print(" Username too short (need at least 3 characters)")
+    if len(username) < MIN_USERNAME_LENGTH:
+        print(f" Username too short (need at least {MIN_USERNAME_LENGTH} characters)")
         return
     
     # Check if email format is correct
@@ -67,27 +57,24 @@ def register_user():
         return
     
     # Check if password is long enough
-    if len(password) < 6:
-        print(" Password too short (need at least 6 characters)")
+    if len(password) < MIN_PASSWORD_LENGTH:
+        print(f" Password too short (need at least {MIN_PASSWORD_LENGTH} characters)")
         return
     
-    # Connect to database
-    db = get_database()
-    
-    # Try to create new user
-    user = register_new_user(db, username, email, password)
-    
-    # Close database connection
-    db.close()
+    # Try to create new user (the database session is closed again straight after)
+    with session_scope() as db:
+        user, taken_field = try_register_user(db, username, email, password)
     
     # Check if user was created successfully
     if user:
         print(f" Account created! Welcome {user.username}!")
+    elif taken_field == "email":
+        print(" Email already exists")
     else:
-        print(" Username or email already exists")
+        print(" Username already exists")
 
 def login_user_with_otp():
-    """Handle user login with OTP code verification"""
+    """Handle user login with OTP code verification, returns a session token or None"""
     print("\n LOGIN")
     print("-"*30)
     
@@ -95,16 +82,24 @@ def login_user_with_otp():
     email = input("Enter email: ").strip()
     password = input("Enter password: ").strip()
     
-    # Connect to database
-    db = get_database()
-    
+    # Connect to database (only for the login itself - the dashboard opens its own)
+    with session_scope() as db:
+        return _check_login(db, email, password)
+
+def _check_login(db, email, password):
+    """Check the password and the OTP code, returns a session token or None"""
     # Check if email and password are correct
     user = login_user(db, email, password)
     
     # If login failed, stop here
     if not user:
-        print(" Wrong email or password")
-        return None, None
+        # Tell the user if they're locked out rather than just wrong
+        wait_seconds = get_lockout_seconds(email)
+        if wait_seconds:
+            print(f" Too many failed attempts. Try again in {int(wait_seconds) + 1} seconds")
+        else:
+            print(" Wrong email or password")
+        return None
     
     print(" Email and password are correct!")
     
@@ -112,11 +107,13 @@ def login_user_with_otp():
     otp_code = create_new_otp(db, user.id)
     
     # Step 2: Send OTP code to user's email (simulated)
-    send_otp_email(user.email, otp_code)
+    if not send_otp_email(user.email, otp_code):
+        print(" Couldn't send your code right now. Please try again in a minute.")
+        return None
     
     # Step 3: Ask user to enter the OTP code
     print("\n ENTER OTP CODE")
-    print("Check the email message above for your code")
+    print("Check your email for the code")
     
     # Give user 3 chances to enter correct OTP
     attempts = 3
@@ -128,16 +125,20 @@ def login_user_with_otp():
             # OTP is correct - record successful login
             log_successful_login(db, user.id)
             print(" Login successful!")
-            return user, db  # Return user and database connection
+            # Step 4: Hand out a signed token instead of keeping the database session open
+            return get_session_tokens().issue(user.id)
         else:
             # OTP is wrong - reduce attempts
             attempts -= 1
+            if get_otp_lockout_seconds(user.id):
+                print(" Too many wrong codes. Please try again later.")
+                break
             if attempts > 0:
                 print(" Wrong OTP code. Try again.")
     
     # Too many wrong attempts
     print(" Too many wrong attempts")
-    return None, None
+    return None
 
 def show_user_profile(user, db):
     """Display user's profile information"""
@@ -147,6 +148,15 @@ def show_user_profile(user, db):
     print(f"Email: {user.email}")
     print(f"Password: {'*' * 8} (hidden for security)")
     print(f"Account created: {user.created_at.strftime('%Y-%m-%d %H:%M:%S')}")
+    
+    # Login totals come from the summary tables, so this stays quick however long the history is
+    summary = get_login_summary(db, user.id)
+    if summary.success_ratio is not None:
+        print(f"Logins: {summary.successes} successful, {summary.failures} failed "
+              f"({summary.success_ratio:.0%} successful)")
+    if summary.last_success_at:
+        print(f"Last login: {summary.last_success_at.strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"Failed attempts today: {summary.recent_failures}")
 
 def update_user_profile(user, db):
     """Let user change their profile details"""
@@ -160,40 +170,78 @@ def update_user_profile(user, db):
     new_password = input("New password: ").strip()
     
     # Update the user's information
-    update_user_info(
+    taken = update_user_info(
         db, user,
         new_username=new_username if new_username else None,
         new_email=new_email if new_email else None,
         new_password=new_password if new_password else None
     )
+    
+    # Tell the user about anything we couldn't change
+    for field in taken:
+        print(f" That {field} is already taken - kept your current {field}")
     print(" Profile updated!")
 
 def show_login_history(user, db):
-    """Show user's past login attempts"""
-    print("\n LOGIN HISTORY")
-    print("-"*40)
+    """Show user's past login attempts, 10 at a time"""
+    # Which attempts to show: None = all, True = successful only, False = failed only
+    only_successful = None
+    # Where the current page starts (None = the newest attempt)
+    before = None
     
-    # Get last 10 login attempts from database
-    attempts = db.query(LoginAttempt).filter(
-        LoginAttempt.user_id == user.id
-    ).order_by(LoginAttempt.timestamp.desc()).limit(10).all()
-    
-    # Check if user has any login history
-    if not attempts:
-        print("No login history found")
+    while True:
+        print("\n LOGIN HISTORY")
+        print("-"*40)
+        
+        # Get the next 10 attempts after the ones already shown
+        page = get_login_history(db, user.id, limit=10, before=before, successful=only_successful)
+        
+        # Check if user has any login history
+        if not page.attempts:
+            print("No login history found")
+        
+        # Show each login attempt
+        for attempt in page.attempts:
+            # Show if login was successful or failed
+            if attempt.successful:
+                status = " SUCCESS"
+            else:
+                status = " FAILED"
+            
+            # Format the time nicely
+            time = attempt.timestamp.strftime('%Y-%m-%d %H:%M:%S')
+            print(f"{time} - {status}")
+        
+        # Ask what to do next
+        print("-"*40)
+        if page.next_cursor:
+            print("n = next page, ", end="")
+        print("a = all, s = successful only, f = failed only, e = export, Enter = back")
+        action = input("Choose: ").strip().lower()
+        
+        if action == 'n' and page.next_cursor:
+            before = page.next_cursor
+        elif action in ('a', 's', 'f'):
+            # Start again from the newest attempt with the new filter
+            only_successful = {'a': None, 's': True, 'f': False}[action]
+            before = None
+        elif action == 'e':
+            export_history(user, db, only_successful)
+            return
+        else:
+            return
+
+def export_history(user, db, only_successful=None):
+    """Save the user's whole login history to a CSV or JSON lines file"""
+    file_format = input("Format (csv/jsonl): ").strip().lower() or "csv"
+    if file_format not in ("csv", "jsonl"):
+        print(" Please choose csv or jsonl")
         return
     
-    # Show each login attempt
-    for attempt in attempts:
-        # Show if login was successful or failed
-        if attempt.successful:
-            status = " SUCCESS"
-        else:
-            status = " FAILED"
-        
-        # Format the time nicely
-        time = attempt.timestamp.strftime('%Y-%m-%d %H:%M:%S')
-        print(f"{time} - {status}")
+    path = input(f"File name [login_history.{file_format}]: ").strip() or f"login_history.{file_format}"
+    with open(path, "w", newline="") as output:
+        count = export_login_history(db, user.id, output, file_format, only_successful)
+    print(f" Exported {count} login attempts to {path}")
 
 def clear_login_history(user, db):
     """Delete all login history for this user"""
@@ -202,6 +250,8 @@ def clear_login_history(user, db):
     
     # Only delete if user types 'y'
     if confirm == 'y':
+        # Save queued attempts first so they don't reappear after clearing
+        flush_audit_log()
         # Delete all login attempts for this user
         db.query(LoginAttempt).filter(LoginAttempt.user_id == user.id).delete()
         # Save changes to database
@@ -229,46 +279,112 @@ def delete_account(user, db):
         return False  
         # Account was not deleted
 
-def user_dashboard(user, db):
+def _user_for_token(db, token):
+    """The logged-in user for a session token, or None if the token or account is gone"""
+    claims = get_session_tokens().verify(token)
+    if claims is None:
+        return None
+    return get_user_by_id(db, claims.user_id)
+
+def user_dashboard(token):
     """Main menu after user logs in"""
     # Keep showing menu until user logs out
     while True:
+        # Check the token and look up the user (the user cache usually answers this)
+        with session_scope() as db:
+            user = _user_for_token(db, token)
+        
+        # The token ran out (or was cancelled) while the user was away
+        if user is None:
+            print(" Your session has expired. Please log in again.")
+            break
+        
         # Show the dashboard menu
         show_user_dashboard(user.username)
         
         # Get user's choice
         choice = input("Choose an option (1-6): ").strip()
         
-        # Handle each menu option
-        if choice == '1':
-            # Show user's profile
-            show_user_profile(user, db)
-        elif choice == '2':
-            # Update user's profile
-            update_user_profile(user, db)
-        elif choice == '3':
-            # Show login history
-            show_login_history(user, db)
-        elif choice == '4':
-            # Clear login history
-            clear_login_history(user, db)
-        elif choice == '5':
-            # Delete account
-            if delete_account(user, db):
-                break  # Exit dashboard if account deleted
-        elif choice == '6':
-            # Logout
+        # Logout
+        if choice == '6':
+            get_session_tokens().revoke(token)
             print(" Logged out successfully!")
             break  # Exit dashboard
+        
+        # Check the token again - the menu may have waited a long time for an answer
+        if get_session_tokens().verify(token) is None:
+            print(" Your session has expired. Please log in again.")
+            break
+        
+        # Viewing the profile or the history only reads, so it goes through the read-only
+        # engine (which doesn't wait on OTP and login writes in the "concurrent" profile)
+        if choice in ('1', '3'):
+            with session_scope(read_only=True) as db:
+                if choice == '1':
+                    # Show user's profile
+                    show_user_profile(user, db)
+                else:
+                    # Show login history
+                    show_login_history(user, db)
+        elif choice in ('2', '4', '5'):
+            # Each change gets its own short database session
+            with session_scope() as db:
+                user = get_user_by_id(db, user.id)
+                if user is None:
+                    print(" Your session has expired. Please log in again.")
+                    break
+                
+                if choice == '2':
+                    # Update user's profile
+                    update_user_profile(user, db)
+                elif choice == '4':
+                    # Clear login history
+                    clear_login_history(user, db)
+                elif delete_account(user, db):
+                    # Cancel every token the account still has
+                    get_session_tokens().revoke_user(user.id)
+                    break  # Exit dashboard if account deleted
         else:
             # Invalid choice
             print(" Invalid choice. Please enter 1-6.")
         
         # Wait for user to press Enter before showing menu again
         input("\nPress Enter to continue...")
+
+def show_stats():
+    """Show how many auth operations ran and how long they took"""
+    print("\n STATS")
+    print("-"*72)
+    print(f"{'Operation':<18}{'Calls':>7}{'OK':>7}{'Failed':>8}{'Errors':>8}{'Avg ms':>10}{'p95 ms':>10}")
+    print("-"*72)
     
-    # Close database connection when done
-    db.close()
+    rows = metrics_registry.summary()
+    if not rows:
+        print("Nothing has happened yet")
+    for row in rows:
+        print(f"{row['operation']:<18}{row['count']:>7}{row['success']:>7}{row['failure']:>8}"
+              f"{row['error']:>8}{row['mean_ms']:>10.1f}{row['p95_ms']:>10.1f}")
+    
+    # Show how well the user cache is doing, if it's on
+    user_cache = get_user_cache()
+    if user_cache:
+        cache_stats = user_cache.stats()
+        print(f"\nUser cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+              f"({cache_stats['hit_rate']:.0%} hit rate)")
+    
+    # Show how many SQL statements each operation sent, if the query log is on
+    query_log = get_query_log()
+    if query_log:
+        print("\nSQL statements per operation:")
+        for operation, numbers in query_log.statement_counts().items():
+            print(f"  {operation:<18}{numbers['statements']:>6} statements"
+                  f"{numbers['total_ms']:>10.1f} ms{numbers['slow']:>5} slow")
+    
+    # Optionally save everything in Prometheus format for a monitoring system
+    save_choice = input("\nSave in Prometheus format? (y/n): ").strip().lower()
+    if save_choice == 'y':
+        path = write_prometheus_file()
+        print(f" Saved to {path}")
 
 def start_cli():
     """Main function that runs the program"""
@@ -278,7 +394,7 @@ def start_cli():
         show_main_menu()
         
         # Get user's choice
-        choice = input("Choose an option (1-3): ").strip()
+        choice = input("Choose an option (1-4): ").strip()
         
         # Handle each menu option
         if choice == '1':
@@ -286,17 +402,20 @@ def start_cli():
             register_user()
         elif choice == '2':
             # Login existing user
-            user, db = login_user_with_otp()
+            token = login_user_with_otp()
             # If login successful, show user dashboard
-            if user:
-                user_dashboard(user, db)
+            if token:
+                user_dashboard(token)
         elif choice == '3':
+            # Show timing and counts
+            show_stats()
+        elif choice == '4':
             # Exit program
             print(" Goodbye!")
             break  # Exit the program
         else:
             # Invalid choice
-            print(" Invalid choice. Please enter 1-3.")
+            print(" Invalid choice. Please enter 1-4.")
         
         # Wait for user to press Enter before showing menu again
         input("\nPress Enter to continue...")
\ No newline at end of file
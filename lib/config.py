@@ -0,0 +1,30 @@
+# This file keeps small settings for this machine in a JSON file next to the database
+# (for example the bcrypt cost picked by "python main.py calibrate")
+import os
+import json
+
+# Settings file location
+CONFIG_PATH = "auth_config.json"
+
+# Database file location (lib/database.py builds its connection URL from this)
+DATABASE_PATH = "auth_system.db"
+
+def load_config(path=CONFIG_PATH):
+    """Read the settings file, an empty dictionary if it doesn't exist yet"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_config(updates, path=CONFIG_PATH):
+    """Change some settings and write the file back, returns all settings"""
+    config = load_config(path)
+    config.update(updates)
+
+    # Write to a temp file first so a crash never leaves a half-written file
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+    return config
@@ -1,31 +1,160 @@
 # This file sets up the database connection for our authentication system
-from sqlalchemy import create_engine
+# How the connection behaves comes from a storage profile:
+#   - "single-user":  one person at the keyboard, a small pool, the file's own journal mode
+#   - "concurrent":   WAL mode plus a separate read-only engine, so people reading their
+#                     login history never wait on OTP or login writes (and the other way round)
+#   - "memory":       an in-memory database for trying things out; nothing is saved
+# The program starts on "single-user"; main.py switches with use_storage() (see --storage).
+from collections import namedtuple
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from lib.config import DATABASE_PATH
 
 # Database file location - SQLite creates a file on your computer
-DATABASE_URL = "sqlite:///auth_system.db"
+DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
 
-# Step 1: Create the database engine (this connects to the database file)
-engine = create_engine(DATABASE_URL)
+# Everything a storage profile decides
+StorageProfile = namedtuple("StorageProfile", [
+    "journal_mode",      # "WAL", "DELETE", ... or None to keep what the file already uses
+    "synchronous",       # How hard SQLite works to make each commit survive a power cut
+    "busy_timeout",      # Seconds to wait for another connection's lock before giving up
+    "pool_size",         # Connections kept open for writing
+    "max_overflow",      # Extra connections allowed when they're all busy
+    "separate_reader",   # Give reads their own read-only engine
+    "reader_pool_size",  # Connections kept open for reading (if separate_reader)
+    "in_memory",         # Keep the whole database in memory instead of the file
+])
 
-# Step 2: Create a session factory (this lets us talk to the database)
-SessionLocal = sessionmaker(bind=engine)
+STORAGE_PROFILES = {
+    "single-user": StorageProfile(journal_mode=None, synchronous="FULL", busy_timeout=5,
+                                  pool_size=2, max_overflow=2, separate_reader=False,
+                                  reader_pool_size=0, in_memory=False),
+    "concurrent": StorageProfile(journal_mode="WAL", synchronous="NORMAL", busy_timeout=30,
+                                 pool_size=2, max_overflow=3, separate_reader=True,
+                                 reader_pool_size=4, in_memory=False),
+    "memory": StorageProfile(journal_mode=None, synchronous="OFF", busy_timeout=0,
+                             pool_size=1, max_overflow=0, separate_reader=False,
+                             reader_pool_size=0, in_memory=True),
+}
+
+DEFAULT_STORAGE_PROFILE = "single-user"
+
+def build_engine(path, profile, read_only=False):
+    """Create an engine for one SQLite file with the profile's pool and PRAGMA settings"""
+    if profile.in_memory:
+        # Every connection to "sqlite://" would be a new, empty database, so share one
+        return create_engine("sqlite://", poolclass=StaticPool,
+                             connect_args={"check_same_thread": False})
+
+    pool_size = profile.reader_pool_size if read_only else profile.pool_size
+    new_engine = create_engine(
+        f"sqlite:///{path}",
+        pool_size=pool_size,
+        max_overflow=profile.max_overflow,
+        connect_args={"timeout": profile.busy_timeout},
+    )
+
+    @event.listens_for(new_engine, "connect")
+    def apply_pragmas(dbapi_connection, connection_record):
+        if profile.journal_mode and not read_only:
+            dbapi_connection.execute(f"PRAGMA journal_mode={profile.journal_mode}")
+        dbapi_connection.execute(f"PRAGMA synchronous={profile.synchronous}")
+        if read_only:
+            # Any write through this engine fails instead of taking the write lock
+            dbapi_connection.execute("PRAGMA query_only=ON")
+
+    return new_engine
+
+def build_engines(path, profile):
+    """The read-write engine and the engine for reads (the same one unless the profile splits them)"""
+    writer = build_engine(path, profile)
+    reader = build_engine(path, profile, read_only=True) if profile.separate_reader else writer
+    return writer, reader
+
+# Step 1: Create the database engines (these connect to the database file)
+storage_profile = STORAGE_PROFILES[DEFAULT_STORAGE_PROFILE]
+engine, read_engine = build_engines(DATABASE_PATH, storage_profile)
+
+# Step 2: Create session factories (these let us talk to the database)
+# expire_on_commit=False keeps objects readable after a commit without reloading them,
+# so saving a user doesn't cost an extra SELECT
+SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
+ReadSessionLocal = sessionmaker(bind=read_engine, expire_on_commit=False)
 
 # Step 3: Create a base class for all our database tables
 Base = declarative_base()
 
+def use_storage(name, path=DATABASE_PATH, connections=None):
+    """Switch to another storage profile (call it before anything else opens a session)
+
+    connections keeps at least that many connections open in each pool, for example one
+    per worker thread.
+    """
+    global engine, read_engine, storage_profile
+
+    profile = STORAGE_PROFILES[name]
+    if connections and not profile.in_memory:
+        profile = profile._replace(pool_size=max(profile.pool_size, connections),
+                                   reader_pool_size=max(profile.reader_pool_size, connections))
+    old_engines = {engine, read_engine}
+
+    storage_profile = profile
+    engine, read_engine = build_engines(path, profile)
+
+    # Rebind the existing factories, so code that imported them already gets the new engines
+    SessionLocal.configure(bind=engine)
+    ReadSessionLocal.configure(bind=read_engine)
+    for old_engine in old_engines:
+        old_engine.dispose()
+
+    # A new in-memory database is empty, so give it its tables straight away
+    if profile.in_memory:
+        create_all_tables()
+    return profile
+
 def get_database():
     """Get a connection to the database so we can read/write data"""
     # Create a new database session
     database_session = SessionLocal()
-    
+
     # Return the session so other functions can use it
     return database_session
 
-def create_all_tables():
+@contextmanager
+def session_scope(read_only=False):
+    """A database session that is always closed afterwards, even if something goes wrong
+
+    The functions in lib/auth.py commit their own work, so this doesn't commit (closing
+    throws away anything left uncommitted). read_only=True uses the read-only engine,
+    which never waits on writers in WAL mode.
+    """
+    db = ReadSessionLocal() if read_only else SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def create_all_tables(target_engine=None):
     """Create all the database tables (users, otp_codes, login_attempts)"""
+    from lib.migrations import run_migrations, get_schema_version, LATEST_VERSION
+    import lib.models  # Registers every table on Base, in case nothing imported the models yet
+
+    # Use the main database unless we were given a different engine
+    target_engine = target_engine or engine
+
+    # A file stamped with the latest schema version already has everything - skip the
+    # table-by-table checks create_all would do
+    with target_engine.connect() as connection:
+        if get_schema_version(connection) >= LATEST_VERSION:
+            return
+
     # This looks at all our models and creates the tables in the database file
-    Base.metadata.create_all(bind=engine)
-    
-    # After this runs, you'll see a file called "auth_system.db" in your folder
\ No newline at end of file
+    Base.metadata.create_all(bind=target_engine)
+
+    # Bring older database files up to date (new indexes etc.)
+    run_migrations(target_engine)
+
+    # After this runs, you'll see a file called "auth_system.db" in your folder
@@ -0,0 +1,163 @@
+# This file runs bcrypt password hashing in a pool of workers
+# bcrypt is slow on purpose (~250ms per call), so we keep it off the caller's thread
+import os
+import time
+import asyncio
+import bcrypt
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Default settings for the hashing engine
+DEFAULT_POOL_KIND = "thread"            # "thread" or "process"
+DEFAULT_WORKERS = os.cpu_count() or 1   # One worker per CPU core
+DEFAULT_ROUNDS = 12                     # Same cost bcrypt.gensalt() uses by default
+MIN_ROUNDS = 10                         # Calibration never goes below this, however slow the machine
+MAX_ROUNDS = 16                         # ...or above this, however fast
+
+def _hash_password_bytes(password, rounds):
+    """Hash one password (runs inside a worker)"""
+    # Generate a random salt with the chosen cost and hash the password
+    salt = bcrypt.gensalt(rounds)
+    hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
+    return hashed.decode('utf-8')
+
+def _check_password_bytes(password, hashed_password):
+    """Compare one password against its hash (runs inside a worker)"""
+    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+def configured_rounds():
+    """The bcrypt cost saved by calibrate_bcrypt_rounds(), or the default"""
+    from lib.config import load_config
+    return int(load_config().get("bcrypt_rounds", DEFAULT_ROUNDS))
+
+def get_hash_rounds(hashed_password):
+    """Read the cost a bcrypt hash was made with (hashes look like $2b$12$...)"""
+    try:
+        return int(hashed_password.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+def calibrate_bcrypt_rounds(target_ms=250, min_rounds=MIN_ROUNDS, max_rounds=MAX_ROUNDS, save=True):
+    """Find the highest bcrypt cost that hashes within target_ms on this machine
+
+    Returns (rounds, elapsed_ms). If even min_rounds is slower than target_ms, that's the
+    cost you get - elapsed_ms > target_ms then tells the caller the budget wasn't met.
+    """
+    def time_one_hash(rounds):
+        started = time.perf_counter()
+        _hash_password_bytes("calibration-password", rounds)
+        return (time.perf_counter() - started) * 1000
+
+    # Each extra round doubles the work, so step up while the next cost still fits the budget
+    rounds = min_rounds
+    elapsed_ms = time_one_hash(rounds)
+    while rounds < max_rounds and elapsed_ms * 2 <= target_ms:
+        rounds += 1
+        elapsed_ms = time_one_hash(rounds)
+
+    # The last step may have overshot - go back one
+    if elapsed_ms > target_ms and rounds > min_rounds:
+        rounds -= 1
+        elapsed_ms = elapsed_ms / 2
+
+    if save:
+        from lib.config import save_config
+        save_config({"bcrypt_rounds": rounds})
+
+    return rounds, elapsed_ms
+
+class HashingEngine:
+    """Runs bcrypt hashing and checking in a thread or process pool"""
+
+    def __init__(self, kind=DEFAULT_POOL_KIND, workers=None, rounds=None):
+        # Check the pool type is one we know about
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown pool kind: {kind}")
+
+        self.kind = kind
+        self.workers = workers or DEFAULT_WORKERS
+        self.rounds = rounds or configured_rounds()  # Cost for new hashes
+
+        # bcrypt releases the GIL while hashing, so threads use every core too.
+        # A process pool is still available for fully isolated workers.
+        if kind == "thread":
+            self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        else:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    def submit_hash(self, password):
+        """Start hashing a password and return a Future with the hash"""
+        return self.pool.submit(_hash_password_bytes, password, self.rounds)
+
+    def submit_check(self, password, hashed_password):
+        """Start checking a password and return a Future with True/False"""
+        return self.pool.submit(_check_password_bytes, password, hashed_password)
+
+    def hash(self, password):
+        """Hash a password and wait for the result"""
+        return self.submit_hash(password).result()
+
+    def check(self, password, hashed_password):
+        """Check a password and wait for the result"""
+        return self.submit_check(password, hashed_password).result()
+
+    def needs_rehash(self, hashed_password):
+        """True if the hash was made with a different cost than new hashes use"""
+        return get_hash_rounds(hashed_password) != self.rounds
+
+    def check_batch(self, pairs):
+        """Check many (password, hashed_password) pairs at once, results in the same order"""
+        # Send every check to the pool first so they all run in parallel
+        futures = [self.submit_check(password, hashed) for password, hashed in pairs]
+
+        # Then collect the answers in order
+        return [future.result() for future in futures]
+
+    async def hash_async(self, password):
+        """Hash a password without blocking the event loop"""
+        return await asyncio.wrap_future(self.submit_hash(password))
+
+    async def check_async(self, password, hashed_password):
+        """Check a password without blocking the event loop"""
+        return await asyncio.wrap_future(self.submit_check(password, hashed_password))
+
+    def shutdown(self):
+        """Stop the worker pool"""
+        self.pool.shutdown(wait=True)
+
+# The engine shared by the whole program (created the first time it's needed)
+_hashing_engine = None
+
+def get_hashing_engine():
+    """Get the shared hashing engine, creating it with default settings if needed"""
+    global _hashing_engine
+    if _hashing_engine is None:
+        _hashing_engine = HashingEngine()
+    return _hashing_engine
+
+def configure_hashing_engine(kind=DEFAULT_POOL_KIND, workers=None, rounds=None):
+    """Replace the shared hashing engine with one using new settings"""
+    global _hashing_engine
+
+    # Stop the old pool before starting a new one
+    if _hashing_engine is not None:
+        _hashing_engine.shutdown()
+
+    _hashing_engine = HashingEngine(kind=kind, workers=workers, rounds=rounds)
+    return _hashing_engine
+
+def set_hashing_engine(engine):
+    """Use an engine that was built elsewhere (for example by the benchmarks)"""
+    global _hashing_engine
+
+    if _hashing_engine is not None and _hashing_engine is not engine:
+        _hashing_engine.shutdown()
+
+    _hashing_engine = engine
+    return _hashing_engine
+
+def shutdown_hashing_engine():
+    """Stop the shared hashing engine (a new one is created on next use)"""
+    global _hashing_engine
+    if _hashing_engine is not None:
+        _hashing_engine.shutdown()
+        _hashing_engine = None
@@ -0,0 +1,90 @@
+# This file reads a user's login history one page at a time and exports all of it
+# Pages are found with "keyset" pagination: each page starts just after the (timestamp, id)
+# of the last row on the previous page. Unlike OFFSET, the database never has to count past
+# the rows already shown, so page 1000 is as quick as page 1 and an export of any size
+# only keeps one page in memory.
+import json
+from collections import namedtuple
+from sqlalchemy import select, tuple_
+from lib.models import LoginAttempt
+from lib.audit import flush_audit_log
+
+# One page of history, newest first; next_cursor is None on the last page
+HistoryPage = namedtuple("HistoryPage", ["attempts", "next_cursor"])
+
+# One login attempt as plain values (cheaper than a LoginAttempt object for exports)
+HistoryRow = namedtuple("HistoryRow", ["id", "timestamp", "successful"])
+
+def history_query(user_id, before=None, successful=None, limit=10):
+    """Build the SELECT for one page (shared with the async service)
+
+    before is the (timestamp, id) cursor of the last row already seen, successful=True or
+    False keeps only successes or failures. The (user_id, timestamp) index also holds the
+    row id, so the ORDER BY and the cursor comparison are both answered from the index.
+    """
+    query = select(LoginAttempt.id, LoginAttempt.timestamp, LoginAttempt.successful).where(
+        LoginAttempt.user_id == user_id
+    )
+    if successful is not None:
+        query = query.where(LoginAttempt.successful == successful)
+    if before is not None:
+        query = query.where(tuple_(LoginAttempt.timestamp, LoginAttempt.id) < tuple_(*before))
+    return query.order_by(LoginAttempt.timestamp.desc(), LoginAttempt.id.desc()).limit(limit)
+
+def make_page(rows, limit):
+    """Turn up to limit + 1 rows into a page (the extra row only tells us there's more)"""
+    attempts = [HistoryRow(*row) for row in rows[:limit]]
+    if len(rows) > limit:
+        last = attempts[-1]
+        return HistoryPage(attempts, (last.timestamp, last.id))
+    return HistoryPage(attempts, None)
+
+def get_login_history(db, user_id, limit=10, before=None, successful=None):
+    """Get one page of login attempts, newest first"""
+    # Save queued login attempts before showing the newest page
+    if before is None:
+        flush_audit_log()
+
+    rows = db.execute(history_query(user_id, before, successful, limit + 1)).all()
+    return make_page(rows, limit)
+
+def iter_login_history(db, user_id, successful=None, page_size=500):
+    """Yield every login attempt, newest first, reading one page at a time"""
+    before = None
+    while True:
+        page = get_login_history(db, user_id, page_size, before, successful)
+        yield from page.attempts
+        if page.next_cursor is None:
+            return
+        before = page.next_cursor
+
+def history_lines(rows, file_format="csv"):
+    """Yield export lines (with newline) for login attempts, in CSV or JSON lines format"""
+    if file_format == "csv":
+        yield "id,timestamp,successful\n"
+        for row in rows:
+            yield f"{row.id},{row.timestamp.isoformat()},{'true' if row.successful else 'false'}\n"
+    elif file_format == "jsonl":
+        for row in rows:
+            yield json.dumps({
+                "id": row.id,
+                "timestamp": row.timestamp.isoformat(),
+                "successful": bool(row.successful),
+            }) + "\n"
+    else:
+        raise ValueError(f"Unknown export format: {file_format}")
+
+def export_login_history(db, user_id, output, file_format="csv", successful=None, page_size=500):
+    """Write a user's whole login history to an open text file, returns how many rows"""
+    exported = 0
+
+    def counted(rows):
+        nonlocal exported
+        for row in rows:
+            exported += 1
+            yield row
+
+    rows = counted(iter_login_history(db, user_id, successful, page_size))
+    for line in history_lines(rows, file_format):
+        output.write(line)
+    return exported
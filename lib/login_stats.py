@@ -0,0 +1,83 @@
+# This file reads each user's login totals without walking through their login history
+# The login_stats table holds running totals per user and login_stats_daily holds them per
+# user per day. Triggers on login_attempts (see migration 4 in lib/migrations.py) keep both
+# up to date on every insert and delete, whichever code path wrote the attempt: login_user,
+# log_successful_login, the audit writer's batches, the async service or a shard move.
+#
+# If the totals ever drift (for example after editing the file by hand), rebuild them from
+# the raw rows with rebuild_login_stats() or "python main.py rebuild-stats".
+from datetime import date, timedelta
+from collections import namedtuple
+from sqlalchemy import select, delete, insert, func, case, null
+from lib.models import LoginAttempt, LoginStats, DailyLoginStats
+from lib.audit import flush_audit_log
+
+# What the dashboard shows about a user's logins
+LoginSummary = namedtuple("LoginSummary", [
+    "successes", "failures", "success_ratio", "last_success_at", "last_failure_at", "recent_failures",
+])
+
+def recent_failures(db, user_id, days=1):
+    """Failed logins today and on the days before it (days=1 means just today)"""
+    first_day = (date.today() - timedelta(days=days - 1)).isoformat()
+    return db.execute(
+        select(func.coalesce(func.sum(DailyLoginStats.failures), 0))
+        .where(DailyLoginStats.user_id == user_id, DailyLoginStats.day >= first_day)
+    ).scalar()
+
+def get_login_summary(db, user_id, recent_days=1):
+    """The user's login totals, read from the summary tables (no history scan)"""
+    # Save queued login attempts first so the one that just happened is counted
+    flush_audit_log()
+
+    row = db.execute(
+        select(LoginStats.successes, LoginStats.failures, LoginStats.last_success_at, LoginStats.last_failure_at)
+        .where(LoginStats.user_id == user_id)
+    ).first()
+    successes, failures, last_success_at, last_failure_at = row or (0, 0, None, None)
+
+    total = successes + failures
+    ratio = successes / total if total else None
+    return LoginSummary(successes, failures, ratio, last_success_at, last_failure_at,
+                        recent_failures(db, user_id, recent_days))
+
+def rebuild_login_stats(db, user_id=None):
+    """Work both summary tables out again from login_attempts (for one user or everyone)
+
+    Returns {"users": rows written to login_stats, "days": rows written to login_stats_daily}.
+    """
+    flush_audit_log()
+
+    success = case((LoginAttempt.successful == True, 1), else_=0)
+    failure = 1 - success
+    day = func.date(LoginAttempt.timestamp)
+
+    per_user = select(
+        LoginAttempt.user_id,
+        func.sum(success), func.sum(failure),
+        func.max(case((LoginAttempt.successful == True, LoginAttempt.timestamp))),
+        func.max(case((LoginAttempt.successful == True, null()), else_=LoginAttempt.timestamp)),
+    ).group_by(LoginAttempt.user_id)
+    per_day = select(
+        LoginAttempt.user_id, day, func.sum(success), func.sum(failure),
+    ).group_by(LoginAttempt.user_id, day)
+
+    # Step 1: Forget the old totals
+    clear_users = delete(LoginStats)
+    clear_days = delete(DailyLoginStats)
+    if user_id is not None:
+        clear_users = clear_users.where(LoginStats.user_id == user_id)
+        clear_days = clear_days.where(DailyLoginStats.user_id == user_id)
+        per_user = per_user.where(LoginAttempt.user_id == user_id)
+        per_day = per_day.where(LoginAttempt.user_id == user_id)
+    db.execute(clear_users)
+    db.execute(clear_days)
+
+    # Step 2: Count everything again in two INSERT ... SELECT statements, in one transaction
+    users = db.execute(insert(LoginStats).from_select(
+        ["user_id", "successes", "failures", "last_success_at", "last_failure_at"], per_user)).rowcount
+    days = db.execute(insert(DailyLoginStats).from_select(
+        ["user_id", "day", "successes", "failures"], per_day)).rowcount
+    db.commit()
+
+    return {"users": users, "days": days}
@@ -0,0 +1,96 @@
+# This file is a tiny stand-in SMTP server for trying out email delivery without a real one
+# It speaks just enough SMTP for smtplib (EHLO/HELO, MAIL, RCPT, DATA, RSET, NOOP, QUIT)
+# and writes every message it receives to a JSON lines file instead of delivering it.
+#
+# Start it with: python main.py mail-sink --port 8025 --output received_mail.jsonl
+# then run the app with: python main.py --mail smtp://localhost:8025
+import json
+import threading
+import socketserver
+from datetime import datetime
+from email import message_from_bytes
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Talks SMTP with one client connection (which may send many messages)"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        self.reply("220 auth-system mail sink ready")
+        sender, recipients = None, []
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").strip()
+            verb = command[:4].upper()
+
+            if verb in ("HELO", "EHLO"):
+                self.reply("250 auth-system")
+            elif verb == "MAIL":
+                sender, recipients = command[10:].strip(), []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command[8:].strip())
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                self.server.save(sender, recipients, self._read_data())
+                self.reply("250 OK: queued")
+            elif verb == "RSET":
+                sender, recipients = None, []
+                self.reply("250 OK")
+            elif verb == "NOOP":
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+    def _read_data(self):
+        """Read the message up to the line with a single dot"""
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line or line in (b".\r\n", b".\n"):
+                return b"".join(lines)
+            # A leading dot is doubled by the client so it can't end the message early
+            lines.append(line[1:] if line.startswith(b"..") else line)
+
+class MailSink(socketserver.ThreadingTCPServer):
+    """Stand-in SMTP server that writes received messages to a file"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="localhost", port=8025, output="received_mail.jsonl"):
+        super().__init__((host, port), _SMTPHandler)
+        self.output = output
+        self.received = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def save(self, sender, recipients, data):
+        message = message_from_bytes(data)
+        line = json.dumps({
+            "from": sender,
+            "to": recipients,
+            "subject": message["Subject"],
+            "body": message.get_payload(),
+            "received_at": datetime.now().isoformat(),
+        })
+        with self.lock:
+            with open(self.output, "a") as f:
+                f.write(line + "\n")
+            self.received += 1
+
+    def start(self):
+        """Serve from a background thread, returns the thread"""
+        thread = threading.Thread(target=self.serve_forever, name="mail-sink", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,163 @@
+# This file counts auth operations and measures how long they take
+# Every timed operation records one latency sample and one success/failure count.
+# That costs two clock reads and a few additions, so it stays on all the time.
+import os
+import time
+import bisect
+import threading
+import contextvars
+from functools import wraps
+
+# Latency bucket upper bounds in seconds (Prometheus style, from 0.5ms to 10s)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Counts samples into latency buckets and keeps their sum"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last slot is "bigger than every bucket"
+        self.total = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += seconds
+            self.count += 1
+
+    def percentile(self, pct):
+        """Approximate percentile: the upper bound of the bucket it falls in"""
+        with self.lock:
+            if not self.count:
+                return 0.0
+            wanted = pct / 100.0 * self.count
+            running = 0
+            for index, bucket_count in enumerate(self.counts):
+                running += bucket_count
+                if running >= wanted:
+                    return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+class MetricsRegistry:
+    """All counters and histograms, keyed by operation name"""
+
+    def __init__(self):
+        self.histograms = {}   # operation -> Histogram
+        self.counters = {}     # (operation, outcome) -> count
+        self.lock = threading.Lock()
+
+    def histogram(self, operation):
+        histogram = self.histograms.get(operation)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(operation, Histogram())
+        return histogram
+
+    def count(self, operation, outcome, amount=1):
+        with self.lock:
+            key = (operation, outcome)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, operation, seconds, outcome):
+        """Record one finished operation"""
+        self.histogram(operation).observe(seconds)
+        self.count(operation, outcome)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def summary(self):
+        """Per-operation numbers for the CLI stats view"""
+        rows = []
+        for operation in sorted(self.histograms):
+            histogram = self.histograms[operation]
+            rows.append({
+                "operation": operation,
+                "count": histogram.count,
+                "success": self.counters.get((operation, "success"), 0),
+                "failure": self.counters.get((operation, "failure"), 0),
+                "error": self.counters.get((operation, "error"), 0),
+                "mean_ms": 1000.0 * histogram.total / histogram.count if histogram.count else 0.0,
+                "p95_ms": 1000.0 * histogram.percentile(95),
+            })
+        return rows
+
+    def prometheus_text(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = [
+            "# HELP auth_operation_total Finished auth operations by outcome.",
+            "# TYPE auth_operation_total counter",
+        ]
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+
+        for (operation, outcome), value in counters:
+            lines.append(f'auth_operation_total{{operation="{operation}",outcome="{outcome}"}} {value}')
+
+        lines.append("# HELP auth_operation_seconds How long auth operations take.")
+        lines.append("# TYPE auth_operation_seconds histogram")
+        for operation, histogram in histograms:
+            with histogram.lock:
+                counts = list(histogram.counts)
+                total, count = histogram.total, histogram.count
+
+            running = 0
+            for bound, bucket_count in zip(histogram.buckets, counts):
+                running += bucket_count
+                lines.append(f'auth_operation_seconds_bucket{{operation="{operation}",le="{bound}"}} {running}')
+            lines.append(f'auth_operation_seconds_bucket{{operation="{operation}",le="+Inf"}} {count}')
+            lines.append(f'auth_operation_seconds_sum{{operation="{operation}"}} {total}')
+            lines.append(f'auth_operation_seconds_count{{operation="{operation}"}} {count}')
+
+        return "\n".join(lines) + "\n"
+
+# The registry the whole program records into
+registry = MetricsRegistry()
+
+# Where the CLI writes the Prometheus dump (a node_exporter textfile collector can pick it up)
+METRICS_PATH = "auth_metrics.prom"
+
+def always(result):
+    """For operations that have no failure result, only success or error"""
+    return True
+
+def write_prometheus_file(path=METRICS_PATH):
+    """Write the Prometheus text dump to a file (atomically, so a scraper never sees half of it)"""
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write(registry.prometheus_text())
+    os.replace(temp_path, path)
+    return path
+
+# The timed operation running right now (so the query log can tell which one sent a statement)
+_current_operation = contextvars.ContextVar("current_operation", default=None)
+
+def current_operation():
+    """Name of the innermost timed operation running here, or None"""
+    return _current_operation.get()
+
+def timed(operation, succeeded=bool):
+    """Decorator: time every call and count it as success/failure (by its result) or error"""
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            token = _current_operation.set(operation)
+            started = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                registry.observe(operation, time.perf_counter() - started, "error")
+                raise
+            finally:
+                _current_operation.reset(token)
+            outcome = "success" if succeeded(result) else "failure"
+            registry.observe(operation, time.perf_counter() - started, outcome)
+            return result
+        return wrapper
+    return decorate
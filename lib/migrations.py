@@ -0,0 +1,136 @@
+# This file upgrades existing database files to the latest schema, one numbered step at a time
+# SQLite keeps the current schema version in the file itself (PRAGMA user_version)
+# A file on LATEST_VERSION is fully set up, so startup can skip create_all. That means a
+# new table or index needs a migration here too, not just a change in lib/models.py.
+#
+# This file only uses the standard library, so checking the version stays cheap.
+import os
+import sqlite3
+
+# Every migration is (version number, description, list of SQL statements).
+# Add new ones at the end with the next number - never change one that has already shipped.
+MIGRATIONS = [
+    (1, "Composite indexes for OTP lookups and login history", [
+        "CREATE INDEX IF NOT EXISTS ix_otp_codes_user_used_code "
+        "ON otp_codes (user_id, is_used, code)",
+        "CREATE INDEX IF NOT EXISTS ix_login_attempts_user_timestamp "
+        "ON login_attempts (user_id, timestamp)",
+    ]),
+    (2, "Indexes for the retention job", [
+        "CREATE INDEX IF NOT EXISTS ix_otp_codes_expires_at ON otp_codes (expires_at)",
+        "CREATE INDEX IF NOT EXISTS ix_login_attempts_timestamp ON login_attempts (timestamp)",
+    ]),
+    (3, "Log of usernames and emails added to users (lets a saved user filter catch up)", [
+        "CREATE TABLE IF NOT EXISTS user_name_log "
+        "(seq INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL, email TEXT NOT NULL)",
+        "CREATE TRIGGER IF NOT EXISTS users_log_insert AFTER INSERT ON users "
+        "BEGIN INSERT INTO user_name_log (username, email) VALUES (NEW.username, NEW.email); END",
+        "CREATE TRIGGER IF NOT EXISTS users_log_update AFTER UPDATE OF username, email ON users "
+        "BEGIN INSERT INTO user_name_log (username, email) VALUES (NEW.username, NEW.email); END",
+    ]),
+    (4, "Per-user and per-day login totals, kept up to date by triggers on login_attempts", [
+        "CREATE TABLE IF NOT EXISTS login_stats "
+        "(user_id INTEGER NOT NULL PRIMARY KEY REFERENCES users (id), "
+        "successes INTEGER NOT NULL, failures INTEGER NOT NULL, "
+        "last_success_at DATETIME, last_failure_at DATETIME)",
+        "CREATE TABLE IF NOT EXISTS login_stats_daily "
+        "(user_id INTEGER NOT NULL REFERENCES users (id), day VARCHAR(10) NOT NULL, "
+        "successes INTEGER NOT NULL, failures INTEGER NOT NULL, PRIMARY KEY (user_id, day))",
+
+        # A new attempt adds one to the user's totals and to that day's totals
+        "CREATE TRIGGER IF NOT EXISTS login_stats_insert AFTER INSERT ON login_attempts BEGIN "
+        "INSERT INTO login_stats (user_id, successes, failures, last_success_at, last_failure_at) "
+        "VALUES (NEW.user_id, NEW.successful IS 1, NEW.successful IS NOT 1, "
+        "CASE WHEN NEW.successful IS 1 THEN NEW.timestamp END, "
+        "CASE WHEN NEW.successful IS NOT 1 THEN NEW.timestamp END) "
+        "ON CONFLICT (user_id) DO UPDATE SET "
+        "successes = successes + excluded.successes, failures = failures + excluded.failures, "
+        "last_success_at = coalesce(max(last_success_at, excluded.last_success_at), "
+        "last_success_at, excluded.last_success_at), "
+        "last_failure_at = coalesce(max(last_failure_at, excluded.last_failure_at), "
+        "last_failure_at, excluded.last_failure_at); "
+        "INSERT INTO login_stats_daily (user_id, day, successes, failures) "
+        "VALUES (NEW.user_id, date(NEW.timestamp), NEW.successful IS 1, NEW.successful IS NOT 1) "
+        "ON CONFLICT (user_id, day) DO UPDATE SET "
+        "successes = successes + excluded.successes, failures = failures + excluded.failures; "
+        "END",
+
+        # A deleted attempt (cleared history, retention) takes one off again. The last login
+        # time is only looked up again when the newest attempt of its kind was deleted.
+        "CREATE TRIGGER IF NOT EXISTS login_stats_delete AFTER DELETE ON login_attempts BEGIN "
+        "UPDATE login_stats SET "
+        "successes = successes - (OLD.successful IS 1), failures = failures - (OLD.successful IS NOT 1), "
+        "last_success_at = CASE WHEN OLD.successful IS 1 AND OLD.timestamp >= last_success_at THEN "
+        "(SELECT max(timestamp) FROM login_attempts WHERE user_id = OLD.user_id AND successful IS 1) "
+        "ELSE last_success_at END, "
+        "last_failure_at = CASE WHEN OLD.successful IS NOT 1 AND OLD.timestamp >= last_failure_at THEN "
+        "(SELECT max(timestamp) FROM login_attempts WHERE user_id = OLD.user_id AND successful IS NOT 1) "
+        "ELSE last_failure_at END "
+        "WHERE user_id = OLD.user_id; "
+        "DELETE FROM login_stats WHERE user_id = OLD.user_id AND successes = 0 AND failures = 0; "
+        "UPDATE login_stats_daily SET "
+        "successes = successes - (OLD.successful IS 1), failures = failures - (OLD.successful IS NOT 1) "
+        "WHERE user_id = OLD.user_id AND day = date(OLD.timestamp); "
+        "DELETE FROM login_stats_daily "
+        "WHERE user_id = OLD.user_id AND day = date(OLD.timestamp) AND successes = 0 AND failures = 0; "
+        "END",
+
+        "CREATE TRIGGER IF NOT EXISTS login_stats_user_delete AFTER DELETE ON users BEGIN "
+        "DELETE FROM login_stats WHERE user_id = OLD.id; "
+        "DELETE FROM login_stats_daily WHERE user_id = OLD.id; "
+        "END",
+
+        # Fill both tables from the attempts already in the file
+        "INSERT OR REPLACE INTO login_stats (user_id, successes, failures, last_success_at, last_failure_at) "
+        "SELECT user_id, sum(successful IS 1), sum(successful IS NOT 1), "
+        "max(CASE WHEN successful IS 1 THEN timestamp END), "
+        "max(CASE WHEN successful IS NOT 1 THEN timestamp END) "
+        "FROM login_attempts GROUP BY user_id",
+        "INSERT OR REPLACE INTO login_stats_daily (user_id, day, successes, failures) "
+        "SELECT user_id, date(timestamp), sum(successful IS 1), sum(successful IS NOT 1) "
+        "FROM login_attempts GROUP BY user_id, date(timestamp)",
+    ]),
+]
+
+# The version a fully upgraded database file has
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(connection):
+    """Read the schema version stored in the database file"""
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+def file_schema_version(path):
+    """Read the schema version straight from a database file (0 if there's no file yet)"""
+    if not os.path.exists(path):
+        return 0
+
+    # Open read-only so checking never creates or locks anything
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return connection.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        connection.close()
+
+def schema_is_current(path):
+    """True if the database file already has every table, index and migration"""
+    return file_schema_version(path) >= LATEST_VERSION
+
+def run_migrations(engine):
+    """Apply every migration the database file hasn't had yet, returns the versions applied"""
+    applied = []
+
+    for version, description, statements in MIGRATIONS:
+        # Each migration runs in its own transaction together with the version bump,
+        # so a failed step leaves the file on the previous version
+        with engine.begin() as connection:
+            if get_schema_version(connection) >= version:
+                continue
+
+            for statement in statements:
+                connection.exec_driver_sql(statement)
+
+            connection.exec_driver_sql(f"PRAGMA user_version = {version}")
+
+        applied.append((version, description))
+
+    return applied
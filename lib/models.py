@@ -1,5 +1,5 @@
 # This file defines the database tables (called "models") for our authentication system
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from lib.database import Base
@@ -49,6 +49,14 @@ class OTP(Base):
     # Connect back to the User table
     user = relationship("User", back_populates="otp_codes")
     
+    # Index for the OTP lookups: create_new_otp filters on (user_id, is_used)
+    # and verify_otp_code on (user_id, code, is_used) - one index covers both.
+    # The expires_at index lets the retention job find old codes quickly.
+    __table_args__ = (
+        Index('ix_otp_codes_user_used_code', 'user_id', 'is_used', 'code'),
+        Index('ix_otp_codes_expires_at', 'expires_at'),
+    )
+    
     def is_expired(self):
         """Check if this OTP code has expired (past its expiration time)"""
         current_time = datetime.now()
@@ -78,4 +86,46 @@ class LoginAttempt(Base):
     # Did the login succeed? (True/False)
     
     # Connect back to the User table
-    user = relationship("User", back_populates="login_attempts")
\ No newline at end of file
+    user = relationship("User", back_populates="login_attempts")
+    
+    # Index for login history: one user's attempts, newest first.
+    # The timestamp index lets the retention job find old attempts quickly.
+    __table_args__ = (
+        Index('ix_login_attempts_user_timestamp', 'user_id', 'timestamp'),
+        Index('ix_login_attempts_timestamp', 'timestamp'),
+    )
+
+class LoginStats(Base):
+    """This creates the 'login_stats' table: running totals of each user's login attempts"""
+    
+    # Tell SQLAlchemy what to name this table in the database
+    __tablename__ = 'login_stats'
+    
+    # The numbers are kept up to date by triggers on login_attempts (see lib/migrations.py),
+    # so reading them is one row lookup instead of a walk through the whole history
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    # Whose attempts these are
+    successes = Column(Integer, nullable=False, default=0)
+    # Successful logins
+    failures = Column(Integer, nullable=False, default=0)
+    # Failed logins
+    last_success_at = Column(DateTime)
+    # When the user last logged in
+    last_failure_at = Column(DateTime)
+    # When the last login failed
+
+class DailyLoginStats(Base):
+    """This creates the 'login_stats_daily' table: each user's login attempts counted per day"""
+    
+    # Tell SQLAlchemy what to name this table in the database
+    __tablename__ = 'login_stats_daily'
+    
+    # Also kept up to date by the triggers on login_attempts
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    # Whose attempts these are
+    day = Column(String(10), primary_key=True)
+    # The date as YYYY-MM-DD
+    successes = Column(Integer, nullable=False, default=0)
+    # Successful logins that day
+    failures = Column(Integer, nullable=False, default=0)
+    # Failed logins that day
@@ -0,0 +1,322 @@
+# This file sends OTP emails from background threads, so logging in never waits on the mail server
+# send_otp_email() puts the message on a queue and returns straight away. Worker threads
+# take messages off in batches and send each batch over one mail server connection, which
+# they keep open between batches. A failed send is tried again later, waiting longer after
+# each failure (exponential backoff), until max_attempts is reached.
+#
+# Where the messages go is up to the "sink": the console (the old behaviour), a JSON lines
+# file for testing offline, or a real SMTP server (see lib/mail_sink.py for a local one).
+import json
+import time
+import heapq
+import queue
+import atexit
+import smtplib
+import threading
+from datetime import datetime
+from collections import namedtuple
+from email.message import EmailMessage
+from lib.metrics import registry
+
+# One email waiting to go out
+OTPMessage = namedtuple("OTPMessage", ["email", "code", "queued_at", "attempts"])
+
+# Who the emails are from
+SENDER = "no-reply@auth-system.local"
+SUBJECT = "Your Login Verification Code"
+
+def otp_email_body(code):
+    """The text of an OTP email"""
+    return (
+        f"Your OTP code is: {code}\n"
+        f"This code will expire in 10 minutes.\n"
+        f"\n"
+        f"Do not share this code with anyone!\n"
+    )
+
+class ConsoleSink:
+    """Prints each email to the console (what send_otp_email always did)"""
+
+    def __init__(self, output=None):
+        self.output = output  # Where to print (None means stdout)
+
+    def connect(self):
+        return self
+
+    def send(self, message):
+        print(f"\n" + "="*50, file=self.output)
+        print(f" EMAIL SENT TO: {message.email}", file=self.output)
+        print(f"Subject: {SUBJECT}", file=self.output)
+        print(f"", file=self.output)
+        print(otp_email_body(message.code), file=self.output)
+        print("="*50, file=self.output, flush=True)
+
+    def close(self):
+        pass
+
+class FileSink:
+    """Appends each email to a file as one JSON object per line (for testing offline)"""
+
+    def __init__(self, path="sent_mail.jsonl"):
+        self.path = path
+        self.lock = threading.Lock()  # Several workers may write at once
+
+    def connect(self):
+        return self
+
+    def send(self, message):
+        line = json.dumps({
+            "to": message.email,
+            "from": SENDER,
+            "subject": SUBJECT,
+            "body": otp_email_body(message.code),
+            "sent_at": datetime.now().isoformat(),
+        })
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+    def close(self):
+        pass
+
+class SMTPSink:
+    """Sends real emails through an SMTP server"""
+
+    def __init__(self, host="localhost", port=25, username=None, password=None, starttls=False, timeout=10):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+
+    def connect(self):
+        """Open one connection (each worker keeps its own and reuses it for every batch)"""
+        return _SMTPConnection(self)
+
+class _SMTPConnection:
+    """One open connection to the SMTP server"""
+
+    def __init__(self, sink):
+        self.smtp = smtplib.SMTP(sink.host, sink.port, timeout=sink.timeout)
+        if sink.starttls:
+            self.smtp.starttls()
+        if sink.username:
+            self.smtp.login(sink.username, sink.password)
+
+    def send(self, message):
+        email = EmailMessage()
+        email["From"] = SENDER
+        email["To"] = message.email
+        email["Subject"] = SUBJECT
+        email.set_content(otp_email_body(message.code))
+        self.smtp.send_message(email)
+
+    def close(self):
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()
+
+class OTPDeliveryQueue:
+    """A bounded queue of OTP emails and the worker threads that send them"""
+
+    def __init__(self, sink, workers=2, max_queue=10000, max_batch=50, batch_wait=0.05,
+                 max_attempts=5, backoff_seconds=0.5, max_backoff_seconds=30, idle_seconds=30):
+        self.sink = sink
+        self.max_batch = max_batch          # Most emails sent over one connection in one go
+        self.batch_wait = batch_wait        # How long to wait for more emails to fill a batch
+        self.max_attempts = max_attempts    # Give up on an email after this many failed sends
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.idle_seconds = idle_seconds    # Close a connection nobody has used for this long
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.retries = []                   # Heap of (when to retry, number, message)
+        self.retry_number = 0
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        self.pending = 0                    # Queued + waiting to retry + being sent
+        self.delivered = 0
+        self.failed = 0
+        self.retried = 0
+
+        self.stopping = threading.Event()
+        self.threads = [
+            threading.Thread(target=self._run, name=f"otp-delivery-{number}", daemon=True)
+            for number in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def enqueue(self, email, code, timeout=2.0):
+        """Queue an email, returns False if the queue stayed full for `timeout` seconds"""
+        with self.lock:
+            self.pending += 1
+        try:
+            self.queue.put(OTPMessage(email, code, time.monotonic(), 0), timeout=timeout)
+            return True
+        except queue.Full:
+            self._finished(1)
+            return False
+
+    def flush(self, timeout=None):
+        """Wait until every queued email has been sent or given up on, returns True if so"""
+        with self.done:
+            return self.done.wait_for(lambda: self.pending == 0, timeout)
+
+    def stop(self, timeout=10):
+        """Send what's left (waiting at most `timeout` seconds) and stop the workers"""
+        self.flush(timeout)
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queued": self.queue.qsize(),
+                "waiting_to_retry": len(self.retries),
+                "pending": self.pending,
+                "delivered": self.delivered,
+                "failed": self.failed,
+                "retried": self.retried,
+            }
+
+    def _finished(self, count):
+        with self.done:
+            self.pending -= count
+            if self.pending == 0:
+                self.done.notify_all()
+
+    def _due_retries(self, limit):
+        """Take retries whose time has come off the heap"""
+        due = []
+        with self.lock:
+            now = time.monotonic()
+            while self.retries and self.retries[0][0] <= now and len(due) < limit:
+                due.append(heapq.heappop(self.retries)[2])
+        return due
+
+    def _seconds_to_next_retry(self):
+        with self.lock:
+            if not self.retries:
+                return None
+            return max(0.0, self.retries[0][0] - time.monotonic())
+
+    def _next_batch(self):
+        """Collect up to max_batch emails: due retries first, then new ones"""
+        batch = self._due_retries(self.max_batch)
+
+        # Wait for the first new email only as long as nothing else needs doing
+        if not batch:
+            wait = self._seconds_to_next_retry()
+            wait = 0.5 if wait is None else min(wait, 0.5)  # Wake up now and then to check stopping
+            try:
+                batch.append(self.queue.get(timeout=wait))
+            except queue.Empty:
+                return batch
+
+        # Give other emails a moment to arrive so they share the connection
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _retry_later(self, message):
+        """Schedule another try, or give up after max_attempts"""
+        attempts = message.attempts + 1
+        if attempts >= self.max_attempts:
+            registry.observe("otp_delivery", time.monotonic() - message.queued_at, "failure")
+            with self.lock:
+                self.failed += 1
+            self._finished(1)
+            return
+
+        delay = min(self.backoff_seconds * 2 ** (attempts - 1), self.max_backoff_seconds)
+        with self.lock:
+            self.retry_number += 1
+            self.retried += 1
+            heapq.heappush(self.retries, (time.monotonic() + delay, self.retry_number,
+                                          message._replace(attempts=attempts)))
+
+    def _run(self):
+        connection = None
+        last_used = time.monotonic()
+
+        while not (self.stopping.is_set() and self.pending == 0):
+            batch = self._next_batch()
+
+            # Hang up connections that have been idle for a while
+            if not batch:
+                if connection is not None and time.monotonic() - last_used > self.idle_seconds:
+                    connection.close()
+                    connection = None
+                if self.stopping.is_set():
+                    break
+                continue
+
+            for index, message in enumerate(batch):
+                try:
+                    if connection is None:
+                        connection = self.sink.connect()
+                    connection.send(message)
+                except Exception:
+                    # The connection is probably broken: drop it and retry this email later
+                    if connection is not None:
+                        try:
+                            connection.close()
+                        except Exception:
+                            pass
+                        connection = None
+                    self._retry_later(message)
+                    continue
+
+                registry.observe("otp_delivery", time.monotonic() - message.queued_at, "success")
+                with self.lock:
+                    self.delivered += 1
+                self._finished(1)
+
+            last_used = time.monotonic()
+
+        if connection is not None:
+            connection.close()
+
+# The delivery queue send_otp_email uses (None means send straight away, like before)
+_delivery_queue = None
+
+def get_otp_delivery():
+    """Get the delivery queue currently in use (or None)"""
+    return _delivery_queue
+
+def start_otp_delivery(sink=None, **settings):
+    """Start sending OTP emails from background threads (console output unless a sink is given)"""
+    global _delivery_queue
+    stop_otp_delivery()
+    _delivery_queue = OTPDeliveryQueue(sink or ConsoleSink(), **settings)
+
+    # Send anything still queued before the program exits
+    atexit.register(stop_otp_delivery)
+    return _delivery_queue
+
+def stop_otp_delivery():
+    """Send what's still queued and stop the background threads"""
+    global _delivery_queue
+    if _delivery_queue is not None:
+        _delivery_queue.stop()
+        _delivery_queue = None
+
+def sink_from_setting(setting):
+    """Turn a --mail setting into a sink: "console", "file:PATH" or "smtp://host:port" """
+    if setting == "console":
+        return ConsoleSink()
+    if setting.startswith("file:"):
+        return FileSink(setting[len("file:"):] or "sent_mail.jsonl")
+    if setting.startswith("smtp://"):
+        host, _, port = setting[len("smtp://"):].partition(":")
+        return SMTPSink(host or "localhost", int(port or 25))
+    raise ValueError(f"Unknown mail setting: {setting}")
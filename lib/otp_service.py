@@ -1,7 +1,10 @@
 # This file handles OTP (One-Time Password) codes for secure login verification
 import random
 from datetime import datetime, timedelta
-from lib.models import OTP
+from lib.otp_store import SQLOTPStore
+from lib.throttle import get_login_throttle, otp_key
+from lib.metrics import timed
+from lib.otp_delivery import get_otp_delivery
 
 def generate_otp_code():
     """Create a random 6-digit number for OTP verification"""
@@ -11,75 +14,86 @@ def generate_otp_code():
     # Convert the number to a string and return it
     return str(random_number)
 
+# How long a code stays valid
+OTP_LIFETIME = timedelta(minutes=10)
+
+# Where codes are kept - the otp_codes table unless set_otp_store() picks another store
+_otp_store = SQLOTPStore()
+
+def get_otp_store():
+    """Get the store OTP codes are currently kept in"""
+    return _otp_store
+
+def set_otp_store(store):
+    """Choose where OTP codes are kept (for example MemoryOTPStore())"""
+    global _otp_store
+    _otp_store = store
+    return _otp_store
+
+@timed("create_new_otp")
 def create_new_otp(db, user_id):
     """Generate a new OTP code for a specific user"""
     
-    # Step 1: Find any old unused OTP codes for this user
-    old_otps = db.query(OTP).filter(
-        OTP.user_id == user_id,   
-         # For this specific user
-        OTP.is_used == False      
-         # That haven't been used yet
-    ).all()
-    
-    # Step 2: Mark all old OTP codes as used (so they can't be used anymore)
-    for old_otp in old_otps:
-        old_otp.is_used = True
-    
-    # Step 3: Generate a new 6-digit OTP code
-    code = generate_otp_code()
-    
-    # Step 4: Set expiration time (10 minutes from now)
+    # Step 1: Generate a new 6-digit OTP code (a TOTP store works out its own)
     current_time = datetime.now()
-    expires_at = current_time + timedelta(minutes=10)
+    code = _otp_store.make_code(user_id, current_time) or generate_otp_code()
     
-    # Step 5: Create a new OTP record in the database
-    new_otp = OTP(
-        user_id=user_id,           # Which user this OTP belongs to
-        code=code,                 # The 6-digit code
-        created_at=current_time,   # When it was created
-        expires_at=expires_at,     # When it expires (10 minutes later)
-        is_used=False              # It hasn't been used yet
-    )
+    # Step 2: Set expiration time (10 minutes from now)
+    expires_at = current_time + OTP_LIFETIME
     
-    # Step 6: Save the new OTP to the database
-    db.add(new_otp)   
-     # Add to database session
-    db.commit()       
-     # Save permanently
+    # Step 3: Save the code (this also cancels any older unused codes)
+    _otp_store.issue(db, user_id, code, current_time, expires_at)
     
-    # Step 7: Return the code so it can be sent to the user
+    # Step 4: Return the code so it can be sent to the user
     return code
 
+def otp_guess_allowed(user_id):
+    """False while this user is locked out for entering too many wrong codes"""
+    throttle = get_login_throttle()
+    return not (throttle and throttle.retry_after(otp_key(user_id)))
+
+def record_otp_result(user_id, correct):
+    """Count a wrong code against the user, or clear their count after a right one"""
+    throttle = get_login_throttle()
+    if throttle:
+        if correct:
+            throttle.reset(otp_key(user_id))
+        else:
+            throttle.record_failure(otp_key(user_id))
+
+@timed("verify_otp_code")
 def verify_otp_code(db, user_id, entered_code):
     """Check if the OTP code entered by the user is correct and valid"""
     
-    # Step 1: Find the OTP code in the database
-    otp = db.query(OTP).filter(
-        OTP.user_id == user_id,    # For this specific user
-        OTP.code == entered_code,  # With the code they entered
-        OTP.is_used == False       # That hasn't been used yet
-    ).first()
-    
-    # Step 2: Check if OTP exists and is not expired
-    if not otp:
-        # No matching OTP found
+    # Step 1: Too many wrong codes recently - refuse without looking the code up
+    if not otp_guess_allowed(user_id):
         return False
     
-    if otp.is_expired():
-        # OTP exists but has expired
-        return False
+    # Step 2: The store checks the code, the expiry time and marks it used in one go
+    correct = _otp_store.consume(db, user_id, entered_code)
     
-    # Step 3: OTP is valid! Mark it as used so it can't be used again
-    otp.is_used = True
-    db.commit()  # Save the change
-    
-    # Step 4: Return True to indicate successful verification
-    return True
+    # Step 3: A wrong code counts against this user, a right one clears the count
+    record_otp_result(user_id, correct)
+    return correct
+
+def get_otp_lockout_seconds(user_id):
+    """How many seconds until this user may enter OTP codes again, 0 if not locked"""
+    throttle = get_login_throttle()
+    if not throttle:
+        return 0
+    return throttle.retry_after(otp_key(user_id))
 
+@timed("send_otp_email")
 def send_otp_email(email, otp_code):
     """Send OTP code to user's email (simulated - prints to console)"""
     
+    # When the delivery queue is running, hand the email to it and return straight away
+    # (False means the queue is full and the email couldn't be queued)
+    delivery = get_otp_delivery()
+    if delivery is not None:
+        return delivery.enqueue(email, otp_code)
+    
+    # Otherwise send it here and now
     # In a real application, this would send an actual email
     # For this demo, we just print it to the console
     
@@ -0,0 +1,269 @@
+# This file decides where OTP codes are kept between "send code" and "check code"
+# There are three choices:
+#   SQLOTPStore    - the otp_codes table (the original behaviour, survives restarts)
+#   MemoryOTPStore - a dictionary in this process (no database work, codes vanish on restart)
+#   TOTPStore      - nothing is kept: codes are worked out from a secret and the time
+import hmac
+import math
+import heapq
+import struct
+import hashlib
+import secrets
+import itertools
+import threading
+from datetime import datetime
+from sqlalchemy import insert, update
+from lib.models import OTP
+
+class OTPStore:
+    """The methods every OTP store must have"""
+
+    def make_code(self, user_id, now):
+        """The code to send, or None to send a random one (only TOTPStore picks its own)"""
+        return None
+
+    def issue(self, db, user_id, code, created_at, expires_at):
+        """Save a new code for the user and cancel any codes they had before"""
+        raise NotImplementedError
+
+    def consume(self, db, user_id, code, now=None):
+        """Use up the code if it matches and hasn't expired, returns True/False"""
+        raise NotImplementedError
+
+class SQLOTPStore(OTPStore):
+    """Keeps OTP codes in the otp_codes table"""
+
+    def issue(self, db, user_id, code, created_at, expires_at):
+        # Step 1: Mark all old unused OTP codes for this user as used, with one UPDATE
+        db.execute(
+            update(OTP)
+            .where(
+                OTP.user_id == user_id,    # For this specific user
+                OTP.is_used == False       # That haven't been used yet
+            )
+            .values(is_used=True)
+            .execution_options(synchronize_session=False)
+        )
+
+        # Step 2: Insert the new OTP record
+        db.execute(insert(OTP).values(
+            user_id=user_id,           # Which user this OTP belongs to
+            code=code,                 # The 6-digit code
+            created_at=created_at,     # When it was created
+            expires_at=expires_at,     # When it expires (10 minutes later)
+            is_used=False              # It hasn't been used yet
+        ))
+
+        # Step 3: Save both changes permanently
+        db.commit()
+
+    def consume(self, db, user_id, code, now=None):
+        # One UPDATE finds the code and marks it used: it only matches a code that is
+        # for this user, unused and not expired - so the same code can't work twice
+        result = db.execute(
+            update(OTP)
+            .where(
+                OTP.user_id == user_id,                 # For this specific user
+                OTP.code == code,                       # With the code they entered
+                OTP.is_used == False,                   # That hasn't been used yet
+                OTP.expires_at >= (now or datetime.now())  # And hasn't expired
+            )
+            .values(is_used=True)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()  # Save the change
+
+        return result.rowcount > 0
+
+class MemoryOTPStore(OTPStore):
+    """Keeps OTP codes in memory, with expired codes thrown away automatically"""
+
+    def __init__(self, max_entries=100000):
+        # Most users we keep codes for at once (the oldest ones are dropped first)
+        self.max_entries = max_entries
+
+        # user_id -> (code, expires_at, entry number) - only the newest code counts
+        self.codes = {}
+
+        # Heap of (expires_at, entry number, user_id) so the next code to expire is always first
+        self.expiry_heap = []
+
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def _evict(self, now):
+        """Drop expired codes, and the soonest-to-expire ones if we're over the limit (lock held)"""
+        while self.expiry_heap:
+            expires_at, number, user_id = self.expiry_heap[0]
+            entry = self.codes.get(user_id)
+
+            # Heap entries for codes that were replaced or used are just skipped
+            if entry is None or entry[2] != number:
+                heapq.heappop(self.expiry_heap)
+                continue
+
+            if expires_at < now or len(self.codes) > self.max_entries:
+                heapq.heappop(self.expiry_heap)
+                del self.codes[user_id]
+                continue
+
+            break
+
+    def issue(self, db, user_id, code, created_at, expires_at):
+        with self.lock:
+            # The new code replaces whatever the user had before
+            number = next(self.counter)
+            self.codes[user_id] = (code, expires_at, number)
+            heapq.heappush(self.expiry_heap, (expires_at, number, user_id))
+            self._evict(created_at)
+
+            # Rebuild the heap now and then so replaced codes don't pile up in it
+            if len(self.expiry_heap) > 2 * len(self.codes) + 64:
+                self.expiry_heap = [(exp, num, uid) for uid, (_, exp, num) in self.codes.items()]
+                heapq.heapify(self.expiry_heap)
+
+    def consume(self, db, user_id, code, now=None):
+        now = now or datetime.now()
+
+        with self.lock:
+            self._evict(now)
+
+            entry = self.codes.get(user_id)
+            if entry is None:
+                return False
+
+            stored_code, expires_at, _ = entry
+            if stored_code != code or now > expires_at:
+                return False
+
+            # Remove it while holding the lock so the same code can never be used twice
+            del self.codes[user_id]
+            return True
+
+    def __len__(self):
+        return len(self.codes)
+
+def hotp(secret, counter, digits=6):
+    """RFC 4226 HOTP: an HMAC-SHA1 of the counter, cut down to `digits` decimal digits"""
+    digest = hmac.new(secret, struct.pack(">Q", counter), hashlib.sha1).digest()
+    offset = digest[-1] & 0x0F
+    number = struct.unpack(">I", digest[offset:offset + 4])[0] & 0x7FFFFFFF
+    return str(number % 10 ** digits).zfill(digits)
+
+class TOTPStore(OTPStore):
+    """Works codes out from a per-user secret and the time (RFC 6238 style), stores nothing
+
+    Time is cut into windows of step_seconds; the code for a window is HOTP(user secret,
+    window number). A code is accepted for drift_back windows after its own (so it lasts
+    about as long as OTP_LIFETIME) and drift_ahead windows before, for clocks that differ.
+    Each user's secret is HMAC-SHA256(master key, user id), so only the master key is kept.
+
+    To stop a code working twice, each user has a "floor": the lowest window still
+    accepted. Sending a code moves it up to that code's window (older codes stop working)
+    and using a code moves it past it. Floors live in this process only and are dropped
+    once every window they block has run out anyway (checked every 1000 codes sent or used).
+
+    Codes are only made for windows up to drift_ahead past now, since later ones couldn't
+    be checked yet. Someone who logs in more often than that (say three times in one
+    window) gets a random code instead, kept in memory like MemoryOTPStore does.
+    """
+
+    def __init__(self, master_key, step_seconds=30, drift_back=20, drift_ahead=1, digits=6):
+        self.master_key = master_key
+        self.step_seconds = step_seconds
+        self.drift_back = drift_back
+        self.drift_ahead = drift_ahead
+        self.digits = digits
+
+        self.floors = {}        # user_id -> lowest window number still accepted
+        self.spare_codes = {}   # user_id -> (random code, expires_at) when no window was free
+        self.lock = threading.Lock()
+        self.checks = 0
+
+    def _secret(self, user_id):
+        return hmac.new(self.master_key, f"otp-user:{user_id}".encode("ascii"), hashlib.sha256).digest()
+
+    def _window(self, now):
+        return int(now.timestamp() // self.step_seconds)
+
+    def _free_window(self, user_id, now):
+        """The window to send a code for, or None if every window we could check is used up (lock held)"""
+        now_window = self._window(now)
+        window = max(now_window, self.floors.get(user_id, 0))
+        return window if window <= now_window + self.drift_ahead else None
+
+    def make_code(self, user_id, now):
+        # Never hand out a code for a window that's already used up, or one too far ahead to check
+        with self.lock:
+            window = self._free_window(user_id, now)
+        if window is None:
+            return None
+        return hotp(self._secret(user_id), window, self.digits)
+
+    def issue(self, db, user_id, code, created_at, expires_at):
+        # Nothing to save - only remember that older codes for this user no longer count
+        with self.lock:
+            window = self._free_window(user_id, created_at)
+            self.spare_codes.pop(user_id, None)
+            if window is not None and hmac.compare_digest(hotp(self._secret(user_id), window, self.digits), code):
+                self.floors[user_id] = window
+            else:
+                # A random code (make_code had no window left): keep it, and cancel every
+                # window code that could still be checked
+                self.spare_codes[user_id] = (code, expires_at)
+                self.floors[user_id] = self._window(created_at) + self.drift_ahead + 1
+
+            # Codes that are sent but never used leave floors behind too
+            self._forget_old(created_at, self._window(created_at))
+
+    def consume(self, db, user_id, code, now=None):
+        # Only ever compare plain ASCII digits (compare_digest refuses other text)
+        if not isinstance(code, str) or len(code) != self.digits or not (code.isascii() and code.isdigit()):
+            return False
+
+        now = now or datetime.now()
+        now_window = self._window(now)
+        secret = self._secret(user_id)
+
+        with self.lock:
+            spare = self.spare_codes.get(user_id)
+            if spare and now <= spare[1] and hmac.compare_digest(spare[0], code):
+                del self.spare_codes[user_id]
+                return True
+
+            lowest = max(now_window - self.drift_back, self.floors.get(user_id, 0))
+
+            # Newest window first, since that's the code people usually type
+            for window in range(now_window + self.drift_ahead, lowest - 1, -1):
+                if hmac.compare_digest(hotp(secret, window, self.digits), code):
+                    self.floors[user_id] = window + 1
+                    self._forget_old(now, now_window)
+                    return True
+        return False
+
+    def _forget_old(self, now, now_window):
+        """Drop floors and spare codes that no longer matter (lock held), checked every 1000 issues or uses"""
+        self.checks += 1
+        if self.checks % 1000:
+            return
+        oldest_accepted = now_window - self.drift_back
+        self.floors = {user_id: floor for user_id, floor in self.floors.items() if floor > oldest_accepted}
+        self.spare_codes = {user_id: spare for user_id, spare in self.spare_codes.items() if spare[1] >= now}
+
+    def __len__(self):
+        return len(self.floors)
+
+def totp_store_from_config(lifetime_seconds, step_seconds=30):
+    """A TOTPStore whose master key is kept in auth_config.json (made on first use)
+
+    Every process sharing the config file derives the same codes.
+    """
+    from lib.config import load_config, save_config
+
+    key_hex = load_config().get("otp_master_key")
+    if not key_hex:
+        key_hex = secrets.token_hex(32)
+        save_config({"otp_master_key": key_hex})
+
+    return TOTPStore(bytes.fromhex(key_hex), step_seconds=step_seconds,
+                     drift_back=math.ceil(lifetime_seconds / step_seconds))
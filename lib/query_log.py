@@ -0,0 +1,184 @@
+# This file watches every SQL statement the program sends and writes the slow ones to a log
+# Each statement is timed and counted against the auth operation that sent it (login_user,
+# verify_otp_code, ...). Statements over the threshold are written as one JSON object per
+# line, together with SQLite's EXPLAIN QUERY PLAN, so a missing index shows up as "SCAN".
+#
+# Turn it on and off while the program runs with enable_query_log() / disable_query_log().
+import re
+import sys
+import json
+import time
+import threading
+from datetime import datetime
+from sqlalchemy import event
+from lib.metrics import current_operation
+
+# Statements slower than this many milliseconds are logged
+DEFAULT_THRESHOLD_MS = 50
+
+# Tables that should always be searched through an index. The first time a statement reads
+# one of them with a full table scan it is logged, however fast it was.
+WATCHED_TABLES = ("otp_codes", "login_attempts")
+
+# "SCAN otp_codes" is a full table scan; "SCAN otp_codes USING INDEX ..." walks an index
+_FULL_SCAN = re.compile(r"^SCAN (\w+)(?: AS \w+)?$")
+
+def full_scans(plan):
+    """Names of the tables a query plan reads from start to finish"""
+    tables = []
+    for step in plan or []:
+        match = _FULL_SCAN.match(step)
+        if match:
+            tables.append(match.group(1))
+    return tables
+
+class QueryLog:
+    """Times and counts statements on one engine (or a few) and logs the slow ones as JSON lines"""
+
+    def __init__(self, target_engine, threshold_ms=DEFAULT_THRESHOLD_MS, output=None,
+                 watched_tables=WATCHED_TABLES, other_engines=()):
+        self.engines = [target_engine] + [other for other in other_engines if other is not target_engine]
+        self.threshold = threshold_ms / 1000.0
+        self.output = output or sys.stderr    # Any file-like object with write()
+        self.watched_tables = set(watched_tables)
+
+        self.plans = {}        # statement text -> plan (the plan doesn't depend on the values)
+        self.reported = set()  # statements already logged for scanning a watched table
+        self.counts = {}       # operation -> [statements, total seconds, slow statements]
+        self.lock = threading.Lock()
+
+    def attach(self):
+        for engine in self.engines:
+            event.listen(engine, "before_cursor_execute", self._before)
+            event.listen(engine, "after_cursor_execute", self._after)
+            event.listen(engine, "handle_error", self._on_error)
+
+    def detach(self):
+        for engine in self.engines:
+            event.remove(engine, "before_cursor_execute", self._before)
+            event.remove(engine, "after_cursor_execute", self._after)
+            event.remove(engine, "handle_error", self._on_error)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_log_started", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        started_times = conn.info.get("query_log_started")
+        if not started_times:
+            return  # Started before the log was switched on
+        elapsed = time.perf_counter() - started_times.pop()
+        operation = current_operation() or "other"
+        slow = elapsed >= self.threshold
+
+        with self.lock:
+            totals = self.counts.setdefault(operation, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += elapsed
+            totals[2] += slow
+
+        # Only look at the plan for slow statements, or for ones we haven't planned yet
+        # that touch a watched table (EXPLAIN runs once per distinct statement)
+        watched = any(table in statement for table in self.watched_tables)
+        if not slow and not (watched and statement not in self.plans):
+            return
+
+        plan = self._plan(cursor, statement, parameters, executemany)
+        scanned = full_scans(plan)
+        scanned_watched = [table for table in scanned if table in self.watched_tables]
+
+        if slow:
+            self._write("slow_query", operation, elapsed, statement, plan, scanned)
+        elif scanned_watched and statement not in self.reported:
+            self.reported.add(statement)
+            self._write("full_scan", operation, elapsed, statement, plan, scanned)
+
+    def _on_error(self, context):
+        # Statements the database rejects (e.g. a unique constraint) still count
+        started_times = context.connection.info.get("query_log_started") if context.connection else None
+        if not started_times:
+            return
+        elapsed = time.perf_counter() - started_times.pop()
+        with self.lock:
+            totals = self.counts.setdefault(current_operation() or "other", [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += elapsed
+
+    def _plan(self, cursor, statement, parameters, executemany):
+        """EXPLAIN QUERY PLAN for a statement (remembered per statement), None if unavailable"""
+        if statement in self.plans:
+            return self.plans[statement]
+
+        plan = None
+        if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "INSERT", "WITH")):
+            if executemany:
+                parameters = parameters[0] if parameters else ()
+            try:
+                # A second cursor on the same connection, so the real result isn't disturbed
+                rows = cursor.connection.execute("EXPLAIN QUERY PLAN " + statement, parameters or ())
+                plan = [row[-1] for row in rows.fetchall()]
+            except Exception:
+                plan = None
+
+        # Statements with IN (...) lists come in many lengths, so don't let this grow forever
+        if len(self.plans) >= 1000:
+            self.plans.clear()
+        self.plans[statement] = plan
+        return plan
+
+    def _write(self, event_name, operation, elapsed, statement, plan, scanned):
+        # Parameter values are left out on purpose: they include password hashes and OTP codes
+        record = {
+            "time": datetime.now().isoformat(timespec="milliseconds"),
+            "event": event_name,
+            "operation": operation,
+            "ms": round(elapsed * 1000.0, 3),
+            "statement": " ".join(statement.split()),
+            "plan": plan,
+            "full_scans": scanned,
+        }
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.output.write(line)
+            self.output.flush()
+
+    def statement_counts(self):
+        """Statements, time and slow statements per operation so far"""
+        with self.lock:
+            return {
+                operation: {
+                    "statements": count,
+                    "total_ms": round(total * 1000.0, 3),
+                    "slow": slow,
+                }
+                for operation, (count, total, slow) in sorted(self.counts.items())
+            }
+
+# The query log that is switched on right now (None means off)
+_query_log = None
+
+def get_query_log():
+    """Get the query log currently in use (or None)"""
+    return _query_log
+
+def enable_query_log(threshold_ms=DEFAULT_THRESHOLD_MS, output=None, target_engine=None):
+    """Start timing every statement on the engine (the main database unless told otherwise)"""
+    global _query_log
+    other_engines = ()
+    if target_engine is None:
+        # Looked up now rather than at import, so a replaced engine is the one watched
+        # (together with the read-only engine, if the storage profile has one)
+        import lib.database
+        target_engine = lib.database.engine
+        other_engines = (lib.database.read_engine,)
+
+    disable_query_log()
+    _query_log = QueryLog(target_engine, threshold_ms, output, other_engines=other_engines)
+    _query_log.attach()
+    return _query_log
+
+def disable_query_log():
+    """Stop timing statements (the log file, if any, is left open for the caller to close)"""
+    global _query_log
+    if _query_log is not None:
+        _query_log.detach()
+        _query_log = None
@@ -0,0 +1,104 @@
+# This file deletes old rows so the otp_codes and login_attempts tables don't grow forever
+# Rows are deleted a small chunk at a time, each chunk in its own short transaction,
+# so logins never wait long for the SQLite write lock
+import time
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import delete, select
+from lib.models import OTP, LoginAttempt
+
+class RetentionPolicy:
+    """How long to keep old rows, and how gently to delete them"""
+
+    def __init__(self, otp_keep_hours=24, login_attempt_keep_days=90, chunk_size=500, pause_seconds=0.0):
+        self.otp_keep_hours = otp_keep_hours                    # Keep OTP codes this long after they expire
+        self.login_attempt_keep_days = login_attempt_keep_days  # Keep login attempts this many days
+        self.chunk_size = chunk_size                            # Rows deleted per transaction
+        self.pause_seconds = pause_seconds                      # Rest between chunks so others can write
+
+class PurgeReport:
+    """What one purge run did"""
+
+    def __init__(self):
+        self.otp_codes = 0       # OTP rows deleted
+        self.login_attempts = 0  # Login attempt rows deleted
+        self.seconds = 0.0       # How long it took
+
+    def as_dict(self):
+        return {"otp_codes": self.otp_codes, "login_attempts": self.login_attempts, "seconds": round(self.seconds, 3)}
+
+def _delete_in_chunks(session_factory, table, id_column, old_rows_filter, policy):
+    """Delete every row matching the filter, chunk_size rows per transaction, returns the count"""
+    total = 0
+
+    while True:
+        # Pick one chunk of ids (the index on the filter column keeps this cheap) and delete them
+        chunk_ids = select(id_column).where(old_rows_filter).limit(policy.chunk_size)
+        statement = delete(table).where(id_column.in_(chunk_ids))
+
+        db = session_factory()
+        try:
+            deleted = db.execute(statement).rowcount
+            db.commit()
+        finally:
+            db.close()
+
+        total += deleted
+        if deleted < policy.chunk_size:
+            return total
+
+        if policy.pause_seconds:
+            time.sleep(policy.pause_seconds)
+
+def purge_old_rows(session_factory, policy=None, now=None):
+    """Delete expired OTP codes and old login attempts, returns a PurgeReport"""
+    policy = policy or RetentionPolicy()
+    now = now or datetime.now()
+    report = PurgeReport()
+    started = time.perf_counter()
+
+    # Step 1: OTP codes that expired more than otp_keep_hours ago
+    otp_cutoff = now - timedelta(hours=policy.otp_keep_hours)
+    report.otp_codes = _delete_in_chunks(
+        session_factory, OTP, OTP.id, OTP.expires_at < otp_cutoff, policy
+    )
+
+    # Step 2: Login attempts older than login_attempt_keep_days
+    attempt_cutoff = now - timedelta(days=policy.login_attempt_keep_days)
+    report.login_attempts = _delete_in_chunks(
+        session_factory, LoginAttempt, LoginAttempt.id, LoginAttempt.timestamp < attempt_cutoff, policy
+    )
+
+    report.seconds = time.perf_counter() - started
+    return report
+
+class RetentionScheduler:
+    """Runs purge_old_rows every few minutes from a background thread"""
+
+    def __init__(self, session_factory, policy=None, interval_seconds=3600, on_report=None):
+        self.session_factory = session_factory
+        self.policy = policy or RetentionPolicy()
+        self.interval_seconds = interval_seconds
+        self.on_report = on_report              # Called with each PurgeReport (optional)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="retention", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def _run(self):
+        # Purge straight away, then once every interval until stopped
+        while not self.stopping.is_set():
+            try:
+                report = purge_old_rows(self.session_factory, self.policy)
+                if self.on_report:
+                    self.on_report(report)
+            except Exception as error:
+                print(f" Retention purge failed: {error}")
+            self.stopping.wait(self.interval_seconds)
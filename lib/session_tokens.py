@@ -0,0 +1,129 @@
+# This file makes and checks signed session tokens for logged-in users
+# After the OTP check the user gets a token instead of a database session. A token holds
+# the user id, when it was made, when it runs out and a random token id, plus an HMAC
+# signature. Checking it is pure computation: if the signature matches, the token is ours
+# and nobody changed it. Every dashboard action checks the token and opens its own short
+# database session, so idle logged-in users don't hold a connection.
+#
+# A token can be cancelled before it runs out (logout) through a deny list kept in memory.
+# Cancelled token ids are forgotten once the token would have expired anyway.
+import hmac
+import time
+import base64
+import struct
+import hashlib
+import secrets
+import threading
+from collections import namedtuple
+
+# How long a token lasts
+TOKEN_LIFETIME_SECONDS = 30 * 60
+
+# version, user id, issued at, expires at (unix seconds), random token id
+_PAYLOAD = struct.Struct(">BQIIQ")
+_VERSION = 1
+
+# What a valid token says
+TokenClaims = namedtuple("TokenClaims", ["user_id", "issued_at", "expires_at", "token_id"])
+
+def _encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+class SessionTokens:
+    """Issues, checks and cancels signed session tokens"""
+
+    def __init__(self, secret_key, lifetime_seconds=TOKEN_LIFETIME_SECONDS, clock=time.time):
+        self.secret_key = secret_key
+        self.lifetime_seconds = lifetime_seconds
+        self.clock = clock
+
+        self.denied = {}             # token id -> when it expires (cancelled tokens)
+        self.users_not_before = {}   # user id -> tokens issued before this time are cancelled
+        self.next_cleanup = 0.0
+        self.lock = threading.Lock()
+
+    def _sign(self, payload):
+        return hmac.new(self.secret_key, payload, hashlib.sha256).digest()
+
+    def issue(self, user_id):
+        """Make a new token for the user"""
+        now = int(self.clock())
+        payload = _PAYLOAD.pack(_VERSION, user_id, now, now + int(self.lifetime_seconds),
+                                secrets.randbits(64))
+        return _encode(payload) + "." + _encode(self._sign(payload))
+
+    def verify(self, token):
+        """Check a token, returns its TokenClaims or None if it's forged, expired or cancelled"""
+        try:
+            payload_text, signature_text = token.split(".")
+            payload = _decode(payload_text)
+            signature = _decode(signature_text)
+        except (ValueError, AttributeError):
+            return None
+
+        if len(payload) != _PAYLOAD.size or not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+
+        version, user_id, issued_at, expires_at, token_id = _PAYLOAD.unpack(payload)
+        if version != _VERSION or self.clock() >= expires_at:
+            return None
+
+        with self.lock:
+            if token_id in self.denied:
+                return None
+            if issued_at < self.users_not_before.get(user_id, 0):
+                return None
+
+        return TokenClaims(user_id, issued_at, expires_at, token_id)
+
+    def revoke(self, token):
+        """Cancel one token (for example on logout)"""
+        claims = self.verify(token)
+        if claims is None:
+            return
+        with self.lock:
+            self.denied[claims.token_id] = claims.expires_at
+            self._forget_expired()
+
+    def revoke_user(self, user_id):
+        """Cancel every token the user has now (for example when the account is deleted)"""
+        with self.lock:
+            # Tokens hold whole seconds, so anything issued up to this second is cancelled
+            self.users_not_before[user_id] = int(self.clock()) + 1
+            self._forget_expired()
+
+    def _forget_expired(self):
+        """Drop deny-list entries for tokens that have expired anyway (lock held, once a minute)"""
+        now = self.clock()
+        if now < self.next_cleanup:
+            return
+        self.next_cleanup = now + 60
+        self.denied = {token_id: expires for token_id, expires in self.denied.items() if expires > now}
+        oldest_live = now - self.lifetime_seconds
+        self.users_not_before = {user_id: when for user_id, when in self.users_not_before.items()
+                                 if when > oldest_live}
+
+# The token issuer the CLI uses (made on first use)
+_session_tokens = None
+
+def get_session_tokens():
+    """Get the token issuer, with its secret key kept in auth_config.json (made on first use)"""
+    global _session_tokens
+    if _session_tokens is None:
+        from lib.config import load_config, save_config
+
+        key_hex = load_config().get("session_key")
+        if not key_hex:
+            key_hex = secrets.token_hex(32)
+            save_config({"session_key": key_hex})
+        _session_tokens = SessionTokens(bytes.fromhex(key_hex))
+    return _session_tokens
+
+def set_session_tokens(session_tokens):
+    """Use a different token issuer (for example one with a shorter lifetime)"""
+    global _session_tokens
+    _session_tokens = session_tokens
+    return _session_tokens
@@ -0,0 +1,314 @@
+# This file spreads users over several SQLite files ("shards") so writes don't all queue
+# behind one file lock
+# Every user lives in exactly one shard, together with their OTP codes and login attempts,
+# so all the usual functions in lib/auth.py and lib/otp_service.py work unchanged on a
+# session for that shard. A small directory database sits in front of the shards:
+#   - it hands out user ids, so ids are unique across all shards
+#   - it holds every username and email, so those stay unique across all shards
+#   - it remembers which shard each user is on
+# A new user goes to shard number hash(user id) % shard count. Changing the count moves
+# users with rebalance_shards() (run it while nothing else is using the shards).
+import os
+import hashlib
+from sqlalchemy import (
+    MetaData, Table, Column, Integer, String,
+    select, insert, update, delete, func
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from lib.database import create_all_tables, build_engine, STORAGE_PROFILES
+from lib.models import User, OTP, LoginAttempt
+from lib.auth import (
+    try_register_user, login_user, log_successful_login, update_user_info,
+    delete_user_account, _conflicting_field
+)
+from lib.otp_service import create_new_otp, verify_otp_code
+from lib.history import get_login_history
+
+# Where the directory and shard files go unless told otherwise
+SHARD_FOLDER = "shards"
+
+# The directory's own tables (kept out of Base so they're never created inside a shard)
+directory_metadata = MetaData()
+
+user_directory = Table(
+    "user_directory", directory_metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),  # The user's id on every shard
+    Column("username", String(50), unique=True, nullable=False),
+    Column("email", String(100), unique=True, nullable=False),
+    Column("shard", Integer, nullable=False),                     # Which shard holds the user
+    sqlite_autoincrement=True,                                    # Never reuse a deleted user's id
+)
+
+shard_files = Table(
+    "shard_files", directory_metadata,
+    Column("number", Integer, primary_key=True),
+    Column("path", String(255), nullable=False),
+)
+
+def shard_number(user_id, shard_count):
+    """Which shard a user belongs on (a stable hash, so it's the same in every process)"""
+    digest = hashlib.blake2b(str(user_id).encode("ascii"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % shard_count
+
+def _open_engine(path, busy_timeout):
+    """Engine for one SQLite file, in WAL mode so readers don't block the writer"""
+    profile = STORAGE_PROFILES["concurrent"]._replace(busy_timeout=busy_timeout)
+    return build_engine(path, profile)
+
+class ShardSet:
+    """The directory database plus one engine and session factory per shard"""
+
+    def __init__(self, folder=SHARD_FOLDER, shard_count=None, busy_timeout=30):
+        """Open the shards in folder, creating shard_count of them if there are none yet"""
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.busy_timeout = busy_timeout
+
+        self.directory_engine = _open_engine(os.path.join(folder, "directory.db"), busy_timeout)
+        directory_metadata.create_all(self.directory_engine)
+        self.Directory = sessionmaker(bind=self.directory_engine, expire_on_commit=False)
+
+        with self.directory_engine.begin() as connection:
+            known = connection.execute(select(func.count()).select_from(shard_files)).scalar()
+            if not known:
+                for number in range(shard_count or 1):
+                    connection.execute(insert(shard_files).values(number=number, path=self._shard_path(number)))
+
+        self.engines = []
+        self.Sessions = []
+        self._open_shards()
+
+    def _shard_path(self, number):
+        return os.path.join(self.folder, f"shard_{number}.db")
+
+    def _open_shards(self):
+        """(Re)open an engine and session factory for every shard listed in the directory"""
+        for engine in self.engines:
+            engine.dispose()
+
+        with self.directory_engine.connect() as connection:
+            paths = [path for number, path in connection.execute(
+                select(shard_files.c.number, shard_files.c.path).order_by(shard_files.c.number))]
+
+        self.engines = [_open_engine(path, self.busy_timeout) for path in paths]
+        for engine in self.engines:
+            create_all_tables(engine)
+        self.Sessions = [sessionmaker(bind=engine, expire_on_commit=False) for engine in self.engines]
+
+    @property
+    def count(self):
+        return len(self.engines)
+
+    def session(self, number):
+        """A new session on one shard"""
+        return self.Sessions[number]()
+
+    def locate(self, email=None, user_id=None):
+        """Find a user in the directory by email or id, returns (user id, shard) or None"""
+        query = select(user_directory.c.id, user_directory.c.shard)
+        if email is not None:
+            query = query.where(user_directory.c.email == email)
+        else:
+            query = query.where(user_directory.c.id == user_id)
+
+        with self.directory_engine.connect() as connection:
+            row = connection.execute(query).first()
+        return (row.id, row.shard) if row else None
+
+    def close(self):
+        """Close every database connection"""
+        for engine in self.engines:
+            engine.dispose()
+        self.directory_engine.dispose()
+
+class ShardedAuthService:
+    """Register, login, OTP, history, profile and delete on top of a ShardSet"""
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    def register(self, username, email, password):
+        """Create a new user account, returns (user, None) or (None, "username"/"email") if taken"""
+        # Step 1: Reserve the username and email in the directory (this also picks the id)
+        try:
+            with self.shards.directory_engine.begin() as connection:
+                user_id = connection.execute(
+                    insert(user_directory).values(username=username, email=email, shard=-1)
+                ).inserted_primary_key[0]
+                shard = shard_number(user_id, self.shards.count)
+                connection.execute(update(user_directory).where(user_directory.c.id == user_id).values(shard=shard))
+        except IntegrityError as error:
+            return None, _conflicting_field(error)
+
+        # Step 2: Create the account on its shard; give the names back if that fails
+        with self.shards.session(shard) as db:
+            try:
+                user, taken = try_register_user(db, username, email, password, user_id=user_id)
+            except Exception:
+                self._release(user_id)
+                raise
+        if user is None:
+            self._release(user_id)
+        return user, taken
+
+    def _release(self, user_id):
+        with self.shards.directory_engine.begin() as connection:
+            connection.execute(delete(user_directory).where(user_directory.c.id == user_id))
+
+    def login(self, email, password):
+        """Check email and password, returns the user or None"""
+        location = self.shards.locate(email=email)
+
+        # Unknown emails still go through login_user (on the first shard) so they're throttled
+        shard = location[1] if location else 0
+        with self.shards.session(shard) as db:
+            return login_user(db, email, password)
+
+    def log_successful_login(self, user_id):
+        with self._user_session(user_id) as db:
+            log_successful_login(db, user_id)
+
+    def issue_otp(self, user_id):
+        """Make a new OTP code for the user, returns the code"""
+        with self._user_session(user_id) as db:
+            return create_new_otp(db, user_id)
+
+    def verify_otp(self, user_id, code):
+        with self._user_session(user_id) as db:
+            return verify_otp_code(db, user_id, code)
+
+    def login_history(self, user_id, limit=10, before=None, successful=None):
+        """One page of the user's login attempts (see lib/history.py)"""
+        with self._user_session(user_id) as db:
+            return get_login_history(db, user_id, limit, before, successful)
+
+    def update_user(self, user, new_username=None, new_email=None, new_password=None):
+        """Change the profile, returns the fields that were already taken"""
+        # Step 1: Claim new names in the directory, dropping any that another user has
+        changes = {}
+        if new_username:
+            changes["username"] = new_username
+        if new_email:
+            changes["email"] = new_email
+
+        taken = []
+        while changes:
+            try:
+                with self.shards.directory_engine.begin() as connection:
+                    connection.execute(update(user_directory).where(user_directory.c.id == user.id).values(**changes))
+                break
+            except IntegrityError as error:
+                field = _conflicting_field(error)
+                if field not in changes:
+                    raise
+                taken.append(field)
+                del changes[field]
+
+        # Step 2: Save what's left on the user's shard
+        with self._user_session(user.id) as db:
+            db.add(user)
+            taken += update_user_info(db, user, changes.get("username"), changes.get("email"), new_password)
+        return taken
+
+    def delete_user(self, user_id):
+        """Delete the account with its OTP codes and login attempts, returns False if not found"""
+        with self._user_session(user_id) as db:
+            user = db.get(User, user_id)
+            if user is None:
+                return False
+            delete_user_account(db, user)
+        self._release(user_id)
+        return True
+
+    def _user_session(self, user_id):
+        location = self.shards.locate(user_id=user_id)
+        if location is None:
+            raise KeyError(f"No user with id {user_id}")
+        return self.shards.session(location[1])
+
+def _copy_user(source, target, user_id):
+    """Copy one user's rows to another shard, replacing anything left there by an earlier try"""
+    user = source.execute(select(User.__table__).where(User.id == user_id)).mappings().first()
+    if user is None:
+        return False
+
+    # Let the target pick new ids for OTP codes and login attempts (ids are per shard)
+    otp_rows = [dict(row) for row in source.execute(
+        select(OTP.user_id, OTP.code, OTP.created_at, OTP.expires_at, OTP.is_used)
+        .where(OTP.user_id == user_id)).mappings()]
+    attempt_rows = [dict(row) for row in source.execute(
+        select(LoginAttempt.user_id, LoginAttempt.timestamp, LoginAttempt.successful)
+        .where(LoginAttempt.user_id == user_id)).mappings()]
+
+    target.execute(delete(OTP).where(OTP.user_id == user_id))
+    target.execute(delete(LoginAttempt).where(LoginAttempt.user_id == user_id))
+    target.execute(delete(User).where(User.id == user_id))
+    target.execute(insert(User), [dict(user)])
+    if otp_rows:
+        target.execute(insert(OTP), otp_rows)
+    if attempt_rows:
+        target.execute(insert(LoginAttempt), attempt_rows)
+    return True
+
+def _remove_user(source, user_id):
+    source.execute(delete(OTP).where(OTP.user_id == user_id))
+    source.execute(delete(LoginAttempt).where(LoginAttempt.user_id == user_id))
+    source.execute(delete(User).where(User.id == user_id))
+
+def rebalance_shards(shards, new_count, on_move=None):
+    """Change the number of shards and move every user whose shard changes
+
+    Each user is copied to the new shard, then the directory is pointed at it, then the
+    old rows are deleted - so stopping half way and running it again is safe.
+    Returns {"moved": n, "shards": {number: users}}.
+    """
+    old_count = shards.count
+
+    # Step 1: Add the new shard files first when growing
+    if new_count > old_count:
+        with shards.directory_engine.begin() as connection:
+            for number in range(old_count, new_count):
+                connection.execute(insert(shard_files).prefix_with("OR IGNORE").values(
+                    number=number, path=shards._shard_path(number)))
+        shards._open_shards()
+
+    # Step 2: Move everyone whose hash now points somewhere else
+    with shards.directory_engine.connect() as connection:
+        placements = connection.execute(select(user_directory.c.id, user_directory.c.shard)).all()
+
+    moved = 0
+    for user_id, current in placements:
+        wanted = shard_number(user_id, new_count)
+        if wanted == current or current < 0:
+            continue
+
+        with shards.engines[current].connect() as source, shards.engines[wanted].begin() as target:
+            copied = _copy_user(source, target, user_id)
+        if not copied:
+            continue
+        with shards.directory_engine.begin() as connection:
+            connection.execute(update(user_directory).where(user_directory.c.id == user_id).values(shard=wanted))
+        with shards.engines[current].begin() as source:
+            _remove_user(source, user_id)
+
+        moved += 1
+        if on_move:
+            on_move(user_id, current, wanted)
+
+    # Step 3: Forget shards that are no longer used when shrinking (their files stay on disk)
+    if new_count < old_count:
+        with shards.directory_engine.begin() as connection:
+            connection.execute(delete(shard_files).where(shard_files.c.number >= new_count))
+        shards._open_shards()
+
+    return {"moved": moved, "shards": shard_sizes(shards)}
+
+def shard_sizes(shards):
+    """How many users the directory has on each shard"""
+    with shards.directory_engine.connect() as connection:
+        rows = connection.execute(
+            select(user_directory.c.shard, func.count()).group_by(user_directory.c.shard)).all()
+    sizes = {number: 0 for number in range(shards.count)}
+    sizes.update({shard: users for shard, users in rows})
+    return sizes
@@ -0,0 +1,111 @@
+# This file slows down password guessing
+# Failed logins are counted in memory per email and per user id over a sliding time window.
+# Once a key has too many recent failures, attempts are refused before any bcrypt work
+# or database write happens.
+import time
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+
+def email_key(email):
+    """Throttle key for login attempts against an email address"""
+    return "email:" + email.strip().lower()
+
+def user_key(user_id):
+    """Throttle key for login attempts against a user account"""
+    return f"user:{user_id}"
+
+def otp_key(user_id):
+    """Throttle key for OTP guesses against a user account"""
+    return f"otp:{user_id}"
+
+class LoginThrottle:
+    """Sliding-window failure counters with a lockout once the limit is reached"""
+
+    def __init__(self, max_failures=5, window_seconds=900, max_keys=100000, clock=time.time):
+        self.max_failures = max_failures      # Failures allowed inside the window
+        self.window_seconds = window_seconds  # How far back failures count
+        self.max_keys = max_keys              # Most keys remembered (least recently used go first)
+        self.clock = clock
+
+        # key -> deque of failure times (oldest first), in least-recently-used order
+        self.failures = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _recent(self, key, now):
+        """Failure times for a key inside the window, dropping older ones (lock held)"""
+        times = self.failures.get(key)
+        if times is None:
+            return None
+
+        while times and times[0] <= now - self.window_seconds:
+            times.popleft()
+
+        if not times:
+            # Nothing recent - forget the key completely
+            del self.failures[key]
+            return None
+        return times
+
+    def retry_after(self, key):
+        """Seconds until this key may try again (0 means it isn't locked out)"""
+        now = self.clock()
+        with self.lock:
+            times = self._recent(key, now)
+            if times is None or len(times) < self.max_failures:
+                return 0
+
+            # Locked until enough old failures slide out of the window
+            unlock_at = times[-self.max_failures] + self.window_seconds
+            return max(0.0, unlock_at - now)
+
+    def record_failure(self, key, when=None):
+        """Count one failed attempt for this key"""
+        when = when or self.clock()
+        with self.lock:
+            times = self._recent(key, when)
+            if times is None:
+                times = deque(maxlen=self.max_failures)
+                self.failures[key] = times
+            times.append(when)
+            self.failures.move_to_end(key)
+
+            # Forget the least recently used keys once we hold too many
+            while len(self.failures) > self.max_keys:
+                self.failures.popitem(last=False)
+
+    def reset(self, key):
+        """Forget the failures for this key (after a successful login)"""
+        with self.lock:
+            self.failures.pop(key, None)
+
+    def seed_from_database(self, db):
+        """Load recent failed logins from login_attempts, e.g. right after startup"""
+        from lib.models import User, LoginAttempt
+
+        cutoff = datetime.now() - timedelta(seconds=self.window_seconds)
+        rows = db.query(LoginAttempt.user_id, User.email, LoginAttempt.timestamp).join(User).filter(
+            LoginAttempt.successful == False,
+            LoginAttempt.timestamp >= cutoff
+        ).order_by(LoginAttempt.timestamp).all()
+
+        # Database times are local datetimes; turn them into the clock's seconds
+        offset = self.clock() - datetime.now().timestamp()
+        for user_id, email, timestamp in rows:
+            when = timestamp.timestamp() + offset
+            self.record_failure(user_key(user_id), when)
+            self.record_failure(email_key(email), when)
+        return len(rows)
+
+# The throttle used by login_user and verify_otp_code (None turns throttling off)
+_login_throttle = LoginThrottle()
+
+def get_login_throttle():
+    """Get the throttle logins currently go through"""
+    return _login_throttle
+
+def set_login_throttle(throttle):
+    """Use a different throttle, or None to turn throttling off"""
+    global _login_throttle
+    _login_throttle = throttle
+    return _login_throttle
@@ -0,0 +1,124 @@
+# This file keeps recently used user rows in memory so looking a user up by id (checking a
+# session token, profile views and the dashboard) doesn't have to ask the database every time
+# Entries are read-only snapshots; any change to a user goes through update_user_info or
+# delete_user_account, which throw the cached copy away. A short time limit (TTL) also
+# covers changes made by other programs. Login is not served from the cache: login_user
+# reads the row by email every time (one indexed query), so a stale entry can't let an old
+# password or a deleted account in. It only puts the fresh row in for the lookups above.
+import time
+import threading
+from collections import OrderedDict, namedtuple
+from sqlalchemy.orm import make_transient_to_detached
+from lib.models import User
+
+# A read-only copy of one row of the users table
+UserSnapshot = namedtuple("UserSnapshot", ["id", "username", "email", "password", "created_at"])
+
+def snapshot_of(user):
+    """Copy the columns of a User into a UserSnapshot"""
+    return UserSnapshot(user.id, user.username, user.email, user.password, user.created_at)
+
+class UserCache:
+    """Least-recently-used cache of user snapshots, looked up by id"""
+
+    def __init__(self, bind, max_entries=10000, ttl_seconds=60, clock=time.monotonic):
+        self.bind = bind                # The engine whose users table is cached
+        self.max_entries = max_entries  # Most users kept at once
+        self.ttl_seconds = ttl_seconds  # How long an entry can be used before it's re-read
+        self.clock = clock
+
+        self.by_id = OrderedDict()      # user id -> (snapshot, time stored), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def covers(self, db):
+        """True if this cache describes the database the session talks to"""
+        return db.get_bind() is self.bind
+
+    def _lookup(self, user_id):
+        """Find a fresh entry and mark it recently used (lock held)"""
+        entry = self.by_id.get(user_id)
+        if entry is None:
+            return None
+
+        snapshot, stored_at = entry
+        if self.clock() - stored_at > self.ttl_seconds:
+            self._remove(user_id)
+            return None
+
+        self.by_id.move_to_end(user_id)
+        return snapshot
+
+    def _remove(self, user_id):
+        """Drop one entry (lock held)"""
+        self.by_id.pop(user_id, None)
+
+    def get_by_id(self, user_id):
+        with self.lock:
+            snapshot = self._lookup(user_id)
+            if snapshot is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return snapshot
+
+    def put(self, user):
+        """Remember a user that was just read from the database"""
+        snapshot = snapshot_of(user)
+        with self.lock:
+            self._remove(snapshot.id)
+            self.by_id[snapshot.id] = (snapshot, self.clock())
+
+            # Forget the least recently used users once we hold too many
+            while len(self.by_id) > self.max_entries:
+                oldest_id = next(iter(self.by_id))
+                self._remove(oldest_id)
+
+    def invalidate(self, user_id):
+        """Forget a user (call this whenever their row changes)"""
+        with self.lock:
+            self._remove(user_id)
+
+    def stats(self):
+        """Hit and miss counters"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.by_id),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+def user_from_snapshot(db, snapshot):
+    """Turn a snapshot back into a User attached to the session, without a query"""
+    user = User(
+        id=snapshot.id,
+        username=snapshot.username,
+        email=snapshot.email,
+        password=snapshot.password,
+        created_at=snapshot.created_at,
+    )
+
+    # Mark it as an already-saved row, then hand it to the session without reloading it
+    make_transient_to_detached(user)
+    return db.merge(user, load=False)
+
+# The cache get_user_by_id uses, and login_user fills (None means always ask the database)
+_user_cache = None
+
+def get_user_cache():
+    """Get the cache currently in use (or None)"""
+    return _user_cache
+
+def enable_user_cache(db, max_entries=10000, ttl_seconds=60):
+    """Start caching users of the database this session talks to"""
+    global _user_cache
+    _user_cache = UserCache(db.get_bind(), max_entries, ttl_seconds)
+    return _user_cache
+
+def disable_user_cache():
+    """Stop caching users"""
+    global _user_cache
+    _user_cache = None
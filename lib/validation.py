@@ -0,0 +1,45 @@
+# This file holds the rules for what a valid username, email and password look like
+# The menus, the bulk importer and batch mode all check new accounts with these, so an
+# account that can't be registered by hand can't sneak in any other way.
+
+# Shortest allowed username and password
+MIN_USERNAME_LENGTH = 3
+MIN_PASSWORD_LENGTH = 6
+
+def is_valid_email(email):
+    """Check if email has correct format"""
+    # Email must have @ symbol
+    if "@" not in email:
+        return False
+
+    # Split email into name and domain parts
+    name, _, domain = email.partition("@")
+
+    # Domain must have a dot (like .com, .org)
+    if "." not in domain:
+        return False
+
+    # Both name and domain must exist
+    if not name or not domain:
+        return False
+
+    return True
+
+def problem_with_new_user(fields):
+    """Return why a new account's fields (a dictionary) can't be used, or None if they look fine"""
+    # Missing fields count as empty; anything that isn't text (numbers, lists, ...) is refused
+    for name in ("username", "email", "password"):
+        if not isinstance(fields.get(name) or "", str):
+            return f"{name} must be text"
+
+    username = (fields.get("username") or "").strip()
+    email = (fields.get("email") or "").strip()
+    password = (fields.get("password") or "").strip()
+
+    if len(username) < MIN_USERNAME_LENGTH:
+        return "username too short"
+    if not is_valid_email(email):
+        return "invalid email"
+    if len(password) < MIN_PASSWORD_LENGTH:
+        return "password too short"
+    return None
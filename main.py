@@ -2,33 +2,427 @@
 """
 This is the main file - the starting point of our authentication system program
 When you run "python main.py", this is the file that gets executed first
+
+Run it with no arguments for the interactive menus, or with a command
+(--storage picks the database settings, see lib/database.py):
+    python main.py import users.csv      Add many users at once from a CSV or JSONL file
+    python main.py purge                 Delete expired OTP codes and old login attempts
+    python main.py calibrate             Pick the bcrypt cost for this machine
+    python main.py export-history EMAIL  Write one account's whole login history to a file
+    python main.py rebuild-stats         Count the login totals again from the login history
+    python main.py batch commands.jsonl  Run register/login/verify-otp/history/delete commands from JSON lines
+    python main.py health                Check the database file is there and up to date
+    python main.py shards status         Show (or create/rebalance) the sharded database files
+    python main.py mail-sink             Stand-in SMTP server that saves OTP emails to a file
 """
+import sys
+import json
+import time
+import atexit
+import argparse
 
-# Import the functions we need from other files
-from lib.database import create_all_tables
-from lib.cli import start_cli
+# The rest of the program (SQLAlchemy, bcrypt, the models) is imported inside the functions
+# that need it, so quick commands like "health" or "--help" start without loading it all
+
+def prepare_database():
+    """Create or upgrade the database file, unless it's already on the latest schema"""
+    from lib.config import DATABASE_PATH
+    from lib.migrations import schema_is_current
+
+    # Reading the version stamp only needs the standard library's sqlite3
+    if schema_is_current(DATABASE_PATH):
+        return False
+
+    from lib.database import create_all_tables
+    create_all_tables()
+    return True
+
+def start_services(mail_sink=None):
+    """Start the background helpers the menus and batch mode both use"""
+    from lib.database import session_scope
+    from lib.otp_delivery import start_otp_delivery
+    from lib.audit import start_audit_writer
+    from lib.user_cache import enable_user_cache
+
+    # Save login attempts in the background so logins don't wait on the database
+    start_audit_writer()
+
+    # Send OTP emails in the background so logins don't wait on the mail server
+    if mail_sink is not None:
+        start_otp_delivery(mail_sink)
+
+    # Remember recent failed logins from before the restart
+    seed_login_throttle()
+
+    # Load (or build) the Bloom filter of usernames and emails
+    load_user_filter()
+
+    # Keep recently used accounts in memory
+    with session_scope() as db:
+        enable_user_cache(db)
+
+def run_interactive(mail_setting="console"):
+    """Start the menus that users click through"""
+    from lib.otp_delivery import sink_from_setting
+    from lib.cli import start_cli
 
-def main():
-    """This is the main function that starts our entire authentication system"""
-    
     # Step 1: Welcome message to let user know the program is starting
     print(" Starting Authentication System...")
     print("Setting up the system for you...")
-    
+
     # Step 2: Create the database tables if they don't exist yet
     # This creates the users, otp_codes, and login_attempts tables
-    create_all_tables()
+    prepare_database()
     print(" Database is ready!")
-    
+
+    # Printing emails to the console is instant (and keeps the email above the code prompt),
+    # so only other kinds of mail go through the background queue
+    start_services(None if mail_setting == "console" else sink_from_setting(mail_setting))
+
     # Step 3: Start the command line interface (the menus and user interaction)
     # This is where users can register, login, and manage their accounts
     print("Starting the main program...")
     start_cli()
-    
+
     # Step 4: Program has ended
     print("Authentication system has been closed. Goodbye!")
 
+def seed_login_throttle():
+    """Load recent failed logins into the login throttle"""
+    from lib.database import session_scope
+    from lib.throttle import get_login_throttle
+
+    throttle = get_login_throttle()
+    if throttle:
+        with session_scope(read_only=True) as db:
+            throttle.seed_from_database(db)
+
+def load_user_filter():
+    """Start the username/email Bloom filter and save it again when the program exits"""
+    from lib.database import session_scope, storage_profile
+    from lib.bloom import enable_user_filter, save_user_filter
+
+    # An in-memory database starts empty each run, so its filter is never saved (that
+    # would overwrite the one that belongs to auth_system.db)
+    if storage_profile.in_memory:
+        with session_scope() as db:
+            enable_user_filter(db, path=None)
+        return
+
+    with session_scope() as db:
+        enable_user_filter(db)
+
+    def save_on_exit():
+        with session_scope() as db:
+            save_user_filter(db)
+
+    atexit.register(save_on_exit)
+
+# Commands that use the main database (None is the interactive menus)
+DATABASE_COMMANDS = (None, "import", "purge", "export-history", "rebuild-stats", "batch")
+
+def open_storage(name, connections=None):
+    """Use one of the storage profiles in lib/database.py for this run"""
+    from lib.database import use_storage
+    use_storage(name, connections=connections)
+
+def start_query_log(path, slow_ms):
+    """Log slow SQL statements (with their query plans) to a file or stderr"""
+    from lib.query_log import enable_query_log
+
+    output = sys.stderr if path == "-" else open(path, "a")
+    enable_query_log(threshold_ms=slow_ms, output=output)
+
+def choose_otp_store(name):
+    """Keep OTP codes somewhere other than the otp_codes table"""
+    from lib.otp_service import set_otp_store, OTP_LIFETIME
+    from lib.otp_store import MemoryOTPStore, totp_store_from_config
+
+    if name == "memory":
+        set_otp_store(MemoryOTPStore())
+    elif name == "totp":
+        set_otp_store(totp_store_from_config(OTP_LIFETIME.total_seconds()))
+
+def run_import(args):
+    """Import users from a file and print a summary"""
+    from lib.database import session_scope
+    from lib.bulk_import import import_users_from_file
+
+    prepare_database()
+
+    # Rows that can't be imported are written to stderr (or a file) as JSON lines
+    problems_file = open(args.problems, "w") if args.problems else sys.stderr
+
+    def report_problem(line_number, row, reason):
+        problem = {"line": line_number, "username": row.get("username"), "email": row.get("email"), "reason": reason}
+        problems_file.write(json.dumps(problem) + "\n")
+
+    try:
+        with session_scope() as db:
+            report = import_users_from_file(db, args.path, args.format, args.chunk_size, report_problem)
+    finally:
+        if problems_file is not sys.stderr:
+            problems_file.close()
+
+    print(json.dumps(report.as_dict()))
+
+def run_purge(args):
+    """Delete old rows once, or keep doing it every few seconds with --every"""
+    from lib.database import SessionLocal
+    from lib.retention import RetentionPolicy, RetentionScheduler, purge_old_rows
+
+    prepare_database()
+    policy = RetentionPolicy(
+        otp_keep_hours=args.otp_hours,
+        login_attempt_keep_days=args.attempt_days,
+        chunk_size=args.chunk_size,
+        pause_seconds=args.pause,
+    )
+
+    if not args.every:
+        print(json.dumps(purge_old_rows(SessionLocal, policy).as_dict()))
+        return
+
+    # Keep purging in the background until someone presses Ctrl+C
+    scheduler = RetentionScheduler(SessionLocal, policy, args.every,
+                                   on_report=lambda report: print(json.dumps(report.as_dict()), flush=True))
+    scheduler.start()
+    try:
+        while scheduler.thread.is_alive():
+            scheduler.thread.join(timeout=1)
+    except KeyboardInterrupt:
+        scheduler.stop()
+
+def run_calibrate(args):
+    """Measure bcrypt on this machine and save the cost that fits the time budget"""
+    from lib.hashing import calibrate_bcrypt_rounds
+
+    rounds, elapsed_ms = calibrate_bcrypt_rounds(args.target_ms, save=not args.dry_run)
+    over_budget = elapsed_ms > args.target_ms
+    print(json.dumps({"bcrypt_rounds": rounds, "hash_ms": round(elapsed_ms, 1),
+                      "over_budget": over_budget, "saved": not args.dry_run}))
+
+    # Even the lowest allowed cost is too slow here - say so instead of looking like success
+    if over_budget:
+        print(f"Warning: the lowest cost ({rounds} rounds) takes {elapsed_ms:.1f} ms, "
+              f"more than the {args.target_ms} ms target", file=sys.stderr)
+
+def run_export_history(args):
+    """Stream one account's login history to a file or stdout"""
+    from lib.database import session_scope
+    from lib.models import User
+    from lib.history import export_login_history
+
+    prepare_database()
+    with session_scope(read_only=True) as db:
+        user = db.query(User).filter(User.email == args.email).first()
+        if user is None:
+            print(f"No account with email {args.email}", file=sys.stderr)
+            sys.exit(1)
+
+        successful = {"all": None, "success": True, "failure": False}[args.only]
+        output = open(args.output, "w", newline="") if args.output else sys.stdout
+        try:
+            count = export_login_history(db, user.id, output, args.format, successful)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+    print(json.dumps({"email": args.email, "exported": count}), file=sys.stderr)
+
+def run_rebuild_stats(args):
+    """Work the login_stats tables out again from login_attempts"""
+    from lib.database import session_scope
+    from lib.models import User
+    from lib.login_stats import rebuild_login_stats
+
+    prepare_database()
+    started = time.perf_counter()
+    with session_scope() as db:
+        user_id = None
+        if args.email:
+            user_id = db.query(User.id).filter(User.email == args.email).scalar()
+            if user_id is None:
+                print(f"No account with email {args.email}", file=sys.stderr)
+                sys.exit(1)
+        report = rebuild_login_stats(db, user_id)
+
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    print(json.dumps(report))
+
+def run_batch(args):
+    """Run commands from a JSON lines file (or stdin) and write one result line for each"""
+    from lib.database import storage_profile
+    from lib.otp_delivery import ConsoleSink, sink_from_setting, stop_otp_delivery
+    from lib.batch import run_batch as run_commands
+
+    prepare_database()
+
+    # stdout carries the results, so console emails go to stderr
+    start_services(ConsoleSink(sys.stderr) if args.mail == "console" else sink_from_setting(args.mail))
+
+    # The in-memory database is one shared connection, which can't run commands side by side
+    workers = 1 if storage_profile.in_memory else args.workers
+
+    commands = sys.stdin if args.input == "-" else open(args.input)
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        summary = run_commands(commands, output, workers, args.show_otp)
+    finally:
+        if commands is not sys.stdin:
+            commands.close()
+        if output is not sys.stdout:
+            output.close()
+
+    # Send the last OTP emails before printing the summary
+    stop_otp_delivery()
+    print(json.dumps(summary), file=sys.stderr)
+
+def run_health(args):
+    """Check the database file without loading SQLAlchemy (for scripts and monitoring)"""
+    from lib.config import DATABASE_PATH
+    from lib.migrations import file_schema_version, LATEST_VERSION
+
+    try:
+        version = file_schema_version(DATABASE_PATH)
+    except Exception as error:
+        print(json.dumps({"ok": False, "database": DATABASE_PATH, "error": str(error)}))
+        sys.exit(1)
+
+    current = version >= LATEST_VERSION
+    print(json.dumps({"ok": current, "database": DATABASE_PATH,
+                      "schema_version": version, "latest_version": LATEST_VERSION}))
+    if not current:
+        sys.exit(1)
+
+def run_shards(args):
+    """Create the shard files, show how users are spread, or change the number of shards"""
+    from lib.sharding import ShardSet, rebalance_shards, shard_sizes
+
+    shards = ShardSet(args.folder, shard_count=args.count)
+    try:
+        if args.action == "rebalance":
+            if not args.count:
+                print("rebalance needs --count", file=sys.stderr)
+                sys.exit(2)
+            report = rebalance_shards(shards, args.count)
+        else:
+            report = {"shards": shard_sizes(shards)}
+    finally:
+        shards.close()
+
+    print(json.dumps(report))
+
+def run_mail_sink(args):
+    """Receive emails on a local port and write them to a file, until Ctrl+C"""
+    from lib.mail_sink import MailSink
+
+    server = MailSink(args.host, args.port, args.output)
+    print(f"Mail sink listening on {args.host}:{args.port}, writing to {args.output} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def build_parser():
+    """Describe the commands main.py understands"""
+    parser = argparse.ArgumentParser(description="CLI Authentication System")
+    parser.add_argument("--query-log", metavar="PATH", help="write slow SQL statements here as JSON lines (- for stderr)")
+    parser.add_argument("--slow-ms", type=float, default=50, help="statements slower than this are logged")
+    parser.add_argument("--otp-store", choices=["sql", "memory", "totp"], default="sql",
+                        help="keep OTP codes in the database, in memory, or work them out from the time (totp)")
+    parser.add_argument("--storage", choices=["single-user", "concurrent", "memory"], default="single-user",
+                        help="database settings: single-user (the default), concurrent (WAL, readers never "
+                             "wait on writers) or memory (nothing is saved)")
+    parser.add_argument("--mail", default="console",
+                        help="where OTP emails go: console, file:PATH or smtp://HOST:PORT")
+    commands = parser.add_subparsers(dest="command")
+
+    import_parser = commands.add_parser("import", help="add many users from a CSV or JSONL file")
+    import_parser.add_argument("path", help="file with username, email and password for each user")
+    import_parser.add_argument("--format", choices=["csv", "jsonl"], help="file format (default: from the file name)")
+    import_parser.add_argument("--chunk-size", type=int, default=1000, help="users per transaction")
+    import_parser.add_argument("--problems", help="write skipped rows here instead of stderr")
+
+    purge_parser = commands.add_parser("purge", help="delete expired OTP codes and old login attempts")
+    purge_parser.add_argument("--otp-hours", type=float, default=24, help="keep OTP codes this many hours after expiry")
+    purge_parser.add_argument("--attempt-days", type=float, default=90, help="keep login attempts this many days")
+    purge_parser.add_argument("--chunk-size", type=int, default=500, help="rows deleted per transaction")
+    purge_parser.add_argument("--pause", type=float, default=0.0, help="seconds to rest between chunks")
+    purge_parser.add_argument("--every", type=float, help="keep running, purging every this many seconds")
+
+    calibrate_parser = commands.add_parser("calibrate", help="pick the bcrypt cost for this machine")
+    calibrate_parser.add_argument("--target-ms", type=float, default=250, help="time budget for one hash")
+    calibrate_parser.add_argument("--dry-run", action="store_true", help="only print the result, don't save it")
+
+    export_parser = commands.add_parser("export-history", help="write an account's login history as CSV or JSONL")
+    export_parser.add_argument("email", help="email of the account")
+    export_parser.add_argument("--format", choices=["csv", "jsonl"], default="csv", help="file format")
+    export_parser.add_argument("--only", choices=["all", "success", "failure"], default="all", help="which attempts")
+    export_parser.add_argument("--output", help="file to write (default: stdout)")
+
+    stats_parser = commands.add_parser("rebuild-stats", help="count the login totals again from the login history")
+    stats_parser.add_argument("--email", help="only this account (default: everyone)")
+
+    batch_parser = commands.add_parser("batch", help="run commands from a JSON lines file without the menus")
+    batch_parser.add_argument("input", nargs="?", default="-", help="file with one command per line (default: stdin)")
+    batch_parser.add_argument("--output", default="-", help="file the results are written to (default: stdout)")
+    batch_parser.add_argument("--workers", type=int, default=4, help="commands run side by side")
+    batch_parser.add_argument("--show-otp", action="store_true",
+                              help="put the OTP code in login results (for replays and load tests only)")
+
+    shards_parser = commands.add_parser("shards", help="manage the sharded database files")
+    shards_parser.add_argument("action", choices=["status", "rebalance"],
+                               help="status creates the files if needed and counts users per shard")
+    shards_parser.add_argument("--count", type=int, help="number of shards (when creating or rebalancing)")
+    shards_parser.add_argument("--folder", default="shards", help="folder with the directory and shard files")
+
+    sink_parser = commands.add_parser("mail-sink", help="run a stand-in SMTP server that saves emails to a file")
+    sink_parser.add_argument("--host", default="localhost", help="address to listen on")
+    sink_parser.add_argument("--port", type=int, default=8025, help="port to listen on")
+    sink_parser.add_argument("--output", default="received_mail.jsonl", help="file the emails are written to")
+
+    commands.add_parser("health", help="check the database file is there and up to date (exit code 1 if not)")
+
+    return parser
+
+def main(argv=None):
+    """This is the main function that starts our entire authentication system"""
+    args = build_parser().parse_args(argv)
+
+    # Set up the database connections before anything opens a session
+    if args.command in DATABASE_COMMANDS:
+        # Batch mode keeps a connection open for each worker
+        open_storage(args.storage, args.workers if args.command == "batch" else None)
+    if args.query_log:
+        start_query_log(args.query_log, args.slow_ms)
+    if args.otp_store != "sql":
+        choose_otp_store(args.otp_store)
+
+    if args.command == "import":
+        run_import(args)
+    elif args.command == "purge":
+        run_purge(args)
+    elif args.command == "calibrate":
+        run_calibrate(args)
+    elif args.command == "export-history":
+        run_export_history(args)
+    elif args.command == "batch":
+        run_batch(args)
+    elif args.command == "rebuild-stats":
+        run_rebuild_stats(args)
+    elif args.command == "shards":
+        run_shards(args)
+    elif args.command == "health":
+        run_health(args)
+    elif args.command == "mail-sink":
+        run_mail_sink(args)
+    else:
+        run_interactive(args.mail)
+
 # This special code block runs when you execute this file directly
 # It means: "If someone runs 'python main.py', then call the main() function"
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,59 @@
+# This file checks that registering and updating a profile say which name was taken
+import pytest
+from sqlalchemy.exc import IntegrityError
+from lib.auth import try_register_user, update_user_info, check_password
+from lib.hashing import HashingEngine, set_hashing_engine, shutdown_hashing_engine
+from lib.models import User
+from benchmarks.common import TempDatabase
+
+@pytest.fixture
+def db():
+    """A session on a throwaway database, with a fast bcrypt cost"""
+    database = TempDatabase(name="test.db")
+    set_hashing_engine(HashingEngine(kind="thread", rounds=4))
+    session = database.session()
+    yield session
+    session.close()
+    shutdown_hashing_engine()
+    database.close()
+
+def stored_row(db, user_id):
+    """The user's row as it is in the database (not the object in the session)"""
+    db.expire_all()
+    return db.get(User, user_id)
+
+def test_register_reports_taken_username(db):
+    try_register_user(db, "ann", "ann@example.com", "secret1")
+    assert try_register_user(db, "ann", "other@example.com", "secret1") == (None, "username")
+
+def test_register_reports_taken_email(db):
+    try_register_user(db, "ann", "ann@example.com", "secret1")
+    assert try_register_user(db, "bob", "ann@example.com", "secret1") == (None, "email")
+
+def test_register_raises_other_integrity_errors(db):
+    user, _ = try_register_user(db, "ann", "ann@example.com", "secret1")
+    db.expunge(user)
+    # A clashing id isn't a taken name, so it mustn't come back as "username"
+    with pytest.raises(IntegrityError):
+        try_register_user(db, "bob", "bob@example.com", "secret1", user_id=user.id)
+
+def test_update_skips_taken_email_and_keeps_the_rest(db):
+    user, _ = try_register_user(db, "ann", "ann@example.com", "secret1")
+    try_register_user(db, "bob", "bob@example.com", "secret1")
+
+    taken = update_user_info(db, user, "ann2", "bob@example.com", "newpass1")
+
+    assert taken == ["email"]
+    row = stored_row(db, user.id)
+    assert (row.username, row.email) == ("ann2", "ann@example.com")
+    assert check_password("newpass1", row.password)
+
+def test_update_skips_taken_username_and_keeps_the_rest(db):
+    user, _ = try_register_user(db, "ann", "ann@example.com", "secret1")
+    try_register_user(db, "bob", "bob@example.com", "secret1")
+
+    taken = update_user_info(db, user, "bob", "ann2@example.com")
+
+    assert taken == ["username"]
+    row = stored_row(db, user.id)
+    assert (row.username, row.email) == ("ann", "ann2@example.com")
@@ -0,0 +1,16 @@
+# This file checks that no auth operation sends more SQL statements than it used to
+# It runs the same measurement as "python -m benchmarks.statement_counts"
+import pytest
+from benchmarks.statement_counts import EXPECTED_STATEMENTS, measure
+
+@pytest.fixture(scope="module")
+def counts():
+    """Statement counts for every operation (measured once for the whole file)"""
+    return measure()
+
+def test_every_operation_is_measured(counts):
+    assert set(counts) == set(EXPECTED_STATEMENTS)
+
+@pytest.mark.parametrize("operation", list(EXPECTED_STATEMENTS))
+def test_statement_count(counts, operation):
+    assert counts[operation] <= EXPECTED_STATEMENTS[operation]